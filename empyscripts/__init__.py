@@ -95,11 +95,10 @@ References |_|
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import sys
+import types
 import warnings
-
-from . import tmtemod
-from . import fdesign
-from .printinfo import versions
+import importlib
 
 __all__ = ['tmtemod', 'fdesign', 'versions']
 
@@ -111,3 +110,33 @@ msg = "\n\n    empyscripts resides now in empymod.scripts from empymod "
 msg += "v1.7.0 onwards.\n    This is the last version of empyscripts "
 msg += "(v0.3.2), use empymod instead.\n"
 warnings.warn(msg, DeprecationWarning)
+
+
+class _LazyModule(types.ModuleType):
+    """Package module which imports the add-ons when they are first accessed.
+
+    A module ``__getattr__`` (PEP 562) requires Python 3.7, hence this module
+    replaces itself in ``sys.modules`` by an instance of this class.
+    """
+
+    def __getattr__(self, name):
+        """Import the add-ons lazily; only called for missing attributes."""
+        if name in ['tmtemod', 'fdesign']:
+            return importlib.import_module('.'+name, self.__name__)
+        elif name == 'versions':
+            versions = importlib.import_module(
+                    '.printinfo', self.__name__).versions
+            self.versions = versions
+            return versions
+        raise AttributeError("module %r has no attribute %r" %
+                             (self.__name__, name))
+
+    def __dir__(self):
+        """List the add-ons, also the ones not yet imported."""
+        return sorted(set(self.__dict__).union(__all__))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(globals())
+_module._original = sys.modules[__name__]  # Keep the original module alive
+sys.modules[__name__] = _module
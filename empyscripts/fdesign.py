@@ -24,7 +24,9 @@ design his filters for [Key_2009]_, [Key_2012]_. Fruitful discussions with
 Evert Slob and Kerry Key improved the add-on substantially.
 
 Note that the use of empymod to create numerical transform pairs is, as of now,
-only implemented for the Hankel transform.
+only implemented for the Hankel transform. Numerical transform pairs can also
+be created from tabulated data with ``tabulated``, e.g., from stored responses
+of an external modeller.
 
 
 Implemented analytical transform pairs
@@ -68,6 +70,42 @@ implemented transform pair ``j0_1``
 
        return Ghosh('j0', lhs, rhs)
 
+Transform pairs defined with nested functions cannot be pickled. The
+implemented transform pairs are therefore registered with ``register_pair``:
+a registered transform pair carries its pair type and parameters (``pair``,
+``params``), from which it can be reconstructed. This makes it picklable (e.g.,
+to send it to worker processes or to store it alongside a filter) and provides
+a hashable identity, ``Ghosh.key``. Your own transform pairs can be registered
+in the same way, by decorating the module-level function with
+``@register_pair``. Registered transform pairs can also be obtained from their
+pair type and parameters with ``get_pair``, e.g. ``get_pair('j0_1', a=5)``.
+
+The parameters of the implemented analytical transform pairs can also be
+arrays (parameter sweeps), e.g. ``j0_1(a=np.linspace(1, 10, 200))``. The
+``lhs`` and ``rhs`` of such a transform pair have an additional leading
+parameter axis, so all parameters are evaluated at once. In ``design``, all
+parameters of a sweep in ``fI`` enter the same inversion, and each parameter of
+a sweep in ``fC`` is checked as if it were an individual transform pair.
+
+To follow a design while it runs, ``design_iter`` yields the result of each
+grid cell and the best filter so far, as soon as they are calculated.
+
+Many designs (e.g., for different ``n`` or transform pairs) can be run on a
+shared pool of worker processes with ``DesignQueue``, which schedules them by
+priority and returns futures. Evaluations of registered transform pairs are
+cached in each worker, and shared between the jobs which run on it.
+
+Designs which are too big for one machine can be split into shards with
+``shard``; each shard is a self-contained job specification, which can be run
+on any node with ``run_shard``. The results of all shards are combined with
+``merge`` into the same result as the one from ``design``.
+
+For batch systems, designs can be run headless from a JSON job file with the
+command-line tool ``empyscripts-fdesign`` (see ``main``).
+
+Designed filters can be applied to any transform pair with ``apply_filter``,
+and compared to other filters, e.g. the ones of empymod, with ``benchmark``.
+
 
 Implemented Hankel transforms
 -----------------------------
@@ -220,36 +258,104 @@ Implemented Fourier transforms
 # the License.
 
 import os
+import csv
+import dbm
+import sys
+import json
+import uuid
+import heapq
+import pickle
 import shelve
+import types
+import argparse
+import multiprocessing
+import tempfile
+import hashlib
+import inspect
+import importlib
+import threading
+import tracemalloc
 import numpy as np
-from copy import deepcopy as dc
+from functools import wraps
+from collections import OrderedDict
+from copy import copy, deepcopy as dc
 from scipy.constants import mu_0
-from scipy.optimize import brute, fmin_powell
-
-# Optional imports
-try:
-    import matplotlib.pyplot as plt
-except ImportError:
-    plt = False
-    plt_msg = "* WARNING :: `matplotlib` is not installed, no figures shown."
+from concurrent.futures import (Future, ProcessPoolExecutor, as_completed,
+                                CancelledError)
 
+from empymod import filters as empyfilters
 from empymod.filters import DigitalFilter
 from empymod.model import dipole, wavenumber
 from empymod.filters import key_201_2009 as j0j1filt
 from empymod.filters import key_201_CosSin_2012 as sincosfilt
 from empymod.utils import printstartfinish, timedelta, default_timer
 
-__all__ = ['design', 'save_filter', 'load_filter', 'plot_result',
-           'print_result', 'Ghosh', 'j0_1', 'j0_2', 'j0_3', 'j0_4', 'j0_5',
+
+class _LazyImport:
+    """Module (or attribute of it) which is only imported when first used.
+
+    Heavy and optional dependencies are imported like this, so that importing
+    fdesign stays fast. The instance is False if the import fails.
+    """
+
+    def __init__(self, module, attr=None):
+        """Store what to import."""
+        self._module = module
+        self._attr = attr
+
+    def _load(self):
+        """Import on first call; return module/attribute or False."""
+        if '_obj' not in self.__dict__:
+            try:
+                obj = importlib.import_module(self._module)
+                if self._attr:
+                    obj = getattr(obj, self._attr)
+            except ImportError:
+                obj = False
+            self._obj = obj
+        return self._obj
+
+    def __bool__(self):
+        """False if the module is not installed."""
+        return self._load() is not False
+
+    def __getattr__(self, name):
+        """Get attribute of the imported module."""
+        if name in ['_module', '_attr', '_obj']:  # Not set (e.g., unpickling)
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        """Call the imported attribute."""
+        return self._load()(*args, **kwargs)
+
+
+brute = _LazyImport('scipy.optimize', 'brute')
+
+# Optional imports, only imported when first used
+plt = _LazyImport('matplotlib.pyplot')
+Figure = _LazyImport('matplotlib.figure', 'Figure')
+FigureCanvasAgg = _LazyImport('matplotlib.backends.backend_agg',
+                              'FigureCanvasAgg')
+plt_msg = "* WARNING :: `matplotlib` is not installed, no figures shown."
+numexpr = _LazyImport('numexpr')
+numexpr_msg = ("* WARNING :: `numexpr` is not installed, " +
+               "`opt=='parallel'` has no effect.")
+
+__all__ = ['design', 'design_iter', 'save_filter', 'load_filter',
+           'apply_filter', 'benchmark', 'DesignQueue', 'shard', 'run_shard',
+           'merge', 'main', 'plot_result', 'plot_qc', 'print_result', 'Ghosh',
+           'register_pair', 'get_pair', 'j0_1', 'j0_2', 'j0_3', 'j0_4', 'j0_5',
            'j1_1', 'j1_2', 'j1_3', 'j1_4', 'j1_5', 'sin_1', 'sin_2', 'sin_3',
-           'cos_1', 'cos_2', 'cos_3', 'empy_hankel']
+           'cos_1', 'cos_2', 'cos_3', 'empy_hankel', 'tabulated']
 
 
 # 1. PRINCIPAL FILTER DESIGNING ROUTINES
 
 def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
            cvar='amp', error=0.01, name=None, full_output=False, finish=False,
-           save=True, verb=2, plot=1):
+           save=True, verb=2, plot=1, cache=False, force=False, qcdir=None,
+           screen=None, maxmem=None, opt=None):
     """Digital linear filter (DLF) design
 
     This routine can be used to design digital linear filters for the Hankel or
@@ -284,7 +390,8 @@ def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
     fI, fC : transform pairs
         Theoretical or numerical transform pair(s) for the inversion (I) and
         for the check of goodness (fC). fC is optional. If not provided, fI is
-        used for both fI and fC.
+        used for both fI and fC. Transform pairs can be parameter sweeps, see
+        the section about implemented analytical transform pairs.
 
     r : array, optional
         Right-hand side evaluation points for the check of goodness (fC).
@@ -344,6 +451,72 @@ def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
                  (can result in lots of plots depending on spacing and shift)
                  If you are using a notebook, use %matplotlib notebook to have
                  all inversion results appear in the same plot.
+                 The data of each inversion is recorded during the brute-force
+                 search, and plotted after it (see ``qcdir``).
+
+    cache : bool or str, optional
+        If True, the result is looked up in and stored to the result cache
+        ./filters/cache (shelve); if a string, it is used as path of the cache
+        instead. Cached results are identified by a hash of all inputs which
+        affect the result: n, spacing, shift, fI, fC, r, r_def, reim, cvar,
+        error, and finish. This requires all transform pairs to be registered
+        (see ``register_pair``); else the cache is not used. Default is False.
+
+    force : bool, optional
+        If True, the design is carried out even if the result is in the cache,
+        and the cached result is replaced. Default is False.
+
+    qcdir : str, optional
+        Only relevant if plot=3. If provided, the recorded data of the
+        inversions is stored in ``{qcdir}/qc.pkl``, and the figures are
+        rendered to image files in ``qcdir`` by a background process, without
+        a display (see ``plot_qc``; a failure of this process is reported by
+        the next design with ``qcdir``). Default is None, which plots the
+        figures with pyplot after the brute-force search.
+
+    screen : float, optional
+        If provided, the brute-force search is carried out in two stages: All
+        cells (spacing, shift) are first screened cheaply, by checking their
+        filters on a subsampled r (about 250 points). Only cells whose
+        screened value is at most ``screen`` times the best screened value
+        are then checked on the full r, reusing their filters; their values
+        are identical to the ones of a full run. The other cells are reported
+        as np.inf. As the screened values are only estimates, the margin
+        should be generous, e.g., screen=100. Default is None (no screening).
+
+        Only the check is cheaper in the screening stage (subsampled r): the
+        filters are calculated with the full ``r_def`` and in double
+        precision, as in a full run. Single precision cannot resolve the
+        minimum amplitudes of good filters (it saturates at ~1e-7), and
+        filters from a reduced ``r_def[2]`` have a different quality from the
+        final ones, hence their values do not rank the cells reliably.
+
+    maxmem : float, optional
+        Memory budget in MB for the evaluation of the transform pairs. If
+        provided, the lhs of the transform pairs are evaluated in chunks of r
+        sized from the budget, instead of for all r at once; this applies to
+        the check of the filters and to their calculation, whose
+        least-squares system is then solved chunk by chunk (updated QR). The
+        results of the check are identical to the ones without budget, and so
+        are the filters if their system fits into one chunk. If it needs
+        several, the filters are least-squares solutions of the same quality
+        (residual), but, as the system is very ill-conditioned, not the same
+        values. The peak memory per cell is measured (tracemalloc) and printed
+        if verb > 1. Default is None (no chunking).
+
+    opt : {None, 'parallel'}, optional
+        Optimization flag. Defaults to None:
+            - None: The transform pairs are evaluated with numpy.
+            - If 'parallel', the lhs of the included analytical transform pairs
+              are evaluated with the package ``numexpr``, multithreaded and in
+              cache-sized blocks, without large temporary arrays. The results
+              agree with the ones of numpy to round-off. Always check if it
+              actually improves performance for a specific problem; it pays
+              off mainly for the complex-valued pairs (j0_4, j0_5, j1_4, j1_5)
+              and on several cores. Transform pairs without a numexpr
+              version (empymod, tabulated, user-defined) use numpy. If
+              ``numexpr`` is not installed, a warning is printed and numpy is
+              used.
 
     Returns
     -------
@@ -364,37 +537,9 @@ def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
         if verb > 0:
             print(plt_msg)
 
-    # Ensure fI, fC are lists
-    def check_f(f):
-        if hasattr(f, 'name'):  # put into list if single tp
-            f = [f, ]
-        else:  # ensure list (works for lists, tuples, arrays)
-            f = list(f)
-        return f
-
-    if not fC:  # copy fI if fC not provided
-        fC = dc(fI)
-    fI = check_f(fI)
-    if fI[0].name == 'j2':
-        print("* ERROR   :: j2 (jointly j0 and j1) is only implemented for " +
-              "fC, not for fI!")
-        raise ValueError('j2')
-    fC = check_f(fC)
-
-    # Check default input values
-    if finish and not callable(finish):
-        finish = fmin_powell
-    if name is None:
-        name = 'dlf_'+str(n)
-    if r is None:
-        r = np.logspace(0, 5, 1000)
-    if reim not in [np.real, np.imag]:
-        reim = np.real
-
-    # Get spacing and shift slices, cast r
-    ispacing = _ls2ar(spacing, 'spacing')
-    ishift = _ls2ar(shift, 'shift')
-    r = np.atleast_1d(r)
+    # Check input, set defaults
+    out = _check_design_input(n, spacing, shift, fI, fC, r, reim, name, finish)
+    fI, fC, r, reim, name, finish, ispacing, ishift = out
 
     # Initialize log-dict to keep track in brute-force minimization-function.
     log = {'cnt1': -1,   # Counter
@@ -403,45 +548,126 @@ def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
            'time': t0,   # Timer
            'warn-r': 0}  # Warning for short r
 
-    # === 2.  THEORETICAL MODEL rhs ============
-
-    # Calculate rhs
-    for i, f in enumerate(fC):
-        fC[i].rhs = f.rhs(r)
-
-    # Plot
-    if plot > 1:
-        _call_qc_transform_pairs(n, ispacing, ishift, fI, fC, r, r_def, reim)
-
-    # === 3. RUN BRUTE FORCE OVER THE GRID ============
-    full = brute(_get_min_val, (ispacing, ishift), full_output=True,
-                 args=(n, fI, fC, r, r_def, error, reim, cvar, verb, plot,
-                       log), finish=finish)
-
-    # Finish output from brute/fmin; depending if finish or not
-    if verb > 1:
-        print('')
-        if callable(finish):
-            print('')
-
-    # Get best filter (full[0] contains spacing/shift of the best result).
-    dlf = _calculate_filter(n, full[0][0], full[0][1], fI, r_def, reim, name)
+    # Memory budget
+    if maxmem:
+        log['maxmem'] = maxmem
+
+    # Look up result in cache
+    cached = None
+    if cache:
+        ckey = _design_key(n, ispacing, ishift, fI, fC, r, r_def, reim, cvar,
+                           error, finish, screen)
+        if cache is True:
+            cache = './filters/cache'
+        if ckey is None:
+            if verb > 0:
+                print("* WARNING :: Result cache not used; not all " +
+                      "transform pairs are registered.")
+        elif not force:
+            cached = _load_cache(cache, ckey)
+
+    # Optimization: numexpr or numpy for the transform pairs
+    ne_eval = _set_opt(opt, verb)
+    try:
+
+        # === 2.  THEORETICAL MODEL rhs ============
+
+        # Calculate rhs (only required for QC if the result is cached)
+        if cached is None or plot > 1:
+            for i, f in enumerate(fC):
+                fC[i].rhs = _evaluate(f, 'rhs', r, ('r', r))
+
+        if cached is None:
+
+            # Plot
+            if plot > 1:
+                _call_qc_transform_pairs(n, ispacing, ishift, fI, fC, r,
+                                         r_def, reim)
+
+            # Record inversion results for QC instead of plotting them
+            if plot > 2:
+                log['qc'] = {'fC': fC, 'r': r, 'cvar': cvar, 'cells': []}
+
+            # === 3. RUN BRUTE FORCE OVER THE GRID ============
+            args = (n, fI, fC, r, r_def, error, reim, cvar, verb, plot, log)
+
+            # Peak memory per cell is recorded in the brute force
+            trace = False
+            if maxmem:
+                log['peakmem'] = []
+                trace = not tracemalloc.is_tracing()
+                if trace:
+                    tracemalloc.start()
 
-    # If verbose, print result
-    if verb > 1:
-        print_result(dlf, full, cvar)
-
-    # === 4.  FINISHED ============
-    printstartfinish(verb, t0)
+            try:
+                if screen:
+                    full = _screen_brute(screen, ispacing, ishift, args,
+                                         finish)
+                else:
+                    full = brute(_get_min_val, (ispacing, ishift),
+                                 full_output=True, args=args, finish=finish)
+            finally:
+                if trace:
+                    tracemalloc.stop()
+
+            # Finish output from brute/fmin; depending if finish or not
+            if verb > 1:
+                print('')
+                if callable(finish):
+                    print('')
+
+            # Peak memory per cell
+            if maxmem:
+                peakmem = np.array(log.pop('peakmem'))/2**20
+                if verb > 1:
+                    print("   peak memory     : %.1f MB per cell (mean " %
+                          peakmem.max() + "%.1f MB)" % peakmem.mean())
+
+            # Get best filter (full[0] contains spacing/shift of the best
+            # result).
+            dlf = _calculate_filter(n, full[0][0], full[0][1], fI, r_def,
+                                    reim, name, maxmem)
+
+            # Plot recorded inversion results
+            if plot > 2:
+                qc = log.pop('qc')
+                if qcdir:
+                    _save_qc(qc, qcdir, verb)
+                    plot_qc(qc, path=qcdir, background=True)
+                else:
+                    plot_qc(qc)
+
+            # Store result in cache
+            if cache and ckey is not None:
+                _store_cache(cache, ckey, (dlf, full))
 
-    # If plot, show result
-    if plot > 0:
-        print('* QC: Overview of brute-force inversion:')
-        plot_result(dlf, full, cvar, False)
-        if plot > 1:
-            print('* QC: Inversion result of best filter (minimum amplitude):')
-            _get_min_val(full[0], n, fI, fC, r, r_def, error, reim, cvar, 0,
-                         plot+1, log)
+        else:
+            # Get result from cache
+            dlf, full = cached
+            dlf.name = dlf.savename = name
+            if verb > 1:
+                print('   Result loaded from cache')
+
+        # If verbose, print result
+        if verb > 1:
+            print_result(dlf, full, cvar)
+
+        # === 4.  FINISHED ============
+        printstartfinish(verb, t0)
+
+        # If plot, show result
+        if plot > 0:
+            print('* QC: Overview of brute-force inversion:')
+            plot_result(dlf, full, cvar, False)
+            if plot > 1:
+                print('* QC: Inversion result of best filter ' +
+                      '(minimum amplitude):')
+                _get_min_val(full[0], n, fI, fC, r, r_def, error, reim, cvar,
+                             0, plot+1, log)
+
+    finally:
+        # Reset optimization, also if the design fails
+        _set_opt(ne_eval)
 
     # Save if desired
     if save:
@@ -457,6 +683,94 @@ def design(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2), reim=None,
         return dlf
 
 
+def design_iter(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2),
+                reim=None, cvar='amp', error=0.01, name=None, workers=1,
+                verb=1):
+    """Digital linear filter (DLF) design, yielding results as they arrive.
+
+    Generator version of ``design``: It carries out the same brute-force
+    search over spacing and shift, but yields the result of each grid cell as
+    soon as it is calculated, together with the best filter so far. The
+    iteration can be stopped at any point; the last yielded filter is the best
+    one of the cells calculated so far. After all cells, it is the same filter
+    as returned by ``design`` without ``finish``.
+
+    Parameters
+    ----------
+    n, spacing, shift, fI, fC, r, r_def, reim, cvar, error, name :
+        Input parameters as in ``design``.
+
+    workers : int, optional
+        Number of processes; default is 1. If workers > 1, the cells are
+        calculated in parallel and yielded in the order they finish; the
+        transform pairs must be picklable (e.g., registered ones, see
+        ``register_pair``).
+
+    verb : {0, 1}, optional
+        Level of verbosity, default is 1:
+            - 0: Print nothing.
+            - 1: Print warnings.
+
+    Yields
+    ------
+    spacing, shift : float
+        Spacing and shift of the cell.
+
+    value : float
+        Minimum amplitude or 1/max r of the cell (depending on cvar); the
+        value brute minimizes in ``design``.
+
+    imin : int
+        Index of r of the minimum amplitude or max r.
+
+    filter : empymod.filter.DigitalFilter instance
+        Best filter so far.
+
+    """
+    # Check input, set defaults
+    out = _check_design_input(n, spacing, shift, fI, fC, r, reim, name, False)
+    fI, fC, r, reim, name, _, ispacing, ishift = out
+
+    # Calculate rhs
+    for i, f in enumerate(fC):
+        fC[i].rhs = _evaluate(f, 'rhs', r, ('r', r))
+
+    # Cells in the order of brute
+    grid = _design_grid(ispacing, ishift)
+    cells = list(zip(grid[0].ravel(), grid[1].ravel()))
+    order = {cell: i for i, cell in enumerate(cells)}
+    args = (n, fI, fC, r, r_def, error, reim, cvar, verb, 0)
+
+    def results():
+        """Yield spacing, shift, value, and imin of all cells."""
+        if workers > 1:
+            # The design input is passed with each cell, as pool initializers
+            # require Python 3.7
+            executor = ProcessPoolExecutor(workers)
+            jobs = [executor.submit(_iter_cell, cell, args) for cell in cells]
+            try:
+                for job in as_completed(jobs):
+                    yield job.result()
+            finally:  # Also if the iteration is stopped early
+                for job in jobs:
+                    job.cancel()
+                executor.shutdown(wait=True)
+        else:
+            log = {'warn-r': 0, 'imin': None}
+            for sp, sh in cells:
+                value = _get_min_val((sp, sh), *args, log)
+                yield sp, sh, float(value), int(log['imin'])
+
+    # Keep track of the best filter; the first cell of the grid order wins
+    # for equal values, as in brute
+    best = None
+    for sp, sh, value, imin in results():
+        key = (value, order[(sp, sh)])
+        if best is None or key < best[0]:
+            best = (key, _calculate_filter(n, sp, sh, fI, r_def, reim, name))
+        yield sp, sh, value, imin, best[1]
+
+
 def save_filter(name, filt, full=None):
     """Save DLF-filter to shelve."""
     os.makedirs('./filters', exist_ok=True)
@@ -478,6 +792,775 @@ def load_filter(name, full=False):
             return shfilt['dlf']
 
 
+def apply_filter(filt, lhs, r, ftype=None, chunk=None, lagged=False):
+    """Apply a digital linear filter to the lhs of a transform pair.
+
+    Calculates the rhs of a transform pair from its lhs with the filter
+    ``filt`` (base b, coefficients c), as done in ``design``,
+
+    .. math::
+
+        rhs(r) = \\frac{1}{r}\\sum_i lhs\\left(\\frac{b_i}{r}\\right) c_i \\ .
+
+    For 'j2' the lhs returns two arrays, for j0 and j1, and the rhs is the sum
+    of the j0-part and the j1-part divided by r.
+
+    The lhs is evaluated on the grid k = b/r[:, None] of size (r.size, n),
+    which is kept in a small cache for subsequent calls with the same filter
+    and r. For many r the memory can be bounded with ``chunk``. Alternatively,
+    the lagged convolution evaluates the lhs only on n-1+nr points, where nr
+    is the number of log-spaced r with the spacing of the filter base which
+    cover r; the result is interpolated with a cubic spline to r.
+
+    Parameters
+    ----------
+    filt : empymod.filter.DigitalFilter instance
+        Filter, e.g., from ``design`` or from empymod.filters.
+
+    lhs : callable or Ghosh instance
+        Left-hand side of the transform pair, evaluated at k.
+
+    r : array_like
+        Points at which the rhs is calculated.
+
+    ftype : {'j0', 'j1', 'j2', 'sin', 'cos'}, optional
+        Transform type; default is the name of lhs, if it is a Ghosh instance.
+
+    chunk : int, optional
+        Maximum number of r for which the lhs is evaluated at once; default is
+        all r. Not used for the lagged convolution.
+
+    lagged : bool, optional
+        If True, the lagged convolution is used; default is False.
+
+    Returns
+    -------
+    rhs : array
+        Right-hand side at r. Parameter sweeps (see module docstring) yield a
+        leading parameter axis.
+
+    """
+    # Get transform type and lhs
+    if isinstance(lhs, Ghosh):
+        if ftype is None:
+            ftype = lhs.name
+        lhs = lhs.lhs
+    if ftype not in ['j0', 'j1', 'j2', 'sin', 'cos']:
+        print("* ERROR   :: <ftype> must be one of 'j0', 'j1', 'j2', 'sin', " +
+              "or 'cos'; <ftype> provided: " + str(ftype))
+        raise ValueError('ftype')
+
+    # Required filter coefficients (j2 uses j0 and j1)
+    coeffs = ['j0', 'j1'] if ftype == 'j2' else [ftype, ]
+    for coeff in coeffs:
+        if not hasattr(filt, coeff):
+            print("* ERROR   :: Filter " + str(filt.name) + " has no " +
+                  "coefficients for " + coeff + ".")
+            raise ValueError('ftype')
+    coeffs = [getattr(filt, coeff) for coeff in coeffs]
+
+    r = np.atleast_1d(np.asarray(r, dtype=float))
+
+    def dlf(values, rr):
+        """Carry out the DLF for lhs-values at k (rr.size, n)."""
+        if ftype == 'j2':
+            return np.dot(values[0], coeffs[0])/rr + (
+                    np.dot(values[1], coeffs[1])/rr**2)
+        else:
+            return np.dot(values, coeffs[0])/rr
+
+    # Lagged convolution
+    if lagged:
+        base = filt.base
+        spacing = np.log(base[1]/base[0])
+
+        # Lagged r: rmax*exp(-j*spacing), j = 0, ..., nlag-1, covering r
+        nlag = int(np.ceil(np.log(r.max()/r.min())/spacing - 1e-8)) + 1
+        if r.size > 1:
+            nlag = max(nlag, 4)  # Cubic spline requires 4 points
+        rlag = r.max()*np.exp(-np.arange(nlag)*spacing)
+
+        # k_ij = b_i/rlag_j = kk_(i+j)
+        kk = _kgrid(base[0]*np.exp(np.arange(base.size+nlag-1)*spacing),
+                    r.max())[0]
+        values = lhs(kk)
+        if ftype == 'j2':
+            values = [_lagged(val, base.size, nlag) for val in values]
+        else:
+            values = _lagged(values, base.size, nlag)
+        rhs = dlf(values, rlag)
+
+        # Interpolate to r (in log-log space, see ``tabulated``)
+        if nlag > 1:
+            rhs = _LogSpline(rlag[::-1], rhs[..., ::-1], 'rhs', 0)(r)
+
+        return rhs
+
+    # Standard DLF, in chunks of r
+    if chunk is None:
+        chunk = r.size
+    rhs = []
+    for i in range(0, r.size, chunk):
+        rr = r[i:i+chunk]
+        rhs.append(dlf(lhs(_kgrid(filt.base, rr)), rr))
+
+    return np.concatenate(rhs, axis=-1)
+
+
+def benchmark(filters, pairs, r=None, error=0.01, output='benchmark.csv',
+              sort='cost', workers=1, repeat=3, verb=1):
+    """Compare accuracy and runtime cost of filters for transform pairs.
+
+    Every filter is applied (``apply_filter``) to every transform pair of a
+    fitting type, and compared to the rhs of the transform pair. The results
+    are written as a table to a CSV file, sorted by ``sort``, with the
+    columns:
+
+    - filter, n, pair, ftype: Name and number of points of the filter; name
+      (``pair`` of registered transform pairs, else its type) and type of the
+      transform pair.
+    - max_r, min_amp: Maximum r and minimum amplitude up to which the relative
+      error is below ``error`` (as in ``design``).
+    - digits: Number of accurate digits, -log10 of the median relative error
+      up to max_r.
+    - time: Wall time per transform (per r) in microseconds; minimum of
+      ``repeat`` runs.
+    - cost: Wall time per accurate digit (time/digits) in microseconds.
+
+    Parameters
+    ----------
+    filters : list of DigitalFilter instances or str
+        Filters to compare, e.g. from ``design``; strings are names of filters
+        in empymod.filters, e.g. 'key_201_2009'.
+
+    pairs : list of Ghosh instances
+        Transform pairs; parameter sweeps are not supported.
+
+    r : array_like, optional
+        Points at which the rhs is compared; default is np.logspace(0, 5,
+        1000).
+
+    error : float, optional
+        Up to which relative error the transformation is considered good;
+        default is 0.01 (1 %).
+
+    output : str, optional
+        File name of the CSV file; default is 'benchmark.csv'. If None, no
+        file is written.
+
+    sort : str, optional
+        Column by which the table is sorted; default is 'cost'. Columns where
+        larger is better (max_r, digits) are sorted descending.
+
+    workers : int, optional
+        Number of processes; default is 1. The transform pairs must be
+        picklable if workers > 1 (e.g., registered ones). Note that timings
+        are affected if there are fewer free processors than workers.
+
+    repeat : int, optional
+        Number of runs of which the fastest is taken as time; default is 3.
+
+    verb : {0, 1}, optional
+        Level of verbosity, default is 1:
+            - 0: Print nothing.
+            - 1: Print the table.
+
+    Returns
+    -------
+    table : list of dict
+        Rows of the table.
+
+    """
+    if r is None:
+        r = np.logspace(0, 5, 1000)
+    r = np.atleast_1d(r)
+    columns = ['filter', 'n', 'pair', 'ftype', 'max_r', 'min_amp', 'digits',
+               'time', 'cost']
+    if sort not in columns:
+        print("* ERROR   :: <sort> must be one of " + str(columns) + "; " +
+              "<sort> provided: " + str(sort))
+        raise ValueError('sort')
+
+    # Get filters from names
+    filters = [getattr(empyfilters, filt)() if isinstance(filt, str) else
+               filt for filt in filters]
+
+    # Reference rhs of the transform pairs, calculated once
+    refs = [f.rhs(r) for f in pairs]
+
+    # All filter/pair-combinations of fitting type
+    tasks = []
+    for filt in filters:
+        for f, ref in zip(pairs, refs):
+            ftypes = ['j0', 'j1'] if f.name == 'j2' else [f.name, ]
+            if all(hasattr(filt, ftype) for ftype in ftypes):
+                tasks.append((filt, f, r, ref, error, repeat))
+
+    # Run them
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            table = list(executor.map(_benchmark_filter, tasks))
+    else:
+        table = [_benchmark_filter(task) for task in tasks]
+
+    # Sort table; larger is better for max_r and digits
+    reverse = sort in ['max_r', 'digits']
+    table.sort(key=lambda row: row[sort], reverse=reverse)
+
+    # Write table
+    if output:
+        with open(output, 'w', newline='') as fcsv:
+            writer = csv.DictWriter(fcsv, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(table)
+
+    if verb > 0:
+        print('   %-24s %5s %-12s %-5s %10s %10s %6s %10s %10s' %
+              tuple(columns))
+        for row in table:
+            print('   %-24s %5d %-12s %-5s %10.3g %10.3g %6.2f %10.3g %10.3g'
+                  % tuple(row[c] for c in columns))
+
+    return table
+
+
+def _design_key(n, ispacing, ishift, fI, fC, r, r_def, reim, cvar, error,
+                finish, screen=None):
+    """Return hash of the design inputs; None if a pair is not registered.
+
+    Screened results differ from full ones (cells which did not survive the
+    screening are np.inf), hence the screening margin is part of the key.
+    """
+    keys = [f.key for f in fI + fC]
+    if None in keys:
+        return None
+
+    inp = (n, ispacing, ishift, keys, r, r_def, reim.__name__, cvar, error,
+           getattr(finish, '__name__', finish), screen or None)
+    return hashlib.sha256(repr(_freeze(inp)).encode()).hexdigest()
+
+
+def _load_cache(cache, ckey):
+    """Return cached (filter, full) for key ckey; None if not in cache."""
+    try:
+        with shelve.open(cache, 'r') as shcache:
+            return shcache.get(ckey)
+    except dbm.error:  # Cache does not exist yet
+        return None
+
+
+def _store_cache(cache, ckey, result):
+    """Store (filter, full) result in cache under key ckey."""
+    os.makedirs(os.path.dirname(cache) or '.', exist_ok=True)
+    with shelve.open(cache) as shcache:
+        shcache[ckey] = result
+
+
+class DesignQueue:
+    """Queue to run many filter designs on a shared pool of worker processes.
+
+    Jobs are submitted with the input parameters of ``design`` and run on a
+    pool of worker processes, ordered by priority. ``submit`` returns a
+    ``concurrent.futures.Future``, which holds the output of ``design`` once
+    the job is finished.
+
+    The worker processes are kept alive between jobs, and each of them keeps
+    its own cache of evaluated lhs and rhs of registered transform pairs (see
+    ``register_pair``). Jobs which run on the same worker and use the same
+    transform pairs on the same grid therefore share these evaluations
+    instead of re-computing them. The cache is not shared between workers;
+    instead, a job is started on a free worker which already ran jobs with
+    the same transform pairs, if there is one.
+
+    The queue can be used as context manager, which waits for all jobs to
+    finish and shuts the pool down at the end.
+
+    .. code-block:: python
+
+        with fdesign.DesignQueue(max_workers=4) as queue:
+            futures = [queue.submit(n=n, spacing=(0.04, 0.1, 10),
+                                    shift=(-3, -1, 10), fI=fI, priority=n)
+                       for n in [201, 101, 51]]
+        filters = [fut.result() for fut in futures]
+
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of worker processes; default is the number of processors.
+
+    cache_size : float, optional
+        Maximum size of the evaluation cache of each worker process in MB;
+        default is 256. If 0, no evaluations are cached.
+
+    """
+
+    def __init__(self, max_workers=None, cache_size=256):
+        """Start the pool of worker processes."""
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+
+        # One single-process pool per worker, to route jobs to workers
+        self._pools = [ProcessPoolExecutor(1)
+                       for _ in range(self.max_workers)]
+        self._idle = list(range(self.max_workers))  # Free workers
+        self._keys = [set() for _ in self._pools]   # Pairs run on workers
+        self._lock = threading.RLock()
+        self._jobs = []      # Heap of waiting jobs
+        self._count = 0      # Submission counter, keeps FIFO on equal priority
+        self._futures = []   # All submitted futures
+        self._shutdown = False
+
+    def submit(self, priority=0, **kwargs):
+        """Submit a design job.
+
+        Parameters
+        ----------
+        priority : int or float, optional
+            Priority of the job. Jobs with lower values are started first;
+            jobs of equal priority are started in order of submission.
+            Default is 0.
+
+        kwargs : keyword arguments
+            Input parameters for ``design``. Transform pairs have to be
+            picklable, hence registered (see ``register_pair``). Unless
+            provided, the workers use ``verb=0``, ``plot=0``, and
+            ``save=False``.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future of the job; ``future.result()`` returns the output of
+            ``design``.
+
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit jobs after shutdown')
+            future = Future()
+            keys = _job_keys(kwargs)
+            heapq.heappush(self._jobs, (priority, self._count, future,
+                                        kwargs, keys))
+            self._count += 1
+            self._futures.append(future)
+            self._dispatch()
+        return future
+
+    def shutdown(self, wait=True):
+        """Shut the queue down.
+
+        If wait, wait for all jobs to finish. Else, jobs which have not yet
+        been started are cancelled, and running jobs finish in the background.
+        """
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+            if not wait:
+                while self._jobs:
+                    heapq.heappop(self._jobs)[2].cancel()
+        if wait:
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()  # Blocks until the job is finished
+        for pool in self._pools:
+            pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+    def _dispatch(self):
+        """Move waiting jobs to free workers, in order of priority.
+
+        A job goes to the free worker which already ran the most of its
+        transform pairs, as their evaluations are cached there.
+        """
+        with self._lock:
+            while self._jobs and self._idle:
+                _, _, future, kwargs, keys = heapq.heappop(self._jobs)
+                if not future.set_running_or_notify_cancel():
+                    continue  # Job was cancelled while waiting
+                worker = max(self._idle,
+                             key=lambda w: len(keys & self._keys[w]))
+                try:
+                    job = self._pools[worker].submit(_run_design, kwargs,
+                                                     self.cache_size)
+                except Exception as exc:  # E.g., broken pool
+                    future.set_exception(exc)
+                    continue
+                self._idle.remove(worker)
+                self._keys[worker] |= keys
+                job.add_done_callback(
+                        lambda job, future=future, worker=worker:
+                        self._done(job, future, worker))
+
+    def _done(self, job, future, worker):
+        """Pass the outcome of a finished job on and start the next one."""
+        if job.cancelled():
+            future.set_exception(CancelledError())
+        elif job.exception() is None:
+            future.set_result(job.result())
+        else:
+            future.set_exception(job.exception())
+        with self._lock:
+            self._idle.append(worker)
+            self._dispatch()
+
+
+def shard(n, spacing, shift, fI, fC=False, r=None, r_def=(1, 1, 2),
+          reim=None, cvar='amp', error=0.01, name=None, finish=False,
+          nshards=2, path='.', verb=1, maxmem=None, opt=None):
+    """Split a design into shards, to be run independently (e.g., on nodes).
+
+    The grid of spacing and shift values is split into ``nshards`` parts, and
+    for each a self-contained job specification is written to a file
+    ``{path}/{name}.shard{i}.pkl``. The shards can be run on any machine with
+    ``run_shard``, and their results are combined with ``merge``.
+
+    The result of ``shard`` -> ``run_shard`` (on each shard) -> ``merge`` is
+    the same as the one of ``design`` with the same input parameters.
+
+    Parameters
+    ----------
+    n, spacing, shift, fI, fC, r, r_def, reim, cvar, error, name, finish :
+        Input parameters as in ``design``. The transform pairs must be
+        picklable (e.g., registered ones, see ``register_pair``).
+
+    nshards : int, optional
+        Number of shards; default is 2.
+
+    path : str, optional
+        Directory in which the job specifications are stored (created if it
+        does not exist); default is the current directory.
+
+    verb : {0, 1}, optional
+        Level of verbosity, default is 1:
+            - 0: Print nothing.
+            - 1: Print the file names of the shards.
+
+    maxmem : float, optional
+        Memory budget in MB for ``run_shard``, see ``design``. It does not
+        change the result. Default is None (no budget).
+
+    opt : {None, 'parallel'}, optional
+        Optimization flag for ``run_shard`` and ``merge``, see ``design``.
+
+    Returns
+    -------
+    files : list of str
+        File names of the job specifications.
+
+    """
+    # Check input, set defaults
+    out = _check_design_input(n, spacing, shift, fI, fC, r, reim, name, finish)
+    fI, fC, r, reim, name, finish, ispacing, ishift = out
+
+    # Identifier of this design, to check in merge that the shards match
+    ident = _design_key(n, ispacing, ishift, fI, fC, r, r_def, reim, cvar,
+                        error, finish)
+    if ident is None:
+        ident = uuid.uuid4().hex
+
+    # Split the cells of the grid into nshards parts
+    ncells = _design_grid(ispacing, ishift)[0].size
+    nshards = max(1, min(nshards, ncells))
+    cells = np.array_split(np.arange(ncells), nshards)
+
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for i, icells in enumerate(cells):
+        spec = {'id': ident, 'shard': i, 'nshards': nshards, 'cells': icells,
+                'n': n, 'ispacing': ispacing, 'ishift': ishift, 'fI': fI,
+                'fC': fC, 'r': r, 'r_def': r_def, 'reim': reim, 'cvar': cvar,
+                'error': error, 'name': name, 'finish': finish,
+                'maxmem': maxmem, 'opt': opt}
+        fname = os.path.join(path, name+'.shard'+str(i)+'.pkl')
+        with open(fname, 'wb') as fspec:
+            pickle.dump(spec, fspec)
+        files.append(fname)
+        if verb > 0:
+            print('   Shard %d/%d: %s' % (i+1, nshards, fname))
+
+    return files
+
+
+def run_shard(spec, out=None, nbest=5, verb=1):
+    """Run a shard of a design, as created by ``shard``.
+
+    Parameters
+    ----------
+    spec : str
+        File name of the job specification of the shard.
+
+    out : str, optional
+        File name for the result; default is the one of spec with
+        ``.result.pkl`` instead of ``.pkl``.
+
+    nbest : int, optional
+        Number of best candidates (spacing, shift, value) of this shard which
+        are stored in the result; default is 5.
+
+    verb : {0, 1, 2}, optional
+        Level of verbosity, default is 1:
+            - 0: Print nothing.
+            - 1: Print the file name of the result.
+            - 2: Print additionally progress.
+
+    Returns
+    -------
+    out : str
+        File name of the result.
+
+    """
+    if out is None:
+        out = (spec[:-4] if spec.endswith('.pkl') else spec)+'.result.pkl'
+    with open(spec, 'rb') as fspec:
+        spec = pickle.load(fspec)
+    cells = spec['cells']
+
+    # Calculate rhs (of a copy, spec is stored with the result)
+    fC = dc(spec['fC'])
+    for i, f in enumerate(fC):
+        fC[i].rhs = _evaluate(f, 'rhs', spec['r'], ('r', spec['r']))
+
+    # Evaluate the cells of this shard
+    grid = _design_grid(spec['ispacing'], spec['ishift'])
+    spacing = grid[0].ravel()[cells]
+    shift = grid[1].ravel()[cells]
+    log = {'cnt1': -1, 'cnt2': -1, 'totnr': cells.size,
+           'time': default_timer(), 'warn-r': 0}
+    if spec.get('maxmem'):
+        log['maxmem'] = spec['maxmem']
+    args = (spec['n'], spec['fI'], fC, spec['r'], spec['r_def'],
+            spec['error'], spec['reim'], spec['cvar'], max(0, verb-1), 0, log)
+    ne_eval = _set_opt(spec.get('opt'), verb)
+    try:
+        values = np.array([_get_min_val((sp, sh), *args)
+                           for sp, sh in zip(spacing, shift)], dtype=float)
+    finally:
+        _set_opt(ne_eval)
+
+    # Best candidates of this shard
+    ibest = np.argsort(values, kind='stable')[:nbest]
+    best = np.c_[spacing[ibest], shift[ibest], values[ibest]]
+
+    result = {'id': spec['id'], 'shard': spec['shard'],
+              'nshards': spec['nshards'], 'cells': cells, 'values': values,
+              'best': best, 'spec': spec}
+    with open(out, 'wb') as fout:
+        pickle.dump(result, fout)
+    if verb > 0:
+        print('   Shard %d/%d finished: %s' % (spec['shard']+1,
+                                               spec['nshards'], out))
+
+    return out
+
+
+def merge(files, full_output=False, save=True, verb=2):
+    """Merge the results of the shards of a design, see ``shard``.
+
+    Parameters
+    ----------
+    files : list of str
+        File names of the results of all shards (from ``run_shard``).
+
+    full_output, save, verb :
+        As in ``design``.
+
+    Returns
+    -------
+    filter : empymod.filter.DigitalFilter instance
+        Best filter for the input parameters.
+
+    full : tuple
+        Output as returned by scipy.optimize.brute with full_output=True; the
+        same as the one of ``design``. (Returned when ``full_output`` is
+        True.)
+
+    """
+    t0 = printstartfinish(verb)
+
+    # Load results
+    results = []
+    for fname in files:
+        with open(fname, 'rb') as fres:
+            results.append(pickle.load(fres))
+    if not results:
+        print("* ERROR   :: <files> must contain at least one shard result.")
+        raise ValueError('files')
+    spec = results[0]['spec']
+
+    # Check that the shards belong together and are complete
+    shards = sorted(res['shard'] for res in results)
+    if (any(res['id'] != spec['id'] for res in results) or
+            shards != list(range(spec['nshards']))):
+        print("* ERROR   :: <files> must contain the results of all " +
+              str(spec['nshards']) + " shards of one design; provided " +
+              "shards: " + str(shards))
+        raise ValueError('files')
+
+    # Assemble the grid of values, as brute does
+    grid = _design_grid(spec['ispacing'], spec['ishift'])
+    Jout = np.empty(grid[0].size)
+    for res in results:
+        Jout[res['cells']] = res['values']
+    Jout = Jout.reshape(grid[0].shape)
+
+    # Best cell; polish it if finish
+    ne_eval = _set_opt(spec.get('opt'), verb)
+    try:
+        fI, fC, r = spec['fI'], spec['fC'], spec['r']
+        args = (spec['n'], fI, fC, r, spec['r_def'], spec['error'],
+                spec['reim'], spec['cvar'], 0, 0, {'warn-r': 1})
+        if callable(spec['finish']):
+            for i, f in enumerate(fC):
+                fC[i].rhs = _evaluate(f, 'rhs', r, ('r', r))
+        full = _brute_result(grid, Jout, spec['finish'], args)
+
+        # Get best filter
+        dlf = _calculate_filter(spec['n'], full[0][0], full[0][1], fI,
+                                spec['r_def'], spec['reim'], spec['name'],
+                                spec.get('maxmem'))
+    finally:
+        _set_opt(ne_eval)
+
+    # If verbose, print result
+    if verb > 1:
+        print_result(dlf, full, spec['cvar'])
+    printstartfinish(verb, t0)
+
+    # Save if desired
+    if save:
+        if full_output:
+            save_filter(spec['name'], dlf, full)
+        else:
+            save_filter(spec['name'], dlf)
+
+    # Output, depending on full_output
+    if full_output:
+        return dlf, full
+    else:
+        return dlf
+
+
+def main(args=None):
+    """Command-line interface of fdesign, ``empyscripts-fdesign``.
+
+    Runs designs headless (no plotting, no output to ``./filters``) from a job
+    file, and writes progress as JSON lines to stdout. Sub-commands:
+
+    - ``run JOB -o OUTPUT``: Run the design of the job file ``JOB``, on
+      ``workers`` processes. Writes the filter as ascii files (see
+      ``DigitalFilter.tofile``) and the brute-force grid (``full`` of
+      ``design``) as ``{name}_full.npz`` to the directory ``OUTPUT``.
+    - ``shard JOB -o PATH``: Split the job into shards (see ``shard``).
+    - ``run-shard SPEC``: Run one shard (see ``run_shard``).
+    - ``merge RESULT [RESULT ...] -o OUTPUT``: Merge the results of the shards
+      (see ``merge``) and write them as ``run`` does.
+    - ``benchmark JOB -o OUTPUT``: Compare filters for transform pairs (see
+      ``benchmark``); writes the table to the CSV file ``OUTPUT``. The job
+      file contains the input parameters of ``benchmark``: ``filters``
+      (names of filters in empymod.filters), ``pairs``, ``r``, ``error``,
+      ``sort``, ``workers``, and ``repeat``.
+
+    The job file is a JSON file with the input parameters of ``design``.
+    Transform pairs are given by the name of the registered transform pair
+    and its parameters (see ``get_pair``); r can be given as list of values or
+    as ``{"logspace": [start, stop, num]}``; reim is either "real" or "imag".
+    Additional keys are ``workers`` (number of processes for ``run``, default
+    1) and ``nshards`` (number of shards; default is four times the number of
+    workers for ``run`` and 2 for ``shard``). An example:
+
+    .. code-block:: json
+
+        {"n": 201, "spacing": [0.04, 0.1, 10], "shift": [-3, -1, 10],
+         "fI": [{"pair": "j0_1", "a": 5}, {"pair": "j1_1", "a": 5}],
+         "r": {"logspace": [0, 5, 1000]}, "error": 0.01, "cvar": "amp",
+         "name": "my_filter", "workers": 4}
+
+
+    Parameters
+    ----------
+    args : list of str, optional
+        Command-line arguments; default is sys.argv[1:].
+
+    """
+    parser = argparse.ArgumentParser(
+            prog='empyscripts-fdesign',
+            description='Headless digital linear filter design (fdesign).')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    prun = sub.add_parser('run', help='run the design of a job file')
+    prun.add_argument('job', help='job file (JSON)')
+    prun.add_argument('-o', '--output', default='.', help='output directory')
+    prun.add_argument('-w', '--workers', type=int,
+                      help='number of processes (overrides job file)')
+    pshard = sub.add_parser('shard', help='split a job into shards')
+    pshard.add_argument('job', help='job file (JSON)')
+    pshard.add_argument('-o', '--output', default='.',
+                        help='directory for the shards')
+    pshard.add_argument('-n', '--nshards', type=int,
+                        help='number of shards (overrides job file)')
+    prshard = sub.add_parser('run-shard', help='run one shard')
+    prshard.add_argument('spec', help='shard specification')
+    prshard.add_argument('-o', '--output', help='result file')
+    pmerge = sub.add_parser('merge', help='merge results of shards')
+    pmerge.add_argument('results', nargs='+', help='results of the shards')
+    pmerge.add_argument('-o', '--output', default='.',
+                        help='output directory')
+    pbench = sub.add_parser('benchmark', help='compare filters')
+    pbench.add_argument('job', help='job file (JSON)')
+    pbench.add_argument('-o', '--output', default='benchmark.csv',
+                        help='output file (CSV)')
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        inp = _read_job(args.job)
+        workers = inp.pop('workers', 1)
+        if args.workers is not None:
+            workers = args.workers
+        nshards = inp.pop('nshards', 4*workers)
+        _progress('start', job=args.job, workers=workers, nshards=nshards)
+
+        # Run the shards in a temporary directory
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = shard(nshards=nshards, path=tmpdir, verb=0, **inp)
+            with ProcessPoolExecutor(workers) as executor:
+                jobs = [executor.submit(run_shard, fname, verb=0)
+                        for fname in files]
+                results = []
+                for job in as_completed(jobs):
+                    results.append(job.result())
+                    _progress('shard', done=len(results), total=len(files))
+            _write_result(results, args.output)
+
+    elif args.command == 'shard':
+        inp = _read_job(args.job)
+        inp.pop('workers', None)
+        nshards = inp.pop('nshards', 2)
+        if args.nshards is not None:
+            nshards = args.nshards
+        files = shard(nshards=nshards, path=args.output, verb=0, **inp)
+        _progress('shards', files=files)
+
+    elif args.command == 'run-shard':
+        out = run_shard(args.spec, out=args.output, verb=0)
+        _progress('shard', result=out)
+
+    elif args.command == 'merge':
+        _write_result(args.results, args.output)
+
+    else:
+        keys = ['filters', 'pairs', 'r', 'error', 'sort', 'workers', 'repeat']
+        inp = _read_job(args.job, keys)
+        table = benchmark(output=args.output, verb=0, **inp)
+        _progress('finished', output=os.path.abspath(args.output),
+                  best=table[0] if table else None)
+
+
 # 2 PLOTTING ROUTINES (for QC or direct use)
 
 # # 2.a Public plotting routines for QC or direct use
@@ -561,6 +1644,96 @@ def plot_result(filt, full, cvar='amp', prntres=True):
     plt.show()
 
 
+def plot_qc(qc, cells=None, path=None, fmt='png', background=False):
+    """Plot recorded inversion results of single grid cells.
+
+    ``design`` with plot=3 records the inversion result of each grid cell
+    (spacing, shift) and transform pair in fC. This routine plots them after
+    the brute-force search, either with pyplot or, without display, to image
+    files.
+
+    Parameters
+    ----------
+    qc : dict or str
+        Recorded inversion results, or file name of them (``qc.pkl`` in
+        ``qcdir`` of ``design``).
+
+    cells : list of int, optional
+        Indices of the recorded inversion results to plot; default is all.
+
+    path : str, optional
+        If provided, the figures are rendered with the Agg backend to image
+        files ``{path}/inversion_{cell}_{name}.{fmt}`` (created if it does not
+        exist), instead of being shown with pyplot.
+
+    fmt : str, optional
+        Image format of the files; default is 'png'.
+
+    background : bool, optional
+        If True, the figures are rendered in a background process; only
+        relevant if path is provided. The figures are rendered in the
+        foreground if the process cannot be started (with start method
+        'spawn', if qc contains transform pairs which cannot be pickled).
+        Finished background processes are joined with the next call, and a
+        warning is printed if they failed. Default is False.
+
+    Returns
+    -------
+    out : list of str or multiprocessing.Process
+        File names of the images if path is provided (or the process
+        rendering them, if background is True); else None.
+
+    """
+    # Check matplotlib (soft dependency)
+    if not plt:
+        print(plt_msg)
+        return
+
+    if isinstance(qc, str):
+        with open(qc, 'rb') as fqc:
+            qc = pickle.load(fqc)
+    if cells is None:
+        cells = range(len(qc['cells']))
+
+    # Render in a background process; inline if it cannot be started, e.g.,
+    # because the transform pairs cannot be pickled (start method 'spawn')
+    if path and background:
+        _reap_qc()
+        proc = multiprocessing.Process(target=plot_qc,
+                                       args=(qc, cells, path, fmt))
+        try:
+            proc.start()
+        except (pickle.PicklingError, AttributeError, TypeError):
+            pass
+        else:
+            _qc_procs.append(proc)
+            return proc
+
+    files = []
+    r = qc['r']
+    for icell in cells:
+        cell = qc['cells'][icell]
+        f = qc['fC'][cell['i']]
+        k = cell['base']/r[:, None]
+        args = (f, cell['rhs'], r, k, cell['imin'], cell['spacing'],
+                cell['shift'], qc['cvar'])
+
+        if path:  # Render to file, without pyplot
+            os.makedirs(path, exist_ok=True)
+            fig = Figure(figsize=(9.5, 4))
+            FigureCanvasAgg(fig)
+            _draw_inversion(fig, *args)
+            fname = os.path.join(path, 'inversion_%05d_%s.%s' %
+                                 (icell, f.name, fmt))
+            fig.savefig(fname)
+            files.append(fname)
+        else:
+            _plot_inversion(*args)
+
+    if path:
+        return files
+
+
 def print_result(filt, full=None, cvar='amp'):
     """Print best filter information.
 
@@ -658,8 +1831,8 @@ def _plot_transform_pairs(fCI, r, k, tit):
             lhs = f.lhs(k)
             plt.loglog(k, np.abs(lhs[0]), lw=2, label='j0')
             plt.loglog(k, np.abs(lhs[1]), lw=2, label='j1')
-        else:
-            plt.loglog(k, np.abs(f.lhs(k)), lw=2, label=f.name)
+        else:  # Parameter sweeps yield one line per parameter (transposed)
+            plt.loglog(k, np.abs(f.lhs(k)).T, lw=2, label=f.name)
     if nr > 0:
         plt.xlabel('l')
     plt.legend(loc='best')
@@ -671,9 +1844,9 @@ def _plot_transform_pairs(fCI, r, k, tit):
     # Transform pair rhs
     for f in fCI:
         if tit == 'fC':
-            plt.loglog(r, np.abs(f.rhs), lw=2, label=f.name)
+            plt.loglog(r, np.abs(f.rhs).T, lw=2, label=f.name)
         else:
-            plt.loglog(r, np.abs(f.rhs(r)), lw=2, label=f.name)
+            plt.loglog(r, np.abs(f.rhs(r)).T, lw=2, label=f.name)
 
     # Transform with Key
     for f in fCI:
@@ -681,16 +1854,9 @@ def _plot_transform_pairs(fCI, r, k, tit):
             filt = j0j1filt()
         else:
             filt = sincosfilt()
-        kk = filt.base/r[:, None]
-        if f.name == 'j2':
-            lhs = f.lhs(kk)
-            kr0 = np.dot(lhs[0], getattr(filt, 'j0'))/r
-            kr1 = np.dot(lhs[1], getattr(filt, 'j1'))/r**2
-            kr = kr0+kr1
-        else:
-            kr = np.dot(f.lhs(kk), getattr(filt, f.name))/r
+        kr = apply_filter(filt, f, r)
 
-        plt.loglog(r, np.abs(kr), '-.', lw=2, label=filt.name)
+        plt.loglog(r, np.abs(kr).T, '-.', lw=2, label=filt.name)
 
     if nr > 0:
         plt.xlabel('r')
@@ -708,47 +1874,57 @@ def _plot_inversion(f, rhs, r, k, imin, spacing, shift, cvar):
         print(plt_msg)
         return
 
-    plt.figure("Inversion result "+f.name, figsize=(9.5, 4))
-    plt.subplots_adjust(wspace=.3, bottom=0.2)
+    fig = plt.figure("Inversion result "+f.name, figsize=(9.5, 4))
     plt.clf()
+    _draw_inversion(fig, f, rhs, r, k, imin, spacing, shift, cvar)
+    fig.canvas.draw()  # To force draw in notebook while running
+    plt.show()
+
+
+def _draw_inversion(fig, f, rhs, r, k, imin, spacing, shift, cvar):
+    """Draw inversion result of _plot_inversion into figure fig."""
+
+    fig.subplots_adjust(wspace=.3, bottom=0.2)
 
     tk = np.logspace(np.log10(k.min()), np.log10(k.max()), r.size)
 
-    plt.suptitle(f.name+'; Spacing ::'+str(spacing)+'; Shift ::'+str(shift))
+    fig.suptitle(f.name+'; Spacing ::'+str(spacing)+'; Shift ::'+str(shift))
 
     # Plot lhs
-    plt.subplot(121)
-    plt.title('|lhs|')
+    ax1 = fig.add_subplot(121)
+    ax1.set_title('|lhs|')
     if f.name == 'j2':
         lhs = f.lhs(tk)
-        plt.loglog(tk, np.abs(lhs[0]), lw=2, label='Theoretical J0')
-        plt.loglog(tk, np.abs(lhs[1]), lw=2, label='Theoretical J1')
-    else:
-        plt.loglog(tk, np.abs(f.lhs(tk)), lw=2, label='Theoretical')
-    plt.xlabel('l')
-    plt.legend(loc='best')
+        ax1.loglog(tk, np.abs(lhs[0]), lw=2, label='Theoretical J0')
+        ax1.loglog(tk, np.abs(lhs[1]), lw=2, label='Theoretical J1')
+    else:  # Parameter sweeps yield one line per parameter (transposed)
+        ax1.loglog(tk, np.abs(f.lhs(tk)).T, lw=2, label='Theoretical')
+    ax1.set_xlabel('l')
+    ax1.legend(loc='best')
 
     # Plot rhs
-    plt.subplot(122)
-    plt.title('|rhs|')
+    ax2 = fig.add_subplot(122)
+    ax2.set_title('|rhs|')
 
     # Transform pair rhs
-    plt.loglog(r, np.abs(f.rhs), lw=2, label='Theoretical')
+    ax2.loglog(r, np.abs(f.rhs).T, lw=2, label='Theoretical')
 
     # Transform with filter
-    plt.loglog(r, np.abs(rhs), '-.', lw=2, label='This filter')
+    ax2.loglog(r, np.abs(rhs).T, '-.', lw=2, label='This filter')
 
     # Plot minimum amplitude or max r, respectively
     if cvar == 'amp':
         label = 'Min. Amp'
     else:
         label = 'Max. r'
-    plt.loglog(r[imin], np.abs(rhs[imin]), 'go', label=label)
+    if np.ndim(rhs) > 1:  # Parameter sweep: imin for each parameter
+        prhs = rhs[np.arange(rhs.shape[0]), imin]
+    else:
+        prhs = rhs[imin]
+    ax2.loglog(r[imin], np.abs(prhs), 'go', label=label)
 
-    plt.xlabel('r')
-    plt.legend(loc='best')
-    plt.gcf().canvas.draw()  # To force draw in notebook while running
-    plt.show()
+    ax2.set_xlabel('r')
+    ax2.legend(loc='best')
 
 
 # 3. ANALYTICAL TRANSFORM PAIRS
@@ -758,276 +1934,445 @@ class Ghosh:
 
     Named after D. P. Ghosh, honouring his 1970 Ph.D. thesis with which he
     introduced the digital filter method to geophysics ([Ghosh_1970]_).
+
+    Transform pairs created by a registered constructor (see
+    ``register_pair``) additionally carry their pair type (``pair``) and
+    parameters (``params``). They are pickled by these, and they have a
+    hashable identity ``key`` (pair, frozen params), which is computed once
+    when the pair is created. It is None for non-registered pairs and for
+    pairs with parameters which cannot be identified, e.g., lambdas.
     """
     def __init__(self, name, lhs, rhs):
         """Add the filter name, lhs, and rhs."""
         self.name = name
         self.lhs = lhs
         self.rhs = rhs
+        self.pair = None
+        self.params = None
+        self.key = None
+
+    def __reduce_ex__(self, protocol):
+        """Pickle registered transform pairs by pair type and parameters."""
+        if self.pair is None:  # Default pickling for non-registered pairs
+            return super().__reduce_ex__(protocol)
+
+        # Keep all non-callable attributes, e.g. an already evaluated rhs
+        state = {k: v for k, v in self.__dict__.items() if not callable(v)}
+        return (_rebuild_pair, (_pairs[self.pair], self.params), state)
+
+
+# Registered transform-pair constructors, {pair: constructor}
+_pairs = {}
+
+
+def register_pair(func):
+    """Register a transform-pair constructor.
+
+    Decorator for module-level functions which return a ``Ghosh`` instance
+    (or a list of them, as ``empy_hankel`` does). The returned transform pairs
+    carry the name of the function as ``pair`` and the bound input arguments
+    as ``params``, which makes them picklable, hashable (``Ghosh.key``), and
+    reconstructible with ``get_pair``.
+
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def constructor(*args, **kwargs):
+        params = signature.bind(*args, **kwargs)
+        params.apply_defaults()
+        out = func(*args, **kwargs)
+        if isinstance(out, Ghosh):
+            out.pair = func.__name__
+            out.params = dict(params.arguments)
+            try:
+                out.key = (out.pair, _freeze(out.params))
+            except TypeError:  # E.g., a lambda as parameter: no identity
+                out.key = None
+        return out
+
+    _pairs[func.__name__] = constructor
+    return constructor
+
+
+def get_pair(pair, **params):
+    """Return registered transform pair ``pair`` for given parameters.
+
+    Parameters
+    ----------
+    pair : str
+        Name of a registered transform pair, e.g. 'j0_1' or 'empy_hankel'.
+
+    params : keyword arguments
+        Parameters passed to the transform-pair constructor.
+
+    Returns
+    -------
+    tp : Ghosh instance
+        Transform pair.
+
+    """
+    if pair not in _pairs:
+        print("* ERROR   :: <pair> must be a registered transform pair " +
+              "(one of " + str(sorted(_pairs)) + "); <pair> provided: " +
+              str(pair))
+        raise ValueError('pair')
+
+    return _pairs[pair](**params)
 
 
 # # 3.a Hankel J0 transform pairs
 
+@register_pair
 def j0_1(a=1):
     """Hankel transform pair J0_1 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return x*np.exp(-a*x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x*exp(-pa*x**2)")
+        return x*np.exp(-pa*x**2)
 
     def rhs(b):
-        return np.exp(-b**2/(4*a))/(2*a)
+        pa = _sweep_axis(a, b)
+        return np.exp(-b**2/(4*pa))/(2*pa)
 
     return Ghosh('j0', lhs, rhs)
 
 
+@register_pair
 def j0_2(a=1):
     """Hankel transform pair J0_2 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("exp(-pa*x)")
+        return np.exp(-pa*x)
 
     def rhs(b):
-        return 1/np.sqrt(b**2 + a**2)
+        pa = _sweep_axis(a, b)
+        return 1/np.sqrt(b**2 + pa**2)
 
     return Ghosh('j0', lhs, rhs)
 
 
+@register_pair
 def j0_3(a=1):
     """Hankel transform pair J0_3 ([Guptasarma_and_Singh_1997]_)."""
 
     def lhs(x):
-        return x*np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x*exp(-pa*x)")
+        return x*np.exp(-pa*x)
 
     def rhs(b):
-        return a/(b**2 + a**2)**1.5
+        pa = _sweep_axis(a, b)
+        return pa/(b**2 + pa**2)**1.5
 
     return Ghosh('j0', lhs, rhs)
 
 
+@register_pair
 def j0_4(f=1, rho=0.3, z=50):
     """Hankel transform pair J0_4 ([Chave_and_Cox_1982]_).
 
     Parameters
     ----------
-    f : float
+    f : float or array_like
         Frequency (Hz)
-    rho : float
+    rho : float or array_like
         Resistivity (Ohm.m)
-    z : float
+    z : float or array_like
         Vertical distance between source and receiver (m)
 
     """
 
+    f, rho, z = _sweep(f, rho, z)
     gam = np.sqrt(2j*np.pi*mu_0*f/rho)
 
     def lhs(x):
-        beta = np.sqrt(x**2 + gam**2)
-        return x*np.exp(-beta*np.abs(z))/beta
+        pgam, pz = _sweep_axis(gam, x), _sweep_axis(z, x)
+        if _use_ne_eval:
+            beta = _use_ne_eval("sqrt(x**2 + pgam**2)")  # NOQA
+            return _use_ne_eval("x*exp(-beta*abs(pz))/beta")
+        beta = np.sqrt(x**2 + pgam**2)
+        return x*np.exp(-beta*np.abs(pz))/beta
 
     def rhs(b):
-        R = np.sqrt(b**2 + z**2)
-        return np.exp(-gam*R)/R
+        pgam, pz = _sweep_axis(gam, b), _sweep_axis(z, b)
+        R = np.sqrt(b**2 + pz**2)
+        return np.exp(-pgam*R)/R
 
     return Ghosh('j0', lhs, rhs)
 
 
+@register_pair
 def j0_5(f=1, rho=0.3, z=50):
     """Hankel transform pair J0_5 ([Chave_and_Cox_1982]_).
 
     Parameters
     ----------
-    f : float
+    f : float or array_like
         Frequency (Hz)
-    rho : float
+    rho : float or array_like
         Resistivity (Ohm.m)
-    z : float
+    z : float or array_like
         Vertical distance between source and receiver (m)
 
     """
 
+    f, rho, z = _sweep(f, rho, z)
     gam = np.sqrt(2j*np.pi*mu_0*f/rho)
 
     def lhs(x):
-        beta = np.sqrt(x**2 + gam**2)
-        return x*np.exp(-beta*np.abs(z))
+        pgam, pz = _sweep_axis(gam, x), _sweep_axis(z, x)
+        if _use_ne_eval:
+            beta = _use_ne_eval("sqrt(x**2 + pgam**2)")  # NOQA
+            return _use_ne_eval("x*exp(-beta*abs(pz))")
+        beta = np.sqrt(x**2 + pgam**2)
+        return x*np.exp(-beta*np.abs(pz))
 
     def rhs(b):
-        R = np.sqrt(b**2 + z**2)
-        return np.abs(z)*(gam*R + 1)*np.exp(-gam*R)/R**3
+        pgam, pz = _sweep_axis(gam, b), _sweep_axis(z, b)
+        R = np.sqrt(b**2 + pz**2)
+        return np.abs(pz)*(pgam*R + 1)*np.exp(-pgam*R)/R**3
 
     return Ghosh('j0', lhs, rhs)
 
 
 # # 3.b Hankel J1 transform pairs
 
+@register_pair
 def j1_1(a=1):
     """Hankel transform pair J1_1 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return x**2*np.exp(-a*x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x**2*exp(-pa*x**2)")
+        return x**2*np.exp(-pa*x**2)
 
     def rhs(b):
-        return b/(4*a**2)*np.exp(-b**2/(4*a))
+        pa = _sweep_axis(a, b)
+        return b/(4*pa**2)*np.exp(-b**2/(4*pa))
 
     return Ghosh('j1', lhs, rhs)
 
 
+@register_pair
 def j1_2(a=1):
     """Hankel transform pair J1_2 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("exp(-pa*x)")
+        return np.exp(-pa*x)
 
     def rhs(b):
-        return (np.sqrt(b**2 + a**2) - a)/(b*np.sqrt(b**2 + a**2))
+        pa = _sweep_axis(a, b)
+        return (np.sqrt(b**2 + pa**2) - pa)/(b*np.sqrt(b**2 + pa**2))
 
     return Ghosh('j1', lhs, rhs)
 
 
+@register_pair
 def j1_3(a=1):
     """Hankel transform pair J1_3 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return x*np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x*exp(-pa*x)")
+        return x*np.exp(-pa*x)
 
     def rhs(b):
-        return b/(b**2 + a**2)**1.5
+        pa = _sweep_axis(a, b)
+        return b/(b**2 + pa**2)**1.5
 
     return Ghosh('j1', lhs, rhs)
 
 
+@register_pair
 def j1_4(f=1, rho=0.3, z=50):
     """Hankel transform pair J1_4 ([Chave_and_Cox_1982]_).
 
     Parameters
     ----------
-    f : float
+    f : float or array_like
         Frequency (Hz)
-    rho : float
+    rho : float or array_like
         Resistivity (Ohm.m)
-    z : float
+    z : float or array_like
         Vertical distance between source and receiver (m)
 
     """
 
+    f, rho, z = _sweep(f, rho, z)
     gam = np.sqrt(2j*np.pi*mu_0*f/rho)
 
     def lhs(x):
-        beta = np.sqrt(x**2 + gam**2)
-        return x**2*np.exp(-beta*np.abs(z))/beta
+        pgam, pz = _sweep_axis(gam, x), _sweep_axis(z, x)
+        if _use_ne_eval:
+            beta = _use_ne_eval("sqrt(x**2 + pgam**2)")  # NOQA
+            return _use_ne_eval("x**2*exp(-beta*abs(pz))/beta")
+        beta = np.sqrt(x**2 + pgam**2)
+        return x**2*np.exp(-beta*np.abs(pz))/beta
 
     def rhs(b):
-        R = np.sqrt(b**2 + z**2)
-        return b*(gam*R + 1)*np.exp(-gam*R)/R**3
+        pgam, pz = _sweep_axis(gam, b), _sweep_axis(z, b)
+        R = np.sqrt(b**2 + pz**2)
+        return b*(pgam*R + 1)*np.exp(-pgam*R)/R**3
 
     return Ghosh('j1', lhs, rhs)
 
 
+@register_pair
 def j1_5(f=1, rho=0.3, z=50):
     """Hankel transform pair J1_5 ([Chave_and_Cox_1982]_).
 
     Parameters
     ----------
-    f : float
+    f : float or array_like
         Frequency (Hz)
-    rho : float
+    rho : float or array_like
         Resistivity (Ohm.m)
-    z : float
+    z : float or array_like
         Vertical distance between source and receiver (m)
 
     """
 
+    f, rho, z = _sweep(f, rho, z)
     gam = np.sqrt(2j*np.pi*mu_0*f/rho)
 
     def lhs(x):
-        beta = np.sqrt(x**2 + gam**2)
-        return x**2*np.exp(-beta*np.abs(z))
+        pgam, pz = _sweep_axis(gam, x), _sweep_axis(z, x)
+        if _use_ne_eval:
+            beta = _use_ne_eval("sqrt(x**2 + pgam**2)")  # NOQA
+            return _use_ne_eval("x**2*exp(-beta*abs(pz))")
+        beta = np.sqrt(x**2 + pgam**2)
+        return x**2*np.exp(-beta*np.abs(pz))
 
     def rhs(b):
-        R = np.sqrt(b**2 + z**2)
-        return np.abs(z)*b*(gam**2*R**2 + 3*gam*R + 3)*np.exp(-gam*R)/R**5
+        pgam, pz = _sweep_axis(gam, b), _sweep_axis(z, b)
+        R = np.sqrt(b**2 + pz**2)
+        return (np.abs(pz)*b*(pgam**2*R**2 + 3*pgam*R + 3) *
+                np.exp(-pgam*R)/R**5)
 
     return Ghosh('j1', lhs, rhs)
 
 
 # # 3.c Fourier sine transform pairs
 
+@register_pair
 def sin_1(a=1):
     """Fourier sine transform pair sin_1 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return x*np.exp(-a**2*x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x*exp(-pa**2*x**2)")
+        return x*np.exp(-pa**2*x**2)
 
     def rhs(b):
-        return np.sqrt(np.pi)*b*np.exp(-b**2/(4*a**2))/(4*a**3)
+        pa = _sweep_axis(a, b)
+        return np.sqrt(np.pi)*b*np.exp(-b**2/(4*pa**2))/(4*pa**3)
 
     return Ghosh('sin', lhs, rhs)
 
 
+@register_pair
 def sin_2(a=1):
     """Fourier sine transform pair sin_2 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("exp(-pa*x)")
+        return np.exp(-pa*x)
 
     def rhs(b):
-        return b/(b**2 + a**2)
+        pa = _sweep_axis(a, b)
+        return b/(b**2 + pa**2)
 
     return Ghosh('sin', lhs, rhs)
 
 
+@register_pair
 def sin_3(a=1):
     """Fourier sine transform pair sin_3 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return x/(a**2 + x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("x/(pa**2 + x**2)")
+        return x/(pa**2 + x**2)
 
     def rhs(b):
-        return np.pi*np.exp(-a*b)/2
+        pa = _sweep_axis(a, b)
+        return np.pi*np.exp(-pa*b)/2
 
     return Ghosh('sin', lhs, rhs)
 
 
 # # 3.d Fourier cosine transform pairs
 
+@register_pair
 def cos_1(a=1):
     """Fourier cosine transform pair cos_1 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return np.exp(-a**2*x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("exp(-pa**2*x**2)")
+        return np.exp(-pa**2*x**2)
 
     def rhs(b):
-        return np.sqrt(np.pi)*np.exp(-b**2/(4*a**2))/(2*a)
+        pa = _sweep_axis(a, b)
+        return np.sqrt(np.pi)*np.exp(-b**2/(4*pa**2))/(2*pa)
 
     return Ghosh('cos', lhs, rhs)
 
 
+@register_pair
 def cos_2(a=1):
     """Fourier cosine transform pair cos_2 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return np.exp(-a*x)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("exp(-pa*x)")
+        return np.exp(-pa*x)
 
     def rhs(b):
-        return a/(b**2 + a**2)
+        pa = _sweep_axis(a, b)
+        return pa/(b**2 + pa**2)
 
     return Ghosh('cos', lhs, rhs)
 
 
+@register_pair
 def cos_3(a=1):
     """Fourier cosine transform pair cos_3 ([Anderson_1975]_)."""
 
     def lhs(x):
-        return 1/(a**2 + x**2)
+        pa = _sweep_axis(a, x)
+        if _use_ne_eval:
+            return _use_ne_eval("1/(pa**2 + x**2)")
+        return 1/(pa**2 + x**2)
 
     def rhs(b):
-        return np.pi*np.exp(-a*b)/(2*a)
+        pa = _sweep_axis(a, b)
+        return np.pi*np.exp(-pa*b)/(2*pa)
 
     return Ghosh('cos', lhs, rhs)
 
 
 # # 3.e Modeller
 
+@register_pair
 def empy_hankel(ftype, zsrc, zrec, res, freqtime, depth=[], aniso=None,
                 epermH=None, epermV=None, mpermH=None, mpermV=None,
                 htarg=None, verblhs=0, verbrhs=0):
@@ -1114,6 +2459,50 @@ def empy_hankel(ftype, zsrc, zrec, res, freqtime, depth=[], aniso=None,
     return Ghosh(ftype, lhs, rhs)
 
 
+# # 3.f Tabulated transform pairs
+
+@register_pair
+def tabulated(ftype, k, lhs, r, rhs, verb=1):
+    """Numerical transform pair from tabulated data.
+
+    Transform pair from sampled lhs- and rhs-values, e.g. stored responses of
+    an external forward modeller. The samples are interpolated with cubic
+    splines in log-log space, the coefficients of which are computed once.
+    Evaluation is therefore fully vectorized and comparable in speed to the
+    analytical transform pairs.
+
+    The spline is carried out through the logarithm of the data (amplitude
+    and unwrapped phase for complex data). Only for real data with sign changes
+    it is carried out on the data itself (always with logarithmic evaluation
+    points).
+
+    Parameters
+    ----------
+    ftype : str
+        Either of: {'j0', 'j1', 'sin', 'cos'}.
+
+    k, lhs : array
+        Left-hand side evaluation points (wavenumbers) and corresponding
+        values. Memory-mapped arrays (``np.load(..., mmap_mode='r')``) can be
+        used. lhs can have a leading parameter axis, in which case the
+        transform pair is a parameter sweep (see module documentation).
+
+    r, rhs : array
+        Right-hand side evaluation points and corresponding values; same rules
+        as for k, lhs.
+
+    verb : int
+        If verb > 0, a warning is printed the first time lhs or rhs are
+        evaluated outside of the tabulated range (extrapolation).
+
+    """
+
+    flhs = _LogSpline(k, lhs, 'lhs', verb)
+    frhs = _LogSpline(r, rhs, 'rhs', verb)
+
+    return Ghosh(ftype, flhs, frhs)
+
+
 # 4. NON-USER-FACING ROUTINES
 
 def _get_min_val(spaceshift, *params):
@@ -1123,83 +2512,231 @@ def _get_min_val(spaceshift, *params):
     spacing, shift = spaceshift
     n, fI, fC, r, r_def, error, reim, cvar, verb, plot, log = params
 
-    # Get filter for these parameters
-    dlf = _calculate_filter(n, spacing, shift, fI, r_def, reim, 'filt')
-
-    # Calculate rhs-response with this filter
-    k = dlf.base/r[:, None]
+    # Memory budget; measure peak memory of this cell if requested
+    maxmem = log['maxmem'] if 'maxmem' in log else None
+    if 'peakmem' in log:
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:  # Python < 3.9; clearing the traces resets the peak too
+            tracemalloc.clear_traces()
+        mem0 = tracemalloc.get_traced_memory()[0]
+
+    # Get filter for these parameters; reuse it if it was already calculated
+    # in a screening pass (see ``_screen_brute``)
+    filters = log['filters'] if 'filters' in log else {}
+    dlf = filters.get((spacing, shift))
+    if dlf is None:
+        dlf = _calculate_filter(n, spacing, shift, fI, r_def, reim, 'filt',
+                                maxmem)
+        if 'filters' in log:
+            filters[(spacing, shift)] = dlf
 
     # Loop over transforms
-    for i, f in enumerate(fC):
-        # Calculate lhs and rhs; rhs depends on ftype
-        lhs = f.lhs(k)
-        if f.name == 'j2':
-            rhs0 = np.dot(lhs[0], getattr(dlf, 'j0'))/r
-            rhs1 = np.dot(lhs[1], getattr(dlf, 'j1'))/r**2
-            rhs = rhs0 + rhs1
-        else:
-            rhs = np.dot(lhs, getattr(dlf, f.name))/r
-
-        # Get relative error
-        rel_error = np.abs((rhs - f.rhs)/f.rhs)
-
-        # Get indices where relative error is bigger than error
-        imin0 = np.where(rel_error > error)[0]
-
-        # Find first occurrence of failure
-        if np.all(rhs == 0) or np.all(np.isnan(rhs)):
-            # if all rhs are zeros or nans, the filter is useless
-            imin0 = 0
-
-        elif imin0.size == 0:
-            # if imin0.size == 0:  # empty array, all rel_error < error.
-            imin0 = rhs.size-1  # set to last r
-            if verb > 0 and log['warn-r'] == 0:
+    min_val = None
+    for f in fC:
+        # Calculate rhs-response with this filter, chunk by chunk of r
+        rhs = []
+        for sl in _rchunks(r.size, n, maxmem):
+            # Calculate lhs and rhs; rhs depends on ftype
+            rc = r[sl]
+            k = dlf.base/rc[:, None]
+            lhs = _evaluate(f, 'lhs', k, ('check', n, spacing, shift, rc))
+            if f.name == 'j2':
+                rhs0 = _dot_blocks(lhs[0], getattr(dlf, 'j0'))/rc
+                rhs1 = _dot_blocks(lhs[1], getattr(dlf, 'j1'))/rc**2
+                rhs.append(rhs0 + rhs1)
+            else:
+                rhs.append(_dot_blocks(lhs, getattr(dlf, f.name))/rc)
+            del k, lhs  # Free chunk before evaluating the next one
+        rhs = np.concatenate(rhs, axis=-1)
+
+        # Loop over parameters of a parameter sweep (leading axis); each
+        # parameter is checked as if it were an individual transform pair
+        imins = []
+        for prhs, pfrhs in zip(rhs.reshape(-1, r.size),
+                               np.reshape(f.rhs, (-1, r.size))):
+
+            # Get index of last r where the relative error is below error
+            imin0, all_good = _get_imin(prhs, pfrhs, error)
+            if all_good and verb > 0 and log['warn-r'] == 0:
                 print('* WARNING :: all data have error < ' + str(error) +
                       '; choose larger r or set error-level higher.')
                 log['warn-r'] = 1  # Only do this once
 
-        else:
-            # Kind of a dirty hack: Permit to jump up to four bad values,
-            # resulting for instance from high rel_error from zero crossings
-            # of the transform pair. Should be made an input argument or
-            # generally improved.
-            if imin0.size > 4:
-                imin0 = np.max([0, imin0[4]-5])
-            else:  # just take the first one (no jumping allowed; normal case)
-                imin0 = np.max([0, imin0[0]-1])
-            # Note that both version yield the same result if the failure is
-            # consistent.
-
-        # Depending on cvar, store minimum amplitude or 1/maxr
-        if cvar == 'amp':
-            min_val0 = np.abs(rhs[imin0])
-        else:
-            min_val0 = 1/r[imin0]
-
-        # Check if this inversion is better than previous ones
-        if i == 0:  # First run, store these values
-            imin = dc(imin0)
-            min_val = dc(min_val0)
-        else:  # Replace imin, min_val if this one is better
-            if min_val0 > min_val:
-                min_val = dc(min_val0)
+            # Depending on cvar, store minimum amplitude or 1/maxr
+            if cvar == 'amp':
+                min_val0 = np.abs(prhs[imin0])
+            else:
+                min_val0 = 1/r[imin0]
+
+            # Check if this inversion is better than previous ones
+            if min_val is None:  # First run, store these values
                 imin = dc(imin0)
+                min_val = dc(min_val0)
+            else:  # Replace imin, min_val if this one is better
+                if min_val0 > min_val:
+                    min_val = dc(min_val0)
+                    imin = dc(imin0)
+
+            imins.append(imin0)
 
-        # QC plot
+        # QC plot; recorded for later if a QC record is provided in log
         if plot > 2:
-            _plot_inversion(f, rhs, r, k, imin0, spacing, shift, cvar)
+            if rhs.ndim == 1:
+                imins = imins[0]
+            if 'qc' in log:
+                log['qc']['cells'].append(
+                        {'i': fC.index(f), 'spacing': spacing, 'shift': shift,
+                         'base': dlf.base, 'rhs': rhs, 'imin': imins})
+            else:
+                _plot_inversion(f, rhs, r, dlf.base/r[:, None], imins,
+                                spacing, shift, cvar)
+
+    # Record peak memory of this cell
+    if 'peakmem' in log:
+        log['peakmem'].append(tracemalloc.get_traced_memory()[1] - mem0)
 
     # If verbose, print progress
     if verb > 1:
         log = _print_count(log)
 
+    # Store index of min_val if requested (design_iter)
+    if 'imin' in log:
+        log['imin'] = imin
+
     # If there is no point with rel_error < error (imin=0) it returns np.inf.
     return np.where(imin == 0, np.inf, min_val)
 
 
-def _calculate_filter(n, spacing, shift, fI, r_def, reim, name):
-    """Calculate filter for this spacing, shift, n."""
+def _benchmark_filter(task):
+    """Return benchmark row of one filter and transform pair."""
+    filt, f, r, ref, error, repeat = task
+
+    # Time apply_filter; fastest of repeat runs
+    times = []
+    for _ in range(max(1, repeat)):
+        t0 = default_timer()
+        rhs = apply_filter(filt, f, r)
+        times.append(default_timer() - t0)
+    time = min(times)/r.size*1e6
+
+    # Accuracy
+    imin, _ = _get_imin(rhs, ref, error)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_error = np.abs((rhs - ref)/ref)
+        digits = np.clip(-np.log10(np.nanmedian(rel_error[:imin+1])), 0, 16)
+        cost = time/digits if digits > 0 else np.inf
+
+    return {'filter': filt.name, 'n': filt.base.size,
+            'pair': f.pair if f.pair else f.name, 'ftype': f.name,
+            'max_r': r[imin], 'min_amp': np.abs(rhs[imin]),
+            'digits': digits, 'time': time, 'cost': cost}
+
+
+def _screen_brute(screen, ispacing, ishift, args, finish):
+    """Two-stage brute force: screen cheaply, evaluate best cells exactly."""
+    n, fI, fC, r, r_def, error, reim, cvar, verb, plot, log = args
+    grid = _design_grid(ispacing, ishift)
+    cells = list(zip(grid[0].ravel(), grid[1].ravel()))
+
+    # 1. Screening: filters are calculated as in a full run, but checked on a
+    # subsampled r only. (Single precision is not an option: the resolved
+    # minimum amplitude saturates then at ~1e-7, which does not discriminate
+    # between good filters. Neither is a reduced r_def[2]: filters of a
+    # (nearly) square system are mostly unusable, and the values do not rank
+    # the cells as the final filters do.)
+    step = max(1, r.size//250)
+    fCs = []
+    for f in fC:
+        fs = copy(f)
+        fs.rhs = f.rhs[..., ::step]
+        fCs.append(fs)
+    filters = {}
+    slog = {'warn-r': 1, 'filters': filters}
+    if 'maxmem' in log:
+        slog['maxmem'] = log['maxmem']
+    sargs = (n, fI, fCs, r[::step], r_def, error, reim, cvar, 0, 0, slog)
+    values = np.array([_get_min_val(cell, *sargs) for cell in cells])
+
+    # Cells within the margin of the best screened value
+    survive = values <= screen*values.min()
+    if verb > 1:
+        print("   screening       : %d of %d cells within margin" %
+              (survive.sum(), survive.size))
+
+    # 2. Exact evaluation of the surviving cells, reusing their filters; the
+    # other cells are set to inf
+    log['totnr'] = int(survive.sum())
+    log['filters'] = filters
+    Jout = np.full(survive.size, np.inf)
+    try:
+        for i in np.where(survive)[0]:
+            Jout[i] = _get_min_val(cells[i], *args)
+    finally:  # Do not keep (or pickle) the filters with log
+        del log['filters']
+
+    return _brute_result(grid, Jout.reshape(grid[0].shape), finish, args)
+
+
+def _brute_result(grid, Jout, finish, args):
+    """Return full output as brute does, for values Jout on grid."""
+
+    # Best cell (first one for equal values)
+    indx = np.unravel_index(np.argmin(Jout), Jout.shape)
+    xmin = np.array([grid[0][indx], grid[1][indx]])
+    Jmin = Jout[indx]
+
+    # Polish it if finish
+    if callable(finish):
+        res = finish(_get_min_val, xmin, args=args, full_output=1, disp=False)
+        xmin, Jmin = res[0], res[1]
+
+    return xmin, Jmin, grid, Jout
+
+
+def _get_imin(rhs, ref, error):
+    """Return index of last r where rel. error of rhs to ref is below error.
+
+    Also returns True if the relative error is below error for all r.
+    """
+
+    # Get relative error
+    rel_error = np.abs((rhs - ref)/ref)
+
+    # Get indices where relative error is bigger than error
+    imin = np.where(rel_error > error)[0]
+
+    # Find first occurrence of failure
+    if np.all(rhs == 0) or np.all(np.isnan(rhs)):
+        # if all rhs are zeros or nans, the filter is useless
+        return 0, False
+
+    elif imin.size == 0:
+        # if imin.size == 0:  # empty array, all rel_error < error.
+        return rhs.size-1, True  # set to last r
+
+    else:
+        # Kind of a dirty hack: Permit to jump up to four bad values,
+        # resulting for instance from high rel_error from zero crossings of
+        # the transform pair. Should be made an input argument or generally
+        # improved.
+        if imin.size > 4:
+            imin = np.max([0, imin[4]-5])
+        else:  # just take the first one (no jumping allowed; normal)
+            imin = np.max([0, imin[0]-1])
+        # Note that both version yield the same result if the failure is
+        # consistent.
+        return imin, False
+
+
+def _calculate_filter(n, spacing, shift, fI, r_def, reim, name, maxmem=None):
+    """Calculate filter for this spacing, shift, n.
+
+    If a memory budget maxmem (MB) is given, the lhs are evaluated in chunks
+    of r (see ``_rchunks``), and the least-squares system is solved chunk by
+    chunk with an updated QR factorization. Without budget (one chunk) this
+    is a single QR factorization of the full system.
+    """
 
     # Base :: For this n/spacing/shift
     base = np.exp(spacing*(np.arange(n)-n//2) + shift)
@@ -1209,9 +2746,6 @@ def _calculate_filter(n, spacing, shift, fI, r_def, reim, name):
     r = np.logspace(np.log10(1/np.max(base)) - r_def[0],
                     np.log10(1/np.min(base)) + r_def[1], r_def[2]*n)
 
-    # k :: Get required k-values (matrix of shape (r.size, base.size))
-    k = base/r[:, None]
-
     # Create filter instance
     dlf = DigitalFilter(name)
     dlf.base = base
@@ -1219,17 +2753,36 @@ def _calculate_filter(n, spacing, shift, fI, r_def, reim, name):
 
     # Loop over transforms
     for f in fI:
-        # Calculate lhs and rhs for inversion
-        lhs = reim(f.lhs(k))
-        rhs = reim(f.rhs(r)*r)
+        xkey = ('filt', n, spacing, shift, r_def)
+        rhs = reim(_evaluate(f, 'rhs', r, xkey)*r)
 
         # Calculate filter values: Solve lhs*J=rhs using linalg.qr.
         # If factoring fails (qr) or if matrix is singular or square (solve) it
         # will raise a LinAlgError. Error is ignored and zeros are returned
         # instead.
         try:
-            qq, rr = np.linalg.qr(lhs)
-            J = np.linalg.solve(rr, rhs.dot(qq))
+            # lhs chunk by chunk of r, where
+            # k :: Required k-values (matrix of shape (rc.size, base.size));
+            # the QR is updated with each chunk (R and Q^T*rhs of the previous
+            # chunks stacked on the new one), so the full lhs is never built.
+            rr, qtrhs = None, None
+            for sl in _rchunks(r.size, n, maxmem):
+                xkey = ('filt', n, spacing, shift, r_def, sl.start, sl.stop)
+                lhs = reim(_evaluate(f, 'lhs', base/r[sl, None], xkey))
+                rhsc = rhs[..., sl]
+
+                # Parameter sweeps: all parameters enter the same inversion
+                if lhs.ndim > 2:
+                    lhs = lhs.reshape(-1, base.size)
+                    rhsc = rhsc.reshape(-1)
+
+                if rr is not None:
+                    lhs = np.concatenate([rr, lhs])
+                    rhsc = np.concatenate([qtrhs, rhsc])
+                qq, rr = np.linalg.qr(lhs)
+                qtrhs = rhsc.dot(qq)
+
+            J = np.linalg.solve(rr, qtrhs)
         except np.linalg.LinAlgError:
             J = np.zeros((base.size,))
 
@@ -1238,6 +2791,219 @@ def _calculate_filter(n, spacing, shift, fI, r_def, reim, name):
     return dlf
 
 
+def _set_opt(opt, verb=0):
+    """Set numexpr (opt='parallel') or numpy for the transform pairs.
+
+    ``opt`` can also be a previous setting; the previous setting is returned.
+    """
+    global _use_ne_eval
+    previous = _use_ne_eval
+    if opt == 'parallel':
+        if numexpr:
+            _use_ne_eval = numexpr.evaluate
+        else:
+            _use_ne_eval = False
+            if verb > 0:
+                print(numexpr_msg)
+    else:
+        _use_ne_eval = opt if callable(opt) else False
+    return previous
+
+
+# Evaluation of the transform pairs: numexpr.evaluate if set with _set_opt,
+# else False (numpy).
+_use_ne_eval = False
+
+
+def _rchunks(nr, n, maxmem):
+    """Return slices of r (size nr) to evaluate lhs within maxmem MB.
+
+    Without budget all r are evaluated at once. Otherwise chunks are sized
+    assuming ``_RBYTES`` bytes per evaluated lhs-value (result and temporary
+    arrays), rounded down to whole blocks of ``_RBLOCK`` r; see
+    ``_dot_blocks``.
+    """
+    if maxmem:
+        size = int(maxmem*2**20/(_RBYTES*n*_RBLOCK))*_RBLOCK
+        size = max(_RBLOCK, size)
+    else:
+        size = max(1, nr)
+    return [slice(i, min(i+size, nr)) for i in range(0, nr, size)]
+
+
+def _dot_blocks(lhs, values):
+    """Return np.dot(lhs, values), carried out in blocks of ``_RBLOCK`` r.
+
+    The result of a matrix-vector product from BLAS can depend in the last
+    digit on the number of rows. Computing it always in the same blocks makes
+    the result independent of the chunks of ``_rchunks``.
+    """
+    out = [np.dot(lhs[..., i:i+_RBLOCK, :], values)
+           for i in range(0, lhs.shape[-2], _RBLOCK)]
+    return np.concatenate(out, axis=-1)
+
+
+# Memory budget: chunks of r consist of blocks of _RBLOCK r.
+# - _RBLOCK is fixed (not derived from the budget or n), as the blocks of
+#   _dot_blocks have to be the same for all budgets to give identical
+#   results. 256 r are also the smallest chunk; for n=201, one block of
+#   complex128 lhs-values is 0.8 MB.
+# - _RBYTES is the peak memory per evaluated lhs-value (one r and one base
+#   point), including temporary arrays. Measured with tracemalloc (n=201,
+#   2000 r): analytical pairs need 16 bytes (the complex128 result), plus
+#   ~50 bytes per swept parameter; empy_hankel pairs ~430 bytes for a
+#   three-layer model, which are the most expensive pairs.
+_RBLOCK = 256
+_RBYTES = 512
+
+
+def _check_design_input(n, spacing, shift, fI, fC, r, reim, name, finish):
+    """Check input parameters of ``design`` and set defaults."""
+
+    # Ensure fI, fC are lists
+    def check_f(f):
+        if hasattr(f, 'name'):  # put into list if single tp
+            f = [f, ]
+        else:  # ensure list (works for lists, tuples, arrays)
+            f = list(f)
+        return f
+
+    if not fC:  # copy fI if fC not provided
+        fC = dc(fI)
+    fI = check_f(fI)
+    if fI[0].name == 'j2':
+        print("* ERROR   :: j2 (jointly j0 and j1) is only implemented for " +
+              "fC, not for fI!")
+        raise ValueError('j2')
+    fC = dc(check_f(fC))  # Copy, as the rhs of fC is replaced by its values
+
+    # Check default input values
+    if finish and not callable(finish):
+        from scipy.optimize import fmin_powell
+        finish = fmin_powell
+    if name is None:
+        name = 'dlf_'+str(n)
+    if r is None:
+        r = np.logspace(0, 5, 1000)
+    if reim not in [np.real, np.imag]:
+        reim = np.real
+
+    # Get spacing and shift slices, cast r
+    ispacing = _ls2ar(spacing, 'spacing')
+    ishift = _ls2ar(shift, 'shift')
+    r = np.atleast_1d(r)
+
+    return fI, fC, r, reim, name, finish, ispacing, ishift
+
+
+# Background processes rendering QC figures (see plot_qc)
+_qc_procs = []
+
+
+def _reap_qc(wait=False):
+    """Join finished (all, if wait) QC processes; warn if they failed."""
+    for proc in list(_qc_procs):
+        if wait or not proc.is_alive():
+            proc.join()
+            _qc_procs.remove(proc)
+            if proc.exitcode != 0:
+                print("* WARNING :: Rendering QC figures failed (exit code " +
+                      str(proc.exitcode) + ").")
+
+
+def _save_qc(qc, qcdir, verb):
+    """Store recorded inversion results of design in qcdir/qc.pkl."""
+    os.makedirs(qcdir, exist_ok=True)
+    fname = os.path.join(qcdir, 'qc.pkl')
+    try:
+        with open(fname, 'wb') as fqc:
+            pickle.dump(qc, fqc)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        os.remove(fname)
+        if verb > 0:
+            print("* WARNING :: QC data not stored, transform pairs cannot " +
+                  "be pickled; register them (see register_pair).")
+
+
+def _read_job(fname, keys=None):
+    """Read job file of the command-line interface; return input parameters.
+
+    keys are the permitted parameters; default are the ones of design.
+    """
+    with open(fname) as fjob:
+        job = json.load(fjob)
+
+    if keys is None:
+        keys = ['n', 'spacing', 'shift', 'fI', 'fC', 'r', 'r_def', 'reim',
+                'cvar', 'error', 'name', 'finish', 'maxmem', 'opt',
+                'workers', 'nshards']
+    unknown = set(job).difference(keys)
+    if unknown:
+        print("* ERROR   :: Unknown parameters in job file " + fname + ": " +
+              str(sorted(unknown)) + "; possible parameters: " + str(keys),
+              file=sys.stderr)
+        raise ValueError('job')
+
+    # Transform pairs, from {'pair': name, **params}
+    for key in ['fI', 'fC', 'pairs']:
+        if key in job:
+            pairs = job[key]
+            if isinstance(pairs, dict):
+                pairs = [pairs, ]
+            job[key] = [get_pair(**pair) for pair in pairs]
+
+    if isinstance(job.get('r'), dict):
+        job['r'] = np.logspace(*job['r']['logspace'])
+    if 'reim' in job:
+        job['reim'] = {'real': np.real, 'imag': np.imag}[job['reim']]
+
+    return job
+
+
+def _write_result(results, output):
+    """Merge results of shards; write filter and grid to output directory."""
+    dlf, full = merge(results, full_output=True, save=False, verb=0)
+
+    dlf.tofile(output)
+    fname = os.path.join(output, dlf.savename+'_full.npz')
+    np.savez(fname, x0=full[0], fval=full[1], grid=full[2], Jout=full[3])
+
+    _progress('finished', name=dlf.savename, output=os.path.abspath(output),
+              spacing=float(full[0][0]), shift=float(full[0][1]),
+              value=float(full[1]))
+
+
+def _progress(event, **kwargs):
+    """Print progress of the command-line interface as JSON line."""
+    info = dict(event=event)
+    info.update(kwargs)
+    print(json.dumps(info), flush=True)
+
+
+def _kgrid(base, r):
+    """Return k = base/r[:, None], from the cache if it was used recently."""
+    key = _freeze((base, r))
+    k = _kgrids.get(key)
+    if k is None:
+        k = base/np.atleast_1d(r)[:, None]
+        _kgrids.put(key, k)  # Grids bigger than the cache are not stored
+    return k
+
+
+def _lagged(values, n, nlag):
+    """Return view of values, where [..., j, :] contains values[..., j:j+n]."""
+    values = np.ascontiguousarray(values)
+    stride = values.strides[-1]
+    return np.lib.stride_tricks.as_strided(
+            values, values.shape[:-1] + (nlag, n),
+            values.strides[:-1] + (stride, stride), writeable=False)
+
+
+def _design_grid(ispacing, ishift):
+    """Return grid of spacing and shift values as used by brute."""
+    return np.mgrid[slice(*ispacing), slice(*ishift)]
+
+
 def _ls2ar(inp, strinp):
     """Convert float or linspace-input to arange/slice-input for brute."""
 
@@ -1300,3 +3066,198 @@ def _print_count(log):
         log['cnt1'] = cp
 
     return log
+
+
+def _iter_cell(cell, args):
+    """Calculate one cell of design_iter in a worker process."""
+    log = {'warn-r': 1, 'imin': None}  # Warning only in the main process
+    value = _get_min_val(cell, *args, log)
+    return cell[0], cell[1], float(value), int(log['imin'])
+
+
+def _job_keys(kwargs):
+    """Return set of the keys of the registered pairs of a design job."""
+    pairs = []
+    for name in ['fI', 'fC']:
+        value = kwargs.get(name)
+        if isinstance(value, Ghosh):
+            pairs.append(value)
+        elif isinstance(value, (list, tuple)):
+            pairs.extend(value)
+    return set(f.key for f in pairs
+               if isinstance(f, Ghosh) and f.key is not None)
+
+
+def _run_design(kwargs, cache_size):
+    """Run a design job of a DesignQueue in a worker process.
+
+    The first job of a worker process enables its evaluation cache, which is
+    kept for all following jobs of the same worker.
+    """
+    global _eval_cache
+    if _eval_cache is None and cache_size > 0:
+        _eval_cache = _EvalCache(cache_size*2**20)
+
+    inp = dict(verb=0, plot=0, save=False)
+    inp.update(kwargs)
+    return design(**inp)
+
+
+# Cache of lhs/rhs evaluations of registered pairs; None if disabled.
+_eval_cache = None
+
+
+def _evaluate(f, side, x, xkey):
+    """Evaluate ``f.lhs(x)`` or ``f.rhs(x)`` (side), using the cache.
+
+    The evaluation points x are identified by xkey, e.g. the parameters they
+    were created from. Only registered transform pairs are cached.
+    """
+    if _eval_cache is None or f.key is None:
+        return getattr(f, side)(x)
+
+    key = (f.key, side, _freeze(xkey))
+    out = _eval_cache.get(key)
+    if out is None:
+        out = getattr(f, side)(x)
+        _eval_cache.put(key, out)
+    return out
+
+
+class _EvalCache:
+    """Least-recently-used cache of evaluations, limited in bytes."""
+
+    def __init__(self, maxbytes):
+        """Initialize empty cache."""
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def get(self, key):
+        """Return cached value for key; None if it is not cached."""
+        if key not in self.data:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(key)
+        return self.data[key][0]
+
+    def put(self, key, value):
+        """Store value (array or tuple of arrays) under key."""
+
+        # Cached arrays are shared; make them read-only
+        arrays = value if isinstance(value, (list, tuple)) else [value, ]
+        for arr in arrays:
+            if isinstance(arr, np.ndarray):
+                arr.flags.writeable = False
+        nbytes = sum(np.asarray(arr).nbytes for arr in arrays)
+        if nbytes > self.maxbytes:
+            return
+
+        self.data[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+        # Remove least-recently-used entries if cache is too big
+        while self.nbytes > self.maxbytes:
+            _, (_, nb) = self.data.popitem(last=False)
+            self.nbytes -= nb
+
+
+# Cache of recent k-grids of apply_filter, limited to 64 MB.
+_kgrids = _EvalCache(64*2**20)
+
+
+def _rebuild_pair(constructor, params):
+    """Reconstruct a registered transform pair (used for pickling)."""
+    return constructor(**params)
+
+
+def _freeze(value):
+    """Return a hashable representation of transform-pair parameters."""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in sorted(value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, np.ndarray):  # Arrays are represented by a hash
+        data = np.ascontiguousarray(value).tobytes()
+        return (value.dtype.str, value.shape, hashlib.sha1(data).hexdigest())
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (types.FunctionType, types.BuiltinFunctionType,
+                            type)):
+        # Callables by their import path; lambdas and local functions have
+        # none, and would all be represented alike.
+        name = value.__qualname__
+        if '<' in name:
+            raise TypeError("cannot freeze callable " + name)
+        return ('callable', value.__module__, name)
+    elif hasattr(value, '__dict__'):  # E.g., a DigitalFilter instance
+        return (type(value).__name__, _freeze(vars(value)))
+    else:
+        return value
+
+
+def _sweep(*params):
+    """Broadcast parameters against each other if any of them is an array."""
+    if all(np.ndim(p) == 0 for p in params):
+        return params
+    return np.broadcast_arrays(*params)
+
+
+def _sweep_axis(param, x):
+    """Return parameter ready to broadcast with evaluation points ``x``.
+
+    Scalar parameters are returned unchanged. Parameter arrays get trailing
+    dimensions, so the parameter axis becomes the leading axis of the result.
+    """
+    if np.ndim(param) == 0:
+        return param
+    param = np.asarray(param)
+    return param.reshape(param.shape + (1, )*np.ndim(x))
+
+
+class _LogSpline:
+    """Cubic spline in log-log space of tabulated data, see ``tabulated``."""
+
+    def __init__(self, x, y, name, verb):
+        """Compute the spline coefficients."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y)
+
+        self.name = name
+        self.verb = verb
+        self.warned = False
+        self.xmin = x.min()
+        self.xmax = x.max()
+        self.iscomplex = np.iscomplexobj(y)
+
+        # Spline through log(y), except for real data with sign changes;
+        # zeroes (e.g., underflow of decaying data) are set to tiny.
+        self.logy = self.iscomplex or np.all(y >= 0) or np.all(y <= 0)
+        if self.logy:
+            amp = np.maximum(np.abs(y), np.finfo(float).tiny)
+            y = np.log(amp) + 1j*np.unwrap(np.angle(y), axis=-1)
+        from scipy.interpolate import CubicSpline
+        self.spline = CubicSpline(np.log(x), y, axis=-1)
+
+    def __call__(self, x):
+        """Evaluate the spline at x."""
+        x = np.asarray(x)
+
+        # Warn (once) if we extrapolate
+        if not self.warned and (x.min() < self.xmin or x.max() > self.xmax):
+            if self.verb > 0:
+                print("* WARNING :: Tabulated " + self.name + " is " +
+                      "extrapolated; tabulated range: [%g, %g]; " %
+                      (self.xmin, self.xmax) + "required range: " +
+                      "[%g, %g]." % (x.min(), x.max()))
+            self.warned = True
+
+        out = self.spline(np.log(x))
+        if self.logy:
+            out = np.exp(out)
+        if not self.iscomplex:
+            out = out.real
+        return out
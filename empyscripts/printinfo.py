@@ -18,7 +18,8 @@ Always shown are the OS, number of CPU(s), ``numpy``, ``scipy``, ``empymod``,
 
 Additionally shown are, if they can be imported, ``IPython``, ``matplotlib``,
 and ``numexpr``. If ``numexpr`` can be imported it shows additionally VML
-information.
+information. These optional modules are only imported when ``versions`` is
+called, not when this module is imported.
 
 All modules provided in ``add_pckg`` are also shown. They have to be imported
 before ``versions`` is called.
@@ -32,27 +33,13 @@ import numpy
 import scipy
 import textwrap
 import platform
+import importlib
 import multiprocessing
 
 # empymod
 import empymod
 import empyscripts
 
-# Optional modules
-try:
-    import IPython
-    from IPython.display import HTML, Pretty
-except ImportError:
-    IPython = False
-try:
-    import matplotlib
-except ImportError:
-    matplotlib = False
-try:
-    import numexpr
-except ImportError:
-    numexpr = False
-
 __all__ = ['versions', 'versions_html', 'versions_text']
 
 
@@ -111,9 +98,11 @@ def versions(mode='print', add_pckg=[], ncol=3):
         return versions_html(add_pckg, ncol)
     elif mode == 'plain':
         return versions_text(add_pckg)
-    elif mode == 'Pretty' and IPython:
+    elif mode == 'Pretty' and _optional('IPython'):
+        from IPython.display import Pretty
         return Pretty(versions_text(add_pckg))
-    elif mode == 'HTML' and IPython:
+    elif mode == 'HTML' and _optional('IPython'):
+        from IPython.display import HTML
         return HTML(versions_html(add_pckg, ncol))
     else:
         print(versions_text(add_pckg))
@@ -170,6 +159,7 @@ def versions_html(add_pckg=[], ncol=3):
     html = colspan(html, sys.version, ncol)
 
     # vml version
+    numexpr = _optional('numexpr')
     if numexpr:
         html = colspan(html, numexpr.get_vml_version(), ncol)
 
@@ -206,6 +196,7 @@ def versions_text(add_pckg=[]):
         text += '  '+txt+'\n'
 
     # vml version
+    numexpr = _optional('numexpr')
     if numexpr:
         text += '\n'
         for txt in textwrap.wrap(numexpr.get_vml_version(), n-4):
@@ -232,9 +223,18 @@ def _get_packages(add_pckg):
 
     # Create package-list
     pckgs = [numpy, scipy, empymod, empyscripts]   # Mandatory ones
-    for module in [IPython, numexpr, matplotlib]:  # Optional ones
+    for name in ['IPython', 'numexpr', 'matplotlib']:  # Optional ones
+        module = _optional(name)
         if module:
             pckgs += [module]
     pckgs += add_pckg  # Add the ones from the input
 
     return pckgs
+
+
+def _optional(name):
+    """Import optional module name; return False if it is not installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return False
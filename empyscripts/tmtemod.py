@@ -18,28 +18,26 @@ each other out in the total field. However, in order to obtain the correct TM
 and TE contributions one has to remove these non-physical parts.
 
 This is what this routine does, but only for an x-directed electric source with
-an x-directed electric receiver, and in the frequency domain (src and rec in
-same layer). This version of ``dipole`` returns the signal separated into TM++,
-TM+-, TM-+, TM--, TE++, TE+-, TE-+, and TE-- as well as the direct field TM and
-TE contributions. The first superscript denotes the direction in which the
-field diffuses towards the receiver and the second superscript denotes the
-direction in which the field diffuses away from the source. For both the
-plus-sign indicates the field diffuses in the downward direction and the
-minus-sign indicates the field diffuses in the upward direction. It uses
+an x-directed electric receiver (src and rec in same layer), in the frequency
+or in the time domain. This version of ``dipole`` returns the signal separated
+into TM++, TM+-, TM-+, TM--, TE++, TE+-, TE-+, and TE-- as well as the direct
+field TM and TE contributions. The first superscript denotes the direction in
+which the field diffuses towards the receiver and the second superscript
+denotes the direction in which the field diffuses away from the source. For
+both the plus-sign indicates the field diffuses in the downward direction and
+the minus-sign indicates the field diffuses in the upward direction. It uses
 ``empymod`` wherever possible. See the corresponding functions in ``empymod``
 for more explanation and documentation regarding input parameters. There are
 important limitations:
 
 - ``ab`` == 11                   [=> x-directed el. source & el. receivers]
-- ``signal`` == None             [=> only frequency domain]
 - ``xdirect`` == False           [=> direct field calc. in wavenr-domain]
 - ``ht`` == 'fht'
-- ``htarg`` == 'key_201_2012'
-- Options ``ft``, ``ftarg``, ``opt``, and ``loop`` are not available.
+- ``htarg``: the filter must contain J0- and J1-coefficients
+- Option ``loop`` is not available.
 - ``lsrc`` == ``lrec``           [=> src & rec are assumed in same layer!]
 - Model must have more than 1 layer
 - Electric permittivity and magnetic permeability are isotropic.
-- Only one frequency at once.
 
 This script is tested and works with ``empymod v1.4.4`` onwards.
 
@@ -324,17 +322,28 @@ can use
 # the License.
 
 import numpy as np
+from scipy.interpolate import CubicSpline
+from scipy.constants import mu_0, epsilon_0
+from scipy.interpolate import InterpolatedUnivariateSpline as iuSpline
 
+from empymod import utils, transform
 from empymod.filters import key_201_2012
 from empymod.kernel import reflections, angle_factor
 from empymod.utils import (check_model, check_frequency, check_dipole, _strvar,
-                           get_off_ang, get_layer_nr, printstartfinish)
+                           get_off_ang, get_layer_nr, printstartfinish,
+                           check_opt, check_time, conv_warning, check_hankel,
+                           _check_targ)
 
 __all__ = ['dipole']
 
+# Names of all modes, in the order in which they are returned by ``dipole``
+_MODES = ['TM--', 'TM-+', 'TM+-', 'TM++', 'TMdirect',
+          'TE--', 'TE-+', 'TE+-', 'TE++', 'TEdirect']
+
 
 def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
-           verb=2):
+           signal=None, htarg=None, ft='sin', ftarg=None, opt=None, modes=None,
+           jacobian=None, cache=None, verb=2):
     """Return the electromagnetic field due to a dipole source.
 
     This is a modified version of ``empymod.model.dipole()``. It returns the
@@ -360,9 +369,15 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
     res : array_like
         Horizontal resistivities rho_h (Ohm.m); #res = #depth + 1.
 
-    freqtime : float
-        Frequency f (Hz). (The name ``freqtime`` is kept for consistency with
-        ``empymod.model.dipole()``. Only one frequency at once.
+        The layer parameters ``res``, ``aniso``, ``eperm``, and ``mperm`` can
+        have a leading model axis, shape (nmodel, #res), to calculate many
+        models on the same geometry at once; the kernel is vectorized over
+        models and frequencies. Parameters without model axis are the same
+        for all models.
+
+    freqtime : array_like
+        Frequencies f (Hz) if ``signal`` == None, else times t (s); (f, t > 0).
+        All required frequencies are calculated at once, vectorized.
 
     aniso : array_like, optional
         Anisotropies lambda = sqrt(rho_v/rho_h) (-); #aniso = #res.
@@ -376,6 +391,95 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
         Relative magnetic permeabilities mu (-);
         #mperm = #res. Default is ones.
 
+    signal : {None, 0, 1, -1}, optional
+        Source signal, default is None:
+            - None: Frequency-domain response
+            - -1 : Switch-off time-domain response
+            - 0 : Impulse time-domain response
+            - +1 : Switch-on time-domain response
+
+    htarg : dict or list, optional
+        Hankel transform arguments for the Digital Linear Filter method:
+            - fhtfilt: string of filter name in ``empymod.filters`` or
+                       the filter method itself; it can also be a filter
+                       designed with ``fdesign`` (as returned by
+                       ``fdesign.design`` or ``fdesign.load_filter``). The
+                       filter must contain J0- and J1-coefficients.
+                       (default: ``empymod.filters.key_201_2012()``)
+            - pts_per_dec: points per decade; (default: 0)
+                - If 0: Standard DLF; the kernel is evaluated for the 201
+                  wavenumbers of each offset.
+                - If < 0: Lagged Convolution DLF; the kernel is evaluated
+                  once on a wavenumber grid shared by all offsets, and the
+                  result is interpolated to the offsets.
+                - If > 0: Splined DLF; the kernel is evaluated once on a
+                  shared wavenumber grid with pts_per_dec points per decade,
+                  and interpolated to the wavenumbers of each offset.
+        Lagged and splined DLF are much faster for many offsets; they are
+        carried out for all frequencies at once. Shorter filters (e.g.,
+        'key_101_2009' or 'key_51_2012') are cheaper, but less accurate.
+        Pass the args as a dict or a list in this order, e.g.,
+        ``{'pts_per_dec': -1}`` or ``['key_101_2009', -1]``.
+
+    ft : {'sin', 'cos', 'qwe', 'fftlog', 'fft'}, optional
+        Only used if ``signal`` != None. Flag to choose either the Digital
+        Linear Filter method (Sine- or Cosine-Filter), the
+        Quadrature-With-Extrapolation (QWE), the FFTLog, or the FFT for the
+        Fourier transform. Defaults to 'sin'. See ``empymod.model.dipole()``.
+
+        The Digital Linear Filter is applied to all ten modes at once; the
+        other methods transform them one after the other.
+
+    ftarg : dict or list, optional
+        Only used if ``signal`` != None. Depends on the value for ``ft``; see
+        ``empymod.model.dipole()`` for the options and their defaults.
+
+    opt : {None, 'parallel'}, optional
+        Optimization flag. Defaults to None:
+            - None: Normal case, no parallelization nor interpolation is used.
+            - If 'parallel', the package ``numexpr`` is used to evaluate the
+              most expensive statements of the kernel (``greenfct`` and
+              ``fields``). Always check if it actually improves performance
+              for a specific problem. It can speed up the calculation for big
+              arrays, but will most likely be slower for small arrays. It will
+              use all available cores for these specific statements, which all
+              contain ``Gamma`` in one way or another, which has dimensions
+              (#frequencies, #offsets, #layers, #lambdas), therefore can grow
+              pretty big. The module ``numexpr`` uses by default all available
+              cores up to a maximum of 8. You can change this behaviour to your
+              desired number of threads ``nthreads`` with
+              ``numexpr.set_num_threads(nthreads)``. If ``numexpr`` is not
+              installed, a warning is printed and numpy is used.
+
+    modes : str or list of str, optional
+        Modes to calculate, out of ['TM--', 'TM-+', 'TM+-', 'TM++',
+        'TMdirect', 'TE--', 'TE-+', 'TE+-', 'TE++', 'TEdirect']. Default is
+        None, which calculates all modes and returns them as TM, TE.
+        If provided, only the requested modes are calculated (reflections,
+        fields, and propagators not required by them are skipped), and
+        returned in the requested order.
+
+    jacobian : str or list of str, optional
+        Parameters for which the derivatives of the modes are returned too,
+        out of ['res', 'aniso']. Default is None (no derivatives).
+        The derivatives with respect to the parameter of each layer are
+        calculated analytically, in the same pass as the modes: through the
+        kernel (with a backward sweep through the reflection recursion), the
+        DLF, the non-physical corrections, and the Fourier transform. They
+        are always calculated with numpy.
+
+    cache : dict, optional
+        If a dict is provided, the wavenumber-domain Gam of each layer and the
+        reflection coefficients after each step of the reflection recursion
+        (TM and TE) are stored in it. In subsequent calls with the same dict
+        only the layers whose parameters changed are recomputed: Gam of these
+        layers, and the recursion from the first changed layer towards the
+        src-layer; the rest is reused. This speeds up, e.g., line searches in
+        an inversion, where only some layers change between calls. The
+        result is the same as without cache. Cached values are discarded if
+        the frequencies, offsets, Hankel filter, depths, or src-layer change.
+        The cache is not used if ``jacobian`` is provided.
+
     verb : {0, 1, 2, 3, 4}, optional
         Level of verbosity, default is 2:
             - 0: Print nothing.
@@ -387,18 +491,29 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
 
     Returns
     -------
-    TM, TE : list of ndarrays, (nfreq, nrec, nsrc)
-        Frequency-domain EM field [V/m], separated into
+    TM, TE : list of ndarrays, ([nmodel, ]nfreqtime, nrec, nsrc)
+        Frequency- or time-domain EM field (depending on ``signal``),
+        separated into
         TM = [TM--, TM-+, TM+-, TM++, TMdirect]
         and
         TE = [TE--, TE-+, TE+-, TE++, TEdirect].
 
+        If ``modes`` is provided, a list of ndarrays of the requested modes is
+        returned instead.
+
+        If ``jacobian`` is provided, the derivatives of the modes are returned
+        in the same structure after the modes, i.e., TM, TE, dTM, dTE, or EM,
+        dEM if ``modes`` is provided. Each derivative has shape ([#jacobian,]
+        nlayer, [nmodel, ]nfreqtime, nrec, nsrc); the leading axis is removed
+        if only one parameter is requested.
+
         However, source and receiver are normalised. So the source strength is
         1 A and its length is 1 m. Therefore the electric field could also be
         written as [V/(A.m2)].
 
-        The shape of EM is (nfreq, nrec, nsrc). However, single dimensions
-        are removed.
+        The shape of EM is (nfreqtime, nrec, nsrc), or (nmodel, nfreqtime,
+        nrec, nsrc) if the layer parameters have a model axis. However, single
+        dimensions are removed.
 
     """
 
@@ -406,14 +521,18 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
     t0 = printstartfinish(verb)
 
     # === 2. CHECK INPUT ============
-    # Check layer parameters
-    model = check_model(depth, res, aniso, eperm, eperm, mperm, mperm, False,
-                        verb)
-    depth, res, aniso, epermH, epermV, mpermH, mpermV, _ = model
-
-    # Check frequency => get etaH, etaV, zetaH, and zetaV
-    frequency = check_frequency(freqtime, res, aniso, epermH, epermV, mpermH,
-                                mpermV, verb)
+    # Check times and Fourier Transform arguments, get required frequencies
+    # (freq = freqtime if ``signal=None``)
+    if signal is not None:
+        time, freq, ft, ftarg = check_time(freqtime, signal, ft, ftarg, verb)
+    else:
+        freq = freqtime
+
+    # Check layer parameters and frequency => get etaH, etaV, zetaH, and zetaV
+    # (with a model axis of shape (nmodel*nfreq, nlayer), models are
+    # stacked along the frequency axis of the kernel)
+    depth, nmodel, frequency = _check_models(depth, res, aniso, eperm, mperm,
+                                             freq, verb)
     freq, etaH, etaV, zetaH, zetaV = frequency
 
     # Check src and rec
@@ -427,6 +546,34 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
     lsrc, zsrc = get_layer_nr(src, depth)
     lrec, zrec = get_layer_nr(rec, depth)
 
+    # Check Hankel transform parameters; default filter is key_201_2012
+    htarg = dict(_check_targ(htarg, ['fhtfilt', 'pts_per_dec']))
+    if htarg.get('fhtfilt', None) is None:
+        htarg['fhtfilt'] = key_201_2012()
+    _, (filt, pts_per_dec) = check_hankel('fht', htarg, verb)
+    if not hasattr(filt, 'j0') or not hasattr(filt, 'j1'):
+        print("* ERROR   :: <fhtfilt> must contain J0- and J1-coefficients; " +
+              "<fhtfilt> provided: "+filt.name)
+        raise ValueError('htarg')
+
+    # Check requested modes
+    imodes = _check_modes(modes)
+
+    # Check Jacobian; derivatives of etaH and etaV with respect to res and
+    # aniso, shape (parameter, nmodel*nfreq, nlayer). As etaH = 1/res + iwe
+    # and etaV = 1/(res*aniso^2) + iwe, they follow from their real parts.
+    jac = _check_jacobian(jacobian)
+    if jac:
+        ieH, ieV = etaH.real, etaV.real
+        deta = {'res': (-ieH*ieH, -ieH*ieV),
+                'aniso': (0*ieH, -2*ieV*np.sqrt(ieV/ieH))}
+        deta = np.array([deta[name] for name in jac], dtype=complex)
+        detaH, detaV = deta[:, 0], deta[:, 1]
+
+    # Check optimization (numexpr or not); loop is fixed, as all frequencies
+    # and offsets are always calculated at once
+    use_ne_eval, _, _ = check_opt(opt, None, 'fht', (filt, 0), verb)
+
     # Check limitations of this routine compared to the standard ``dipole``
     if lsrc != lrec:                           # src and rec in same layer
         print("* ERROR   :: src and rec must be in the same layer; " +
@@ -438,42 +585,53 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
               "<depth> provided: "+_strvar(depth[1:]))
         raise ValueError('depth')
 
-    if freq.size > 1:                          # only 1 frequency
-        print("* ERROR   :: only one frequency permitted; " +
-              "<freqtime> provided: "+_strvar(freqtime))
-        raise ValueError('frequency')
-
     # === 3. EM-FIELD CALCULATION ============
     # This part is a simplification of:
     # - model.fem()
     # - transform.dlf()
     # - kernel.wavenumber()
 
-    # DLF filter we use
-    filt = key_201_2012()
-
     # 3.1. COMPUTE REQUIRED LAMBDAS for given hankel-filter-base
-    lambd = filt.base/off[:, None]
+    # (shape (noff, nbase) for the standard DLF, else (1, nlambd)). The kernel
+    # and the Hankel transform do not depend on the angle, hence they are
+    # only calculated for the unique offsets.
+    uoff, uind = _unique_offsets(off)
+    lambd, _ = transform.get_spline_values(filt, uoff, pts_per_dec)
 
     # 3.2. CALL THE KERNEL
-    PTM, PTE = greenfct(zsrc, zrec, lsrc, lrec, depth, etaH, etaV, zetaH,
-                        zetaV, lambd)
+    # (the requested modes, by default TM and TE [uu, ud, du, dd, df], in one
+    # contiguous array of shape (nmodes, nmodel*nfreq, noff, nlambd))
+    # (derivatives: (nmodes, njac, nlayer, nmodel*nfreq, noff, nlambd))
+    PT = np.empty((len(imodes), etaH.shape[0]) + lambd.shape, dtype=complex)
+    if jac:
+        dPT = np.empty((len(imodes), len(jac), depth.size) + PT.shape[1:],
+                       dtype=complex)
+        greenfct(zsrc, zrec, lsrc, lrec, depth, etaH, etaV, zetaH, zetaV,
+                 lambd, use_ne_eval, PT, [_MODES[i] for i in imodes],
+                 (detaH, detaV), dPT)
+    else:
+        greenfct(zsrc, zrec, lsrc, lrec, depth, etaH, etaV, zetaH, zetaV,
+                 lambd, use_ne_eval, PT, [_MODES[i] for i in imodes],
+                 cache=cache)
 
     # 3.3. CARRY OUT THE HANKEL TRANSFORM WITH DLF
+    # (for all modes and the unique offsets at once; the angle factors are
+    # applied per offset afterwards, (factAng+1)/2 to TM and (factAng-1)/2 to
+    # TE for the J0-part)
+    J0, J1 = dlf(PT, lambd, uoff, filt, pts_per_dec)
+    del PT
     factAng = angle_factor(ang, 11, False, False)
-    zmfactAng = (factAng[:, np.newaxis]-1)/2
-    zpfactAng = (factAng[:, np.newaxis]+1)/2
+    pm = np.array([1 if i < 5 else -1 for i in imodes])
+    zpmfactAng = (factAng + pm[:, None, None])/2
     fact = 4*np.pi*off
 
-    # TE [uu, ud, du, dd, df]
-    for i, val in enumerate(PTE):
-        PTE[i] = (factAng*np.dot(-val, filt.j1)/off +
-                  np.dot(zmfactAng*val*lambd, filt.j0))/fact
+    EM = list((factAng*J1[..., uind] + zpmfactAng*J0[..., uind])/(4*np.pi))
 
-    # TM [uu, ud, du, dd, df]
-    for i, val in enumerate(PTM):
-        PTM[i] = (factAng*np.dot(-val, filt.j1)/off +
-                  np.dot(zpfactAng*val*lambd, filt.j0))/fact
+    if jac:  # Same for the derivatives, (nmodes, njac, nlayer, nfreq, noff)
+        J0, J1 = dlf(dPT, lambd, uoff, filt, pts_per_dec)
+        del dPT
+        dEM = factAng*J1[..., uind] + zpmfactAng[:, None, None]*J0[..., uind]
+        dEM /= 4*np.pi
 
     # 3.4. Remove non-physical contributions
 
@@ -481,18 +639,38 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
     # the accompanying pdf, due to the way the direct field is accounted for
     # in the book.)
 
-    # General parameters
+    # General parameters; frequency-dependent ones have shape (nfreq, 1),
+    # to broadcast with the offsets
     Gam = np.sqrt((zetaH*etaH)[:, None, :, None])  # Gam for lambd=0
     iGam = Gam[:, :, lsrc, 0]
-    lgam = np.sqrt(zetaH[:, lsrc]*etaH[:, lsrc])
+    lgam = np.sqrt(zetaH[:, lsrc]*etaH[:, lsrc])[:, None]
     ddepth = np.r_[depth, np.inf]
     ds = ddepth[lsrc+1] - ddepth[lsrc]
 
+    # Derivatives of Gam (lambd=0) and e_zH (TM) of each layer, and of lgam,
+    # shape (njac, nlayer, nfreq, 1)
+    if jac:
+        dGam = (zetaH*detaH/(2*Gam[:, 0, :, 0])).transpose(0, 2, 1)[..., None]
+        dlgam = np.zeros_like(dGam)
+        dlgam[:, lsrc] = dGam[:, lsrc]
+
     def get_rp_rm(z_eta):
-        """Return Rp, Rm, Ms."""
+        """Return Rp, Rm, Ms, npfct, and their derivatives if ``jac``."""
 
         # Get Rp/Rm for lambd=0
-        Rp, Rm = reflections(depth, z_eta, Gam, lrec, lsrc, False)
+        if jac:
+            Rp, Rm, dRp, dRm = reflections_deriv(depth, z_eta, Gam, lrec,
+                                                 lsrc)
+
+            # Chain rule, to shape (njac, nlayer, nfreq, 1)
+            de = detaH if z_eta is etaH else np.zeros_like(detaH)
+            de = de.transpose(0, 2, 1)[..., None]
+            dRp = dRp[0][:, 0, :, 0].T[:, :, None]*dGam + \
+                dRp[1][:, 0, :, 0].T[:, :, None]*de
+            dRm = dRm[0][:, 0, :, 0].T[:, :, None]*dGam + \
+                dRm[1][:, 0, :, 0].T[:, :, None]*de
+        else:
+            Rp, Rm = reflections(depth, z_eta, Gam, lrec, lsrc, False)
 
         # Depending on model Rp/Rm have 3 or 4 dimensions. Last two are
         # wavenumbers and layers btw src and rec, which both are 1.
@@ -505,105 +683,363 @@ def dipole(src, rec, depth, res, freqtime, aniso=None, eperm=None, mperm=None,
 
         # Calculate reverberation M and general factor npfct
         Ms = 1 - Rp*Rm*np.exp(-2*iGam*ds)
-        npfct = factAng*zetaH[:, lsrc]/(fact*off*lgam*Ms)
-
-        return Rp, Rm, Ms, npfct
-
-    # TE modes TE[uu, ud, du, dd]
-    Rp, Rm, Ms, npfct = get_rp_rm(zetaH)
-
-    PTE[0] += npfct*Rp*Rm*np.exp(-lgam*(2*ds - zrec + zsrc))
-    PTE[1] += npfct*Rp*np.exp(-lgam*(2*ddepth[lrec+1] - zrec - zsrc))
-    PTE[2] += npfct*Rm*np.exp(-lgam*(zrec + zsrc))
-    PTE[3] += npfct*Rp*Rm*np.exp(-lgam*(2*ds + zrec - zsrc))
-
-    # TM modes TM[uu, ud, du, dd]
-    Rp, Rm, Ms, npfct = get_rp_rm(etaH)
-
-    PTM[0] -= npfct*Rp*Rm*np.exp(-lgam*(2*ds - zrec + zsrc))
-    PTM[1] += npfct*Rp*np.exp(-lgam*(2*ddepth[lrec+1] - zrec - zsrc))
-    PTM[2] += npfct*Rm*np.exp(-lgam*(zrec + zsrc))
-    PTM[3] -= npfct*Rp*Rm*np.exp(-lgam*(2*ds + zrec - zsrc))
-
-    # 3.5 Reshape for number of sources
-    for i, val in enumerate(PTE):
-        PTE[i] = np.squeeze(val.reshape((-1, nrec, nsrc), order='F'))
+        npfct = factAng*zetaH[:, lsrc, None]/(fact*off*lgam*Ms)
+
+        if not jac:
+            return Rp, Rm, Ms, npfct, None
+
+        # Derivatives of Ms and npfct (exponent is zero if ds is infinite)
+        e2 = np.exp(-2*iGam*ds)
+        dMs = -(dRp*Rm + Rp*dRm)*e2
+        if np.isfinite(ds):
+            dMs += Rp*Rm*2*ds*e2*dlgam
+        dnpfct = -npfct*(dlgam/lgam + dMs/Ms)
+
+        return Rp, Rm, Ms, npfct, (dRp, dRm, dnpfct)
+
+    # Corrections of [uu, ud, du, dd]: (reflection coefficients, exponent)
+    corr = [(['Rp', 'Rm'], 2*ds - zrec + zsrc),
+            (['Rp'], 2*ddepth[lrec+1] - zrec - zsrc),
+            (['Rm'], zrec + zsrc),
+            (['Rp', 'Rm'], 2*ds + zrec - zsrc)]
+
+    # TM and TE modes *[uu, ud, du, dd]; only the requested ones
+    for first, z_eta in [(0, etaH), (5, zetaH)]:
+        req = [(imodes.index(first+k), k) for k in range(4)
+               if first+k in imodes]
+        if not req:
+            continue
 
-    for i, val in enumerate(PTM):
-        PTM[i] = np.squeeze(val.reshape((-1, nrec, nsrc), order='F'))
+        Rp, Rm, Ms, npfct, deriv = get_rp_rm(z_eta)
+        R = {'Rp': Rp, 'Rm': Rm}
+
+        for i, k in req:
+            Rs, dz = corr[k]
+            val = npfct*np.prod([R[r] for r in Rs], 0)*np.exp(-lgam*dz)
+            sign = -1 if first == 0 and len(Rs) == 2 else 1
+            EM[i] += sign*val  # TMuu and TMdd are subtracted
+
+            # Derivative of the correction (product rule)
+            if jac:
+                dR = {'Rp': deriv[0], 'Rm': deriv[1]}
+                dval = deriv[2]*np.prod([R[r] for r in Rs], 0)
+                for r in Rs:
+                    dval += npfct*dR[r]*np.prod(
+                            [R[q] for q in Rs if q != r], 0)
+                dval *= np.exp(-lgam*dz)
+                if np.isfinite(dz):
+                    dval -= val*dz*dlgam
+                dEM[i] += sign*dval
+
+    # Derivatives are transformed and reshaped as additional modes
+    nmodes = len(EM)
+    if jac:
+        EM += list(dEM.reshape((-1, ) + dEM.shape[-2:]))
+        del dEM
+
+    # 3.5 Do f->t transform if required; all modes and models at once
+    if signal is not None:
+        shape = (len(EM), nmodel or 1, freq.size, -1)
+        EM = np.array(EM).reshape(shape).transpose(2, 0, 1, 3)
+        EM, conv = tem(EM.reshape(freq.size, -1), freq, time, signal, ft,
+                       ftarg)
+        EM = EM.reshape((time.size, ) + shape[:2] + (-1, ))
+        EM = list(EM.transpose(1, 2, 0, 3).reshape(shape[0], -1, off.size))
+
+        # In case of QWE/QUAD, print Warning if not converged
+        conv_warning(conv, ftarg, 'Fourier', verb)
+
+    # 3.6 Reshape for number of models and sources
+    for i, val in enumerate(EM):
+        val = val.reshape((nmodel or 1, -1, nsrc, nrec)).swapaxes(2, 3)
+        EM[i] = np.squeeze(val)
+
+    # Split modes and derivatives
+    if jac:
+        dEM = np.array(EM[nmodes:])
+        dEM = dEM.reshape((nmodes, len(jac), depth.size) + dEM.shape[1:])
+        EM = EM[:nmodes]
+        EM += [val[0] if len(jac) == 1 else val for val in dEM]
 
     # === 4. FINISHED ============
     printstartfinish(verb, t0)
 
-    # return [TMuu, TMud, TMdu, TMdd, TMdf], [TEuu, TEud, TEdu, TEdd, TEdf]
-    return PTM, PTE
+    if modes is None and jac:
+        # return TM, TE, dTM, dTE
+        return EM[:5], EM[5:10], EM[10:15], EM[15:]
+    elif jac:
+        # return the requested modes and their derivatives
+        return EM[:nmodes], EM[nmodes:]
+    elif modes is None:
+        # return [TMuu, TMud, TMdu, TMdd, TMdf], [TEuu, TEud, TEdu, TEdd, TEdf]
+        return EM[:5], EM[5:]
+    else:
+        # return the requested modes
+        return EM
 
 
-def greenfct(zsrc, zrec, lsrc, lrec, depth, etaH, etaV, zetaH, zetaV, lambd):
+def greenfct(zsrc, zrec, lsrc, lrec, depth, etaH, etaV, zetaH, zetaV, lambd,
+             use_ne_eval=False, out=None, modes=None, deta=None, dout=None,
+             cache=None):
     """Calculate Green's function for TM and TE.
 
     This is a modified version of empymod.kernel.greenfct(). See the original
     version for more information.
 
+    If ``use_ne_eval`` is ``numexpr.evaluate`` (see ``opt`` in ``dipole``),
+    the expensive statements are evaluated with ``numexpr``.
+
+    All modes are stored in one contiguous array ``out``, which is created if
+    not provided. By default, ``out`` has shape (2, 5, frequency, offset,
+    lambda), and returned are the views PTM = out[0] and PTE = out[1].
+
+    If ``modes`` is given (see ``dipole``), only these modes are calculated;
+    ``out`` has then shape (#modes, frequency, offset, lambda) and is returned.
+    Reflection coefficients, fields, and propagators which are not required by
+    these modes are not calculated.
+
+    If ``deta`` = (detaH, detaV) is provided, the derivatives of the modes
+    with respect to parameters of each layer are calculated too, and stored
+    in ``dout``, of shape (mode, parameter, layer, frequency, offset, lambda).
+    detaH and detaV, of shape (parameter, frequency, layer), are the
+    derivatives of etaH and etaV of each layer with respect to its own
+    parameters (e.g., resistivity). The derivatives are always calculated
+    with numpy.
+
+    If ``cache`` is a dict (see ``dipole``), Gam and the reflection recursion
+    are only recomputed for the layers which changed since the last call with
+    this dict. It is not used if ``deta`` is provided.
+
     """
     # GTM/GTE have shape (frequency, offset, lambda).
     # gamTM/gamTE have shape (frequency, offset, layer, lambda):
 
+    # Requested modes as indices into _MODES
+    imodes = _check_modes(modes)
+    if out is None:
+        shape = (2, 5) if modes is None else (len(imodes), )
+        out = np.empty(shape + (etaH.shape[0], ) + lambd.shape, dtype=complex)
+    PT = out.reshape((-1, ) + out.shape[-3:])  # View of shape (mode, ...)
+    if deta is not None:
+        detaH, detaV = deta
+        if dout is None:
+            dout = np.empty((len(imodes), detaH.shape[0], depth.size) +
+                            PT.shape[1:], dtype=complex)
+        dPT = dout.reshape((-1, ) + dout.shape[-5:])
+
     for TM in [True, False]:
 
+        # Requested modes of TM or TE, {name: index in PT}
+        first = 0 if TM else 5
+        req = {name: imodes.index(first+i) for i, name in
+               enumerate(['uu', 'ud', 'du', 'dd', 'df']) if first+i in imodes}
+        if not req:
+            continue
+
         # Define eta/zeta depending if TM or TE
         if TM:
             e_zH, e_zV, z_eH = etaH, etaV, zetaH   # TM: zetaV not used
         else:
             e_zH, e_zV, z_eH = zetaH, zetaV, etaH  # TE: etaV not used
 
+        # Cached Gam and reflections, and layers which changed since
+        if cache is not None and deta is None:
+            entry, changed = _get_cache(cache, 'TM' if TM else 'TE',
+                                        (lambd, depth, lsrc),
+                                        (etaH, etaV, zetaH, zetaV))
+        else:
+            entry, changed = None, None
+
         # Uppercase gamma
-        Gam = np.sqrt((e_zH/e_zV)[:, None, :, None] *
-                      (lambd*lambd)[None, :, None, :] +
-                      (z_eH*e_zH)[:, None, :, None])
+        if changed is not None:  # Only for the changed layers
+            Gam = entry['Gam']
+            ilay = np.nonzero(changed)[0]
+            tmp = (e_zH/e_zV)[:, None, ilay, None] * \
+                (lambd*lambd)[None, :, None, :]
+            tmp += (z_eH*e_zH)[:, None, ilay, None]
+            Gam[:, :, ilay, :] = np.sqrt(tmp)
+            del tmp
+        elif use_ne_eval:
+            ez_ratio = (e_zH/e_zV)[:, None, :, None]  # NOQA
+            ez_prod = (z_eH*e_zH)[:, None, :, None]  # NOQA
+            lambd2 = use_ne_eval("lambd*lambd")[None, :, None, :]  # NOQA
+            Gam = use_ne_eval("sqrt(ez_ratio*lambd2 + ez_prod)")
+        else:  # (in-place, to avoid temporary arrays of the size of Gam)
+            Gam = (e_zH/e_zV)[:, None, :, None]*(lambd*lambd)[None, :, None, :]
+            Gam += (z_eH*e_zH)[:, None, :, None]
+            np.sqrt(Gam, out=Gam)
+        if entry is not None:
+            entry['Gam'] = Gam
 
         # Gamma in receiver layer
         lrecGam = Gam[:, :, lrec, :]
 
-        # Reflection (coming from below (Rp) and above (Rm) rec)
-        Rp, Rm = reflections(depth, e_zH, Gam, lrec, lsrc, False)
+        # Derivatives of Gam and e_zH of each layer with respect to its own
+        # parameters, shape (parameter, frequency, offset, layer, lambda);
+        # dgam and de are zero except in the src/rec layer
+        if deta is not None:
+            if TM:
+                dratio = detaH/etaV - etaH*detaV/etaV**2
+            else:
+                dratio = np.zeros_like(detaH)
+            dGam = dratio[:, :, None, :, None]*(lambd*lambd)[:, None, :]
+            dGam += (zetaH*detaH)[:, :, None, :, None]
+            dGam /= 2*Gam
+            dgam = np.zeros_like(dGam)
+            dgam[..., lrec, :] = dGam[..., lrec, :]
+            de = np.zeros(dGam.shape[:2] + (1, depth.size, 1), dtype=complex)
+            if TM:
+                de[..., 0] = detaH[:, :, None, :]
+
+        # Reflected fields; not required for the direct field
+        which = [name for name in req if name != 'df']
+        if which and deta is not None:
+
+            # Reflection and their derivatives
+            Rp, Rm, dRp, dRm = reflections_deriv(depth, e_zH, Gam, lrec, lsrc)
+            dRp = dRp[0]*dGam + dRp[1]*de
+            dRm = dRm[0]*dGam + dRm[1]*de
+
+            # Fields at rec level and their derivatives
+            P = fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM, False, which,
+                       (dRp, dRm, dgam))
+            dP = dict(zip(['uu', 'ud', 'du', 'dd'], P[4:]))
+            P = dict(zip(['uu', 'ud', 'du', 'dd'], P[:4]))
+            del Rp, Rm, dRp, dRm
+
+        elif which:
+
+            # Reflection (coming from below (Rp) and above (Rm) rec)
+            if entry is not None:
+                Rp, Rm = reflections_cache(depth, e_zH, Gam, lrec, lsrc,
+                                           use_ne_eval, entry, changed)
+            else:
+                Rp, Rm = reflections(depth, e_zH, Gam, lrec, lsrc,
+                                     use_ne_eval)
+
+            # Field at rec level (coming from below (Pu) and above (Pd) rec)
+            P = dict(zip(['uu', 'ud', 'du', 'dd'],
+                         fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM,
+                                use_ne_eval, which)))
+            del Rp, Rm
 
         # Field propagators
         # (Up- (Wu) and downgoing (Wd), in rec layer); Eq 74
-        if lrec != depth.size-1:  # No upgoing field prop. if rec in last
-            ddepth = depth[lrec + 1] - zrec
-            Wu = np.exp(-lrecGam*ddepth)
-        else:
-            Wu = np.full_like(lrecGam, 0+0j)
-        if lrec != 0:     # No downgoing field propagator if rec in first
-            ddepth = zrec - depth[lrec]
-            Wd = np.exp(-lrecGam*ddepth)
-        else:
-            Wd = np.full_like(lrecGam, 0+0j)
-
-        # Field at rec level (coming from below (Pu) and above (Pd) rec)
-        Puu, Pud, Pdu, Pdd = fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM)
-
-        # Store in corresponding variable PT* = [T*uu, T*ud, T*du, T*dd]
-        df = np.exp(-lrecGam*abs(zsrc - zrec))  # direct field
-        fTM = Gam[:, :, lrec, :]/etaH[:, None, lrec, None]
-        fTE = zetaH[:, None, lsrc, None]/Gam[:, :, lsrc, :]
+        # (Wdepth: depths of the propagators, for their derivatives)
+        W, Wdepth = {}, {'u': 0, 'd': 0}
+        if 'uu' in req or 'ud' in req:
+            if lrec != depth.size-1:  # No upgoing field prop. if rec in last
+                ddepth = depth[lrec + 1] - zrec
+                Wdepth['u'] = ddepth
+                if use_ne_eval:
+                    W['u'] = use_ne_eval("exp(-lrecGam*ddepth)")
+                else:
+                    W['u'] = np.exp(-lrecGam*ddepth)
+            else:
+                W['u'] = np.full_like(lrecGam, 0+0j)
+        if 'du' in req or 'dd' in req:
+            if lrec != 0:     # No downgoing field propagator if rec in first
+                ddepth = zrec - depth[lrec]
+                Wdepth['d'] = ddepth
+                if use_ne_eval:
+                    W['d'] = use_ne_eval("exp(-lrecGam*ddepth)")
+                else:
+                    W['d'] = np.exp(-lrecGam*ddepth)
+            else:
+                W['d'] = np.full_like(lrecGam, 0+0j)
+
+        # Store in corresponding variable PT* = [T*uu, T*ud, T*du, T*dd, T*df]
+        # (written directly into ``out``, without temporary arrays)
         if TM:
-            PTM = [Puu*Wu*fTM, Pud*Wu*fTM, Pdu*Wd*fTM, Pdd*Wd*fTM, -df*fTM]
+            fact = Gam[:, :, lrec, :]/etaH[:, None, lrec, None]
         else:
-            PTE = [Puu*Wu*fTE, Pud*Wu*fTE, Pdu*Wd*fTE, Pdd*Wd*fTE, df*fTE]
+            fact = zetaH[:, None, lsrc, None]/Gam[:, :, lsrc, :]
+        for name, i in req.items():
+            if name == 'df' and use_ne_eval:  # direct field
+                ddepth = abs(zsrc - zrec)
+                dfsign = -1 if TM else 1  # NOQA
+                use_ne_eval("dfsign*exp(-lrecGam*ddepth)*fact", out=PT[i])
+            elif name == 'df':
+                np.multiply(lrecGam, -abs(zsrc - zrec), out=PT[i])
+                np.exp(PT[i], out=PT[i])
+                PT[i] *= fact
+                if TM:
+                    np.negative(PT[i], out=PT[i])
+            elif use_ne_eval:
+                Pn, Wn = P[name], W[name[0]]  # NOQA
+                use_ne_eval("Pn*Wn*fact", out=PT[i])
+            else:
+                np.multiply(P[name], W[name[0]], out=PT[i])
+                PT[i] *= fact
+
+        # Derivatives of PT* (product rule); fact is Gam/etaH (TM) or
+        # zetaH/Gam (TE) of the src/rec layer
+        if deta is not None:
+            if TM:
+                dfact = dgam/etaH[:, None, None, lrec, None]
+                dfact[..., lrec, :] -= fact/etaH[:, None, lrec, None] * \
+                    de[..., lrec, :]
+            else:
+                dfact = -(fact/lrecGam)[:, :, None, :]*dgam
+            for name, i in req.items():
+                if name == 'df':  # direct field
+                    ddepth = abs(zsrc - zrec)
+                    dfsign = -1 if TM else 1
+                    val = dfact - (ddepth*fact)[:, :, None, :]*dgam
+                    val *= dfsign*np.exp(-lrecGam*ddepth)[:, :, None, :]
+                else:
+                    Pn, Wn = P[name], W[name[0]]
+                    val = dP[name]*(Wn*fact)[:, :, None, :]
+                    val -= (Pn*Wn*fact*Wdepth[name[0]])[:, :, None, :]*dgam
+                    val += (Pn*Wn)[:, :, None, :]*dfact
+                dPT[i] = np.moveaxis(val, -2, 1)
+            del dGam, dgam, de, dfact, val
+
+        # Without reflections, the cached recursion is outdated
+        if entry is not None and not which:
+            entry.pop('Rp', None)
+            entry.pop('Rm', None)
+
+        # Free the arrays of this mode before calculating the next one
+        del Gam, lrecGam, W, fact
+        if which:
+            del P
+        if which and deta is not None:
+            del dP
 
     # Return Green's functions
-    return PTM, PTE
+    if modes is None:
+        return out[0], out[1]
+    else:
+        return out
 
 
-def fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM):
+def fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM, use_ne_eval=False,
+           which=None, deriv=None):
     """Calculate Pu+, Pu-, Pd+, Pd-.
 
     This is a modified version of empymod.kernel.fields(). See the original
     version for more information.
 
+    If ``use_ne_eval`` is ``numexpr.evaluate`` (see ``opt`` in ``dipole``),
+    the expensive statements are evaluated with ``numexpr``.
+
+    ``which`` is a list of the fields to calculate, out of ['uu', 'ud', 'du',
+    'dd'] (default is all of them); the others are returned as None.
+
+    If ``deriv`` = (dRp, dRm, dGam) is provided, the derivatives of the fields
+    are returned too, as four additional arrays. dRp, dRm, and dGam are the
+    derivatives of Rp, Rm, and of Gam in the src-layer, with shape (parameter,
+    frequency, offset, layer, lambda); see ``greenfct``.
+
     """
+    if which is None:
+        which = ['uu', 'ud', 'du', 'dd']
+    Puu = Pud = Pdu = Pdd = None
+    dPuu = dPud = dPdu = dPdd = None
+    if deriv is not None:
+        dRmp, dRpm, dGam = deriv[1], deriv[0], deriv[2]
+
     # Booleans if src in first or last layer; swapped if up=True
     first_layer = lsrc == 0
     last_layer = lsrc == depth.size-1
@@ -632,15 +1068,29 @@ def fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM):
     # Calculate down- and up-going fields
     for up in [False, True]:
 
+        # Required fields: up: Puu = Pu, Pud = Pd; down: Pdu = Pd, Pdd = Pu
+        if up:
+            need_u, need_d = 'uu' in which, 'ud' in which
+        else:
+            need_u, need_d = 'dd' in which, 'du' in which
+        if not need_u and not need_d:
+            continue
+
         # No upgoing field if rec is in last layer or below src
         if up and (lrec == depth.size-1 or lrec > lsrc):
-            Puu = np.full_like(Gam[:, :, lsrc, :], 0+0j)
-            Pud = np.full_like(Gam[:, :, lsrc, :], 0+0j)
+            Puu = np.full_like(Gam[:, :, lsrc, :], 0+0j) if need_u else None
+            Pud = np.full_like(Gam[:, :, lsrc, :], 0+0j) if need_d else None
+            if deriv is not None:
+                dPuu = np.zeros_like(dGam) if need_u else None
+                dPud = np.zeros_like(dGam) if need_d else None
             continue
         # No downgoing field if rec is in first layer or above src
         if not up and (lrec == 0 or lrec < lsrc):
-            Pdu = np.full_like(Gam[:, :, lsrc, :], 0+0j)
-            Pdd = np.full_like(Gam[:, :, lsrc, :], 0+0j)
+            Pdu = np.full_like(Gam[:, :, lsrc, :], 0+0j) if need_d else None
+            Pdd = np.full_like(Gam[:, :, lsrc, :], 0+0j) if need_u else None
+            if deriv is not None:
+                dPdu = np.zeros_like(dGam) if need_d else None
+                dPdd = np.zeros_like(dGam) if need_u else None
             continue
 
         # Swaps if up=True
@@ -648,24 +1098,564 @@ def fields(depth, Rp, Rm, Gam, lrec, lsrc, zsrc, TM):
             dp, dm = dm, dp
             Rmp, Rpm = Rpm, Rmp
             first_layer, last_layer = last_layer, first_layer
+            if deriv is not None:
+                dRmp, dRpm = dRpm, dRmp
 
         # Calculate Pu+, Pu-, Pd+, Pd-; rec in src layer; Eqs  81/82, A-8/A-9
+        # (only the required ones)
         iGam = Gam[:, :, lsrc, :]
+        Pu = Pd = None
         if last_layer:  # If src/rec are in top (up) or bottom (down) layer
-            Pd = Rmp*np.exp(-iGam*dm)
-            Pu = np.full_like(Gam[:, :, lsrc, :], 0+0j)
+            if need_d and use_ne_eval:
+                Pd = use_ne_eval("Rmp*exp(-iGam*dm)")
+            elif need_d:
+                Pd = Rmp*np.exp(-iGam*dm)
+            if need_u:
+                Pu = np.full_like(Gam[:, :, lsrc, :], 0+0j)
         else:           # If src and rec are in any layer in between
-            Ms = 1 - Rmp*Rpm*np.exp(-2*iGam*ds)
-            Pd = Rmp/Ms*np.exp(-iGam*dm)
-            Pu = Rmp/Ms*pm*Rpm*np.exp(-iGam*(ds+dp))
+            if use_ne_eval:
+                Ms = use_ne_eval("1 - Rmp*Rpm*exp(-2*iGam*ds)")  # NOQA
+                if need_d:
+                    Pd = use_ne_eval("Rmp/Ms*exp(-iGam*dm)")
+                if need_u:
+                    Pu = use_ne_eval("Rmp/Ms*pm*Rpm*exp(-iGam*(ds+dp))")
+            else:
+                Ms = 1 - Rmp*Rpm*np.exp(-2*iGam*ds)
+                if need_d:
+                    Pd = Rmp/Ms*np.exp(-iGam*dm)
+                if need_u:
+                    Pu = Rmp/Ms*pm*Rpm*np.exp(-iGam*(ds+dp))
+
+        # Derivatives of Pu+, Pu-, Pd+, Pd- (product and quotient rule); the
+        # primal arrays get a layer axis to broadcast with the derivatives
+        if deriv is not None:
+            dPu = dPd = None
+            ed = np.exp(-iGam*dm)[:, :, None, :]
+            if last_layer:
+                if need_d:
+                    dPd = (dRmp - (Rmp*dm)[:, :, None, :]*dGam)*ed
+                if need_u:
+                    dPu = np.zeros_like(dGam)
+            else:
+                e2 = np.exp(-2*iGam*ds)
+                dMs = (Rmp*Rpm*e2*2*ds)[:, :, None, :]*dGam
+                dMs -= (dRmp*Rpm[:, :, None, :] +
+                        Rmp[:, :, None, :]*dRpm)*e2[:, :, None, :]
+                if need_d:
+                    dPd = dRmp*ed - (Rmp*dm)[:, :, None, :]*ed*dGam
+                    dPd -= Pd[:, :, None, :]*dMs
+                    dPd /= Ms[:, :, None, :]
+                if need_u:
+                    eu = np.exp(-iGam*(ds+dp))[:, :, None, :]
+                    dPu = dRmp*Rpm[:, :, None, :] + Rmp[:, :, None, :]*dRpm
+                    dPu -= (Rmp*Rpm*(ds+dp))[:, :, None, :]*dGam
+                    dPu *= pm*eu
+                    dPu -= Pu[:, :, None, :]*dMs
+                    dPu /= Ms[:, :, None, :]
 
         # Store P's
         if up:
             Puu = Pu
             Pud = Pd
+            if deriv is not None:
+                dPuu, dPud = dPu, dPd
         else:
             Pdu = Pd
             Pdd = Pu
+            if deriv is not None:
+                dPdu, dPdd = dPd, dPu
 
     # Return fields (up- and downgoing)
-    return Puu, Pud, Pdu, Pdd
+    if deriv is None:
+        return Puu, Pud, Pdu, Pdd
+    else:
+        return Puu, Pud, Pdu, Pdd, dPuu, dPud, dPdu, dPdd
+
+
+def reflections_deriv(depth, e_zH, Gam, lrec, lsrc):
+    """Calculate Rp, Rm, and their derivatives.
+
+    This is a modified version of empymod.kernel.reflections() for src and rec
+    in the same layer. See the original version for more information.
+
+    Besides Rp and Rm (shape (frequency, offset, lambda)) it returns their
+    derivatives with respect to ``Gam`` and ``e_zH`` of each layer, as tuples
+    (dR/dGam, dR/de_zH), both of the shape of ``Gam``. They are obtained by
+    one backward sweep through the recursion, storing the local derivatives
+    of each step in the forward sweep; the cost is therefore independent of
+    the number of parameters.
+
+    """
+    out = []
+
+    # Loop over Rp, Rm
+    for plus in [True, False]:
+
+        # Switches depending if plus or minus
+        if plus:
+            pm = 1
+            layer_count = np.arange(depth.size-2, lsrc-1, -1)
+        else:
+            pm = -1
+            layer_count = np.arange(1, lsrc+1, 1)
+
+        # Pre-allocate Ref and its derivatives
+        tRef = np.zeros_like(Gam[:, :, lsrc, :])
+        dGam = np.zeros_like(Gam)
+        de_zH = np.zeros_like(Gam)
+
+        # Calculate the reflection, storing the local derivatives
+        local = []
+        for iz in layer_count:
+
+            # Eqs 65, A-12
+            e_zHa = e_zH[:, None, iz+pm, None]
+            Gama = Gam[:, :, iz, :]
+            e_zHb = e_zH[:, None, iz, None]
+            Gamb = Gam[:, :, iz+pm, :]
+            rloca = e_zHa*Gama
+            rlocb = e_zHb*Gamb
+            rloc = (rloca - rlocb)/(rloca + rlocb)
+
+            # d rloc / d[Gama, e_zHb, Gamb, e_zHa]
+            fact = 2/(rloca + rlocb)**2
+            drloc = [fact*rlocb*e_zHa, -fact*rloca*Gamb,
+                     -fact*rloca*e_zHb, fact*rlocb*Gama]
+
+            # In first layer tRef = rloc
+            if iz == layer_count[0]:
+                tRef = rloc.copy()
+                dprev = None
+            else:
+                ddepth = depth[iz+1+pm]-depth[iz+pm]
+
+                # Eqs 64, A-11
+                term = tRef*np.exp(-2*Gamb*ddepth)
+                denom = (1 + rloc*term)**2
+                dprev = np.exp(-2*Gamb*ddepth)*(1 - rloc*rloc)/denom
+                drloc = [val*(1 - term*term)/denom for val in drloc]
+                drloc[2] -= 2*ddepth*term*(1 - rloc*rloc)/denom
+                tRef = (rloc + term)/(1 + rloc*term)
+
+            local.append((iz, drloc, dprev))
+
+        # Backward sweep: d tRef / d tRef_i is the product of the dprev's of
+        # all later steps
+        fact = np.ones_like(tRef)
+        for iz, drloc, dprev in local[::-1]:
+            dGam[:, :, iz, :] += fact*drloc[0]
+            de_zH[:, :, iz, :] += fact*drloc[1]
+            dGam[:, :, iz+pm, :] += fact*drloc[2]
+            de_zH[:, :, iz+pm, :] += fact*drloc[3]
+            if dprev is not None:
+                fact *= dprev
+
+        out.append((tRef, (dGam, de_zH)))
+
+    # Return reflections (plus and minus), and their derivatives
+    return out[0][0], out[1][0], out[0][1], out[1][1]
+
+
+def reflections_cache(depth, e_zH, Gam, lrec, lsrc, use_ne_eval, entry,
+                      changed=None):
+    """Calculate Rp, Rm, reusing the recursion of unchanged layers.
+
+    This is a modified version of empymod.kernel.reflections() for src and rec
+    in the same layer. See the original version for more information.
+
+    The reflection coefficient after each step of the recursion is stored in
+    the dict ``entry`` (keys 'Rp' and 'Rm', each a dict {layer: tRef}). If
+    ``changed`` (bool per layer) is provided, the recursion restarts at the
+    first step involving a changed layer, from the stored reflection
+    coefficient of the step before; the steps away from the src-layer are
+    reused.
+
+    """
+    out = []
+
+    # Loop over Rp, Rm
+    for plus in [True, False]:
+
+        # Switches depending if plus or minus
+        if plus:
+            pm = 1
+            layer_count = np.arange(depth.size-2, lsrc-1, -1)
+        else:
+            pm = -1
+            layer_count = np.arange(1, lsrc+1, 1)
+
+        # Stored steps, and first step to calculate
+        name = 'Rp' if plus else 'Rm'
+        if changed is None or name not in entry:
+            entry[name] = {}
+            start = 0
+        else:
+            redo = changed[layer_count] | changed[layer_count+pm]
+            start = np.argmax(redo) if redo.any() else layer_count.size
+        tRefs = entry[name]
+
+        # Start from the last unchanged step (zero if no layers)
+        if start > 0:
+            tRef = tRefs[layer_count[start-1]]
+        else:
+            tRef = np.zeros_like(Gam[:, :, lsrc, :])
+
+        # Calculate the reflection
+        for iz in layer_count[start:]:
+
+            # Eqs 65, A-12
+            e_zHa = e_zH[:, None, iz+pm, None]
+            Gama = Gam[:, :, iz, :]
+            e_zHb = e_zH[:, None, iz, None]
+            Gamb = Gam[:, :, iz+pm, :]
+            if use_ne_eval:
+                rlocstr = "(e_zHa*Gama - e_zHb*Gamb)/(e_zHa*Gama + e_zHb*Gamb)"
+                rloc = use_ne_eval(rlocstr)
+            else:
+                rloca = e_zHa*Gama
+                rlocb = e_zHb*Gamb
+                rloc = (rloca - rlocb)/(rloca + rlocb)
+
+            # In first layer tRef = rloc
+            if iz == layer_count[0]:
+                tRef = rloc.copy()
+            else:
+                ddepth = depth[iz+1+pm]-depth[iz+pm]
+
+                # Eqs 64, A-11
+                if use_ne_eval:
+                    term = use_ne_eval("tRef*exp(-2*Gamb*ddepth)")
+                    tRef = use_ne_eval("(rloc + term)/(1 + rloc*term)")
+                else:
+                    term = tRef*np.exp(-2*Gamb*ddepth)  # NOQA
+                    tRef = (rloc + term)/(1 + rloc*term)
+
+            tRefs[iz] = tRef
+
+        out.append(tRef)
+
+    # Return reflections (plus and minus)
+    return out[0], out[1]
+
+
+def dlf(PT, lambd, off, filt, pts_per_dec):
+    """Digital Linear Filter method for the Hankel transform.
+
+    This is a modified version of empymod.transform.dlf(), restricted to the
+    kernels of ``ab=11`` without angle factors: the J0-transform of
+    ``PT*lambd`` and the J1-transform of ``-PT``. See the original version for
+    more information.
+
+    ``PT`` has shape (..., offset, lambda) for the standard DLF, and
+    (..., 1, lambda) for the lagged convolution and splined DLF; all leading
+    dimensions (modes, frequencies) are transformed at once. For the standard
+    and lagged DLF the J0- and J1-filters are combined into one weight matrix
+    [base*j0, -j1], so both transforms of all modes are a single matrix
+    product; the factor ``lambd = base/r`` of the J0-kernel is split into the
+    weights and a division by r.
+
+    Returned are the J0- and J1-transforms, the latter already divided by the
+    offsets (because of J2).
+
+    """
+    nbase = filt.base.size
+    shape = PT.shape[:-2] + (off.size, )  # Shape of the transforms
+
+    # Combined weights for J0 and J1, shape (nbase, 2)
+    weights = np.array([filt.base*filt.j0, -filt.j1]).T
+
+    if pts_per_dec < 0:  # Lagged Convolution DLF: interp. in output domain
+        _, int_pts = transform.get_spline_values(filt, off, pts_per_dec)
+
+        # View of the signal, where row i is signal[i:i+nbase]
+        PT = np.ascontiguousarray(PT[..., 0, :])
+        stride = PT.strides[-1]
+        PT = np.lib.stride_tricks.as_strided(
+                PT, PT.shape[:-1] + (int_pts.size, nbase),
+                PT.strides[:-1] + (stride, stride), writeable=False)
+
+        # Apply DLF; J2(kr) = 2/(kr)*J1(kr) - J0(kr), hence J1 is divided by
+        # r, and J0 by r because of the weights
+        J = np.matmul(PT, weights)/int_pts[:, None]
+
+        # Interpolate to the offsets
+        J = CubicSpline(np.log(int_pts[::-1]), J[..., ::-1, :],
+                        axis=-2)(np.log(off))
+        J0, J1 = J[..., 0], J[..., 1]
+
+    elif pts_per_dec > 0:  # Splined DLF: interpolate in input domain
+        # The J0- and J1-kernels differ after interpolation, hence they are
+        # transformed separately; one mode at a time, as the interpolated
+        # kernels have shape (..., offset, nbase)
+        ln_lambd = np.log(lambd[0])
+        new = np.log(filt.base/off[:, None])
+        PT = PT.reshape((-1, ) + PT.shape[-3:])
+        J0 = np.empty(PT.shape[:-2] + (off.size, ), dtype=complex)
+        J1 = np.empty(PT.shape[:-2] + (off.size, ), dtype=complex)
+        for i, val in enumerate(PT[..., 0, :]):
+            tmp = CubicSpline(ln_lambd, val*lambd[0], axis=-1)(new)
+            J0[i] = np.dot(tmp, filt.j0)
+            tmp = CubicSpline(ln_lambd, val, axis=-1)(new)
+            J1[i] = np.dot(tmp, -filt.j1)/off
+        J0 = J0.reshape(shape)
+        J1 = J1.reshape(shape)
+
+    else:                  # Standard DLF: one matrix product
+        J = np.dot(PT.reshape(-1, nbase), weights)
+        J = J.reshape(PT.shape[:-1] + (2, ))/off[:, None]
+        J0, J1 = J[..., 0], J[..., 1]
+
+    return J0/off, J1/off
+
+
+def _check_models(depth, res, aniso, eperm, mperm, freq, verb):
+    """Check layer parameters with an optional model axis, and frequency.
+
+    Depth, frequency, and the first model are checked with ``check_model``
+    and ``check_frequency``. The stacked parameters of all models are then
+    checked at once (shape and minimum values, as in ``check_model``), and
+    etaH, etaV, zetaH, and zetaV are computed for all models without a loop
+    over the models.
+
+    Returns
+    -------
+    depth : array
+        Depths of layer interfaces, with -infty at the beginning.
+
+    nmodel : int or None
+        Number of models; None if no parameter has a model axis.
+
+    frequency : tuple
+        (freq, etaH, etaV, zetaH, zetaV); etaH, etaV, zetaH, and zetaV have
+        shape (nmodel*nfreq, nlayer).
+
+    """
+    # Number of models, from the parameters with a model axis
+    params = {'res': res, 'aniso': aniso, 'eperm': eperm, 'mperm': mperm}
+    nmodels = {np.shape(val)[0] for val in params.values() if np.ndim(val) > 1}
+    if len(nmodels) > 1:
+        print("* ERROR   :: All layer parameters with a model axis must " +
+              "have the same number of models; number provided: " +
+              _strvar(np.array(sorted(nmodels))))
+        raise ValueError('res')
+    nmodel = nmodels.pop() if nmodels else None
+
+    # Check depth, frequency, and the first model (warnings of the stacked
+    # parameters are printed below, by the check of all models)
+    model = [val[0] if np.ndim(val) > 1 else val for val in params.values()]
+    model = check_model(depth, model[0], model[1], model[2], model[2],
+                        model[3], model[3], False, verb if nmodel is None
+                        else min(verb, 0))
+    depth = model[0]
+    frequency = check_frequency(freq, *model[1:-1], verb)
+    if nmodel is None:
+        return depth, nmodel, frequency
+    freq = frequency[0]
+    if verb > 2:
+        print("   models          : ", nmodel)
+
+    # Check the stacked parameters of all models, of shape (nmodel, nlayer)
+    shape = (nmodel, depth.size)
+    for name, val in params.items():
+        if val is None:
+            val = np.ones(shape)
+        else:
+            val = np.array(val, dtype=float, ndmin=1)
+            if val.ndim > 1 and val.shape != shape:
+                print('* ERROR   :: Parameter ' + name + ' has wrong ' +
+                      'shape! : ' + str(val.shape) + ' instead of ' +
+                      str(shape) + '.')
+                raise ValueError(name)
+            val = np.broadcast_to(val, shape).copy()
+        params[name] = val
+
+    # Minimum values, as in ``check_model``; aniso via vertical resistivity
+    res = _check_stacked_min(params['res'], utils._min_res, 'Resistivities',
+                             'Ohm.m', verb)
+    resv = _check_stacked_min(params['aniso']**2*res, utils._min_res,
+                              'Parameter aniso', '', verb)
+    eperm = _check_stacked_min(params['eperm'], 0.0, 'Parameter epermH', '',
+                               verb)
+    mperm = _check_stacked_min(params['mperm'], 0.0, 'Parameter mpermH', '',
+                               verb)
+
+    # etaH, etaV, zetaH, and zetaV of all models, stacked model after model
+    # along the frequency axis, as in ``check_frequency``
+    omega = 2j*np.pi*freq[None, :, None]
+    etaH = 1/res[:, None, :] + omega*eperm[:, None, :]*epsilon_0
+    etaV = 1/resv[:, None, :] + omega*eperm[:, None, :]*epsilon_0
+    zeta = omega*mperm[:, None, :]*mu_0
+    frequency = [freq, ] + [val.reshape(-1, depth.size) for val in
+                            [etaH, etaV, zeta, zeta.copy()]]
+
+    return depth, nmodel, frequency
+
+
+def _check_stacked_min(par, minval, name, unit, verb):
+    """Set values of stacked parameter ``par`` below ``minval`` to it."""
+    ipar = par < minval
+    if ipar.any():
+        par[ipar] = minval
+        if verb > 0:
+            print('* WARNING :: ' + name + ' < ' + str(minval) + ' ' + unit +
+                  ' are set to ' + str(minval) + ' ' + unit + '!')
+    return par
+
+
+def _get_cache(cache, name, key, eta):
+    """Return cache entry ``name`` and the layers changed since (bool).
+
+    The entry is reset (and None is returned for the changed layers) if it is
+    new, or if the arrays in ``key`` (e.g., lambd, depth) or the shapes of the
+    parameters ``eta`` (etaH, etaV, zetaH, zetaV) changed.
+
+    """
+    entry = cache.setdefault(name, {})
+    old_key, old_eta = entry.get('key'), entry.get('eta')
+
+    # Check if the cached values are valid for this call
+    valid = old_key is not None and 'Gam' in entry
+    valid = valid and all(np.shape(new) == np.shape(old) and
+                          np.array_equal(new, old) for new, old in
+                          zip(key, old_key))
+    valid = valid and all(new.shape == old.shape for new, old in
+                          zip(eta, old_eta))
+
+    # Layers with changed parameters
+    if valid:
+        changed = np.zeros(eta[0].shape[1], dtype=bool)
+        for new, old in zip(eta, old_eta):
+            changed |= np.any(new != old, axis=0)
+    else:
+        entry.clear()
+        changed = None
+
+    # Store the current key and parameters
+    entry['key'] = [np.array(val, copy=True) for val in key]
+    entry['eta'] = [val.copy() for val in eta]
+
+    return entry, changed
+
+
+def _check_jacobian(jacobian):
+    """Return list of parameters for the Jacobian (empty if None)."""
+    if jacobian is None:
+        return []
+
+    jac = [jacobian, ] if isinstance(jacobian, str) else list(jacobian)
+    if len(jac) == 0 or not set(jac).issubset(['res', 'aniso']):
+        print("* ERROR   :: <jacobian> must be a list of ['res', 'aniso']; " +
+              "<jacobian> provided: " + str(jacobian))
+        raise ValueError('jacobian')
+
+    return jac
+
+
+def _check_modes(modes):
+    """Return indices into _MODES of the requested modes (default all)."""
+    if modes is None:
+        return list(range(len(_MODES)))
+
+    modes = [modes, ] if isinstance(modes, str) else list(modes)
+    if len(modes) == 0 or not set(modes).issubset(_MODES):
+        print("* ERROR   :: <modes> must be a list of " + str(_MODES) +
+              "; <modes> provided: " + str(modes))
+        raise ValueError('modes')
+
+    return [_MODES.index(mode) for mode in modes]
+
+
+def _unique_offsets(off, rtol=1e-12):
+    """Return unique offsets and the indices to reconstruct off from them.
+
+    Offsets which differ by less than ``rtol`` (relative) are considered
+    identical, as offsets of, e.g., receivers on a circle around the source
+    differ in the last digits.
+
+    """
+    isort = np.argsort(off)
+    soff = off[isort]
+    new = np.r_[True, np.diff(soff) > rtol*soff[1:]]
+    uind = np.empty(off.size, dtype=int)
+    uind[isort] = np.cumsum(new) - 1
+    return soff[new], uind
+
+
+def tem(fEM, freq, time, signal, ft, ftarg):
+    """Return the time-domain response of the frequency-domain response fEM.
+
+    This is a modified version of empymod.model.tem(). See the original
+    version for more information.
+
+    ``fEM`` has shape (frequency, response), where the responses are all modes
+    for all offsets. With the Digital Linear Filter method they are transformed
+    at once (see ``ffht``), the other methods transform one response after the
+    other.
+
+    """
+    # 1. Scale frequencies if switch-on/off response
+    # Step function for causal times is like a unit fct, therefore an impulse
+    # in frequency domain
+    if signal in [-1, 1]:
+        # Divide by signal/(2j*pi*f) to obtain step response
+        fEM = fEM*signal/(2j*np.pi*freq[:, None])
+
+    # 2. f->t transform
+    if ft == 'ffht':
+        tEM, conv = ffht(fEM, time, freq, ftarg)
+    else:
+        conv = True
+        tEM = np.zeros((time.size, fEM.shape[1]))
+        for i in range(fEM.shape[1]):
+            out = getattr(transform, ft)(fEM[:, i], time, freq, ftarg)
+            tEM[:, i] += out[0]
+            conv *= out[1]
+
+    return tEM*2/np.pi, conv  # Scaling from Fourier transform
+
+
+def ffht(fEM, time, freq, ftarg):
+    """Fourier Transform using the Digital Linear Filter method.
+
+    This is a modified version of empymod.transform.ffht() and
+    empymod.transform.dlf(), which transforms all responses (columns) of
+    ``fEM`` at once. See the original versions for more information.
+
+    """
+    # Get ffhtargs
+    ffhtfilt, pts_per_dec, kind = ftarg
+    values = getattr(ffhtfilt, kind)  # Sine (`sin`) or cosine (`cos`)
+    nbase = ffhtfilt.base.size
+
+    # Real or -Imag part depending on kind (sine/cosine)
+    if kind == 'sin':
+        fEM = -fEM.imag
+    else:
+        fEM = fEM.real
+
+    if pts_per_dec < 0:  # Lagged Convolution DLF: interp. in output domain
+        _, int_pts = transform.get_spline_values(ffhtfilt, time, pts_per_dec)
+
+        # Re-arrange signal: row i is signal[i:i+nbase]
+        ind = np.arange(int_pts.size)[:, None] + np.arange(nbase)
+        tEM = np.tensordot(fEM[ind], values, axes=(1, 0))
+
+        # Interpolate each response to the desired times
+        ln_int_pts = np.log(int_pts[::-1])
+        tEM = np.array([iuSpline(ln_int_pts, val[::-1])(np.log(time))
+                        for val in tEM.T]).T
+
+    else:
+        if pts_per_dec > 0:  # Splined DLF: interpolate in input domain
+            new = np.log(ffhtfilt.base/time[:, None])
+            ln_points = np.log(2*np.pi*freq)
+            fEM = np.array([iuSpline(ln_points, val)(new) for val in fEM.T])
+            fEM = fEM.transpose(1, 2, 0)
+        else:                # Standard DLF: cast into (time, base, response)
+            fEM = fEM.reshape(time.size, nbase, -1)
+
+        tEM = np.tensordot(fEM, values, axes=(1, 0))
+
+    # Return the electromagnetic time domain field
+    # (Second argument is only for QWE)
+    return tEM/time[:, None], True
@@ -14,6 +14,11 @@ setup(
     download_url='https://github.com/empymod/empyscripts/tarball/v0.3.2',
     license='Apache License V2.0',
     packages=['empyscripts'],
+    entry_points={
+        'console_scripts': [
+            'empyscripts-fdesign = empyscripts.fdesign:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'License :: OSI Approved :: Apache Software License',
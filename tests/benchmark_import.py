@@ -0,0 +1,63 @@
+"""
+Import-time benchmark of empyscripts.
+
+Runs each import statement several times in a fresh Python process and
+reports the best time and which of the heavy dependencies got imported. The
+first row imports everything, as ``import empyscripts`` did before the
+add-ons and their optional dependencies were imported lazily.
+
+Note that ``empymod`` itself (from v1.7.0 onwards, which contains
+``empymod.scripts``) imports matplotlib and IPython; the times of the rows
+which import an add-on are therefore dominated by importing empymod.
+
+Usage: python tests/benchmark_import.py [nrepeat]
+
+"""
+import sys
+import subprocess
+
+# Heavy dependencies to check
+HEAVY = ['empymod', 'scipy.optimize', 'matplotlib.pyplot', 'IPython',
+         'numexpr']
+
+# Statements to benchmark: (name, statement)
+STATEMENTS = [
+    ('eager (previous)', 'import empyscripts.tmtemod, empyscripts.fdesign, '
+                         'empyscripts.printinfo, matplotlib.pyplot, IPython, '
+                         'numexpr, scipy.optimize'),
+    ('import empyscripts', 'import empyscripts'),
+    ('empymod (dependency)', 'import empymod'),
+    ('fdesign', 'from empyscripts import fdesign'),
+    ('tmtemod', 'from empyscripts import tmtemod'),
+    ('versions', 'from empyscripts import versions'),
+]
+
+CODE = """
+import sys, warnings
+from timeit import default_timer
+warnings.simplefilter('ignore')
+t0 = default_timer()
+{}
+t = default_timer() - t0
+print(t, ','.join(m for m in {} if m in sys.modules))
+"""
+
+
+def run(statement, nrepeat):
+    """Return best time and imported heavy modules of statement."""
+    times = []
+    for _ in range(nrepeat):
+        out = subprocess.check_output(
+                [sys.executable, '-c', CODE.format(statement, HEAVY)])
+        time, _, modules = out.decode().strip().partition(' ')
+        times.append(float(time))
+    return min(times), modules
+
+
+if __name__ == '__main__':
+    nrepeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print('  {:20} {:>9}  {}'.format('Statement', 'Time (s)', 'Imported'))
+    for name, statement in STATEMENTS:
+        time, modules = run(statement, nrepeat)
+        print('  {:20} {:9.3f}  {}'.format(name, time, modules or '-'))
@@ -0,0 +1,63 @@
+"""
+Benchmark of tmtemod.dipole for receiver layouts with repeated offsets.
+
+The kernel and the Hankel transform of ``tmtemod.dipole`` depend only on
+offset, not on azimuth; they are calculated once per unique offset, and the
+azimuthal factors are applied afterwards. This script compares the runtime of
+layouts with the same number of receivers but a different number of unique
+offsets: a line (all offsets distinct, which is the cost without
+deduplication), receivers on circles around the source, and a reciprocal
+layout (every offset twice).
+
+Usage: python tests/benchmark_tmtemod.py [nrec] [nrepeat]
+
+"""
+import sys
+from timeit import default_timer
+
+import numpy as np
+
+from empyscripts import tmtemod
+
+# Model
+MODEL = {'src': [0, 0, 100], 'depth': [0, 1000, 1200],
+         'res': [2e14, 1, 100, 1], 'freqtime': [0.1, 1, 3], 'verb': 0}
+
+
+def layouts(nrec):
+    """Return receiver layouts (name, x, y) with nrec receivers each."""
+    phi = np.linspace(0, 2*np.pi, nrec, endpoint=False)
+    off = np.linspace(1000, 10000, nrec)
+    ring = np.repeat(np.linspace(1000, 10000, 10), nrec//10)
+    half = np.linspace(1000, 10000, nrec//2)
+    return [
+        ('line', off, np.zeros(nrec)),
+        ('circle', 3000*np.cos(phi), 3000*np.sin(phi)),
+        ('10 circles', ring*np.cos(phi), ring*np.sin(phi)),
+        ('reciprocal', np.r_[half, -half], np.zeros(2*half.size)),
+    ]
+
+
+def run(x, y, nrepeat):
+    """Return best time of tmtemod.dipole for receivers x, y."""
+    times = []
+    for _ in range(nrepeat):
+        t0 = default_timer()
+        tmtemod.dipole(rec=[x, y, 200], **MODEL)
+        times.append(default_timer() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    nrec = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nrepeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print('  {:12} {:>6} {:>8} {:>9} {:>8}'.format(
+          'Layout', 'nrec', 'nunique', 'Time (s)', 'Speedup'))
+    tref = None
+    for name, x, y in layouts(nrec):
+        nunique = tmtemod._unique_offsets(np.sqrt(x**2 + y**2))[0].size
+        time = run(x, y, nrepeat)
+        tref = tref or time
+        print('  {:12} {:6d} {:8d} {:9.3f} {:8.1f}'.format(
+              name, x.size, nunique, time, tref/time))
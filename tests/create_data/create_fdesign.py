@@ -3,8 +3,9 @@ import numpy as np
 from copy import deepcopy as dc
 from empyscripts import fdesign
 
-# Cannot pickle/shelve this; could dill it. For the moment, we just provide
-# it separately here and in the tests.
+# The transform pairs are registered and could therefore be pickled; however,
+# the stored data predates that, so we provide them separately here and in the
+# tests.
 fI = (fdesign.j0_1(5), fdesign.j1_1(5))
 
 # Define main model
@@ -1,8 +1,13 @@
 import os
 import sys
+import json
+import pickle
+import tracemalloc
+import multiprocessing
 import pytest
 import numpy as np
 from timeit import default_timer
+from concurrent.futures import ProcessPoolExecutor, CancelledError
 from os.path import join, dirname
 from numpy.testing import assert_allclose
 
@@ -84,6 +89,399 @@ def test_design():
         fdesign.design(fI=fI2, verb=0, plot=0, **dat4[0])
 
 
+def test_design_cache(tmpdir, monkeypatch, capsys):
+    cache = join(str(tmpdir), 'cache')
+    inp = {'n': 101, 'spacing': (0.05, 0.07, 3), 'shift': (-1.5, -1, 3),
+           'fI': fdesign.j0_1(5), 'r': np.logspace(0, 2, 20), 'verb': 0,
+           'plot': 0, 'save': False, 'full_output': True, 'cache': cache}
+
+    # First call computes and stores the result
+    filt1, out1 = fdesign.design(**inp)
+
+    # Second call loads it from the cache; brute must not be called
+    def no_brute(*args, **kwargs):
+        raise RuntimeError('brute called')
+
+    monkeypatch.setattr(fdesign, 'brute', no_brute)
+    monkeypatch.setattr(fdesign, '_screen_brute', no_brute)
+    filt2, out2 = fdesign.design(name='other', **inp)
+    assert filt2.name == 'other'
+    assert_allclose(filt2.base, filt1.base)
+    assert_allclose(filt2.j0, filt1.j0)
+    assert_allclose(out2[3], out1[3])
+
+    # Different inputs are not in the cache
+    with pytest.raises(RuntimeError):
+        fdesign.design(error=0.02, **inp)
+
+    # Screened results are not unscreened ones (and vice versa)
+    with pytest.raises(RuntimeError):
+        fdesign.design(screen=2, **inp)
+
+    # force recomputes
+    with pytest.raises(RuntimeError):
+        fdesign.design(force=True, **inp)
+    monkeypatch.undo()
+    inp['full_output'] = False
+    filt3 = fdesign.design(force=True, **inp)
+    assert_allclose(filt3.j0, filt1.j0)
+
+    # Screened result is stored separately
+    _, out4 = fdesign.design(screen=1.0001, **dict(inp, full_output=True))
+    _, out5 = fdesign.design(**dict(inp, full_output=True))
+    assert np.isinf(out4[3]).any()
+    assert_allclose(out5[3], out1[3])
+
+    # Unregistered pair: cache is not used, warning is printed
+    fI = fdesign.Ghosh('j0', inp['fI'].lhs, inp['fI'].rhs)
+    fdesign.design(**dict(inp, fI=fI, verb=1))
+    out, _ = capsys.readouterr()
+    assert "Result cache not used" in out
+
+
+def test_design_queue(monkeypatch):
+    inp = {'n': 101, 'spacing': (0.05, 0.07, 3), 'shift': (-1.5, -1, 3),
+           'r': np.logspace(0, 2, 20), 'verb': 0, 'plot': 0, 'save': False}
+    fI = [fdesign.j0_1(3), fdesign.j0_1(5), fdesign.j1_1(3)]
+    ref = [fdesign.design(fI=f, **inp) for f in fI]
+
+    # Single worker: the first job starts right away, the others wait and are
+    # started by priority
+    order = []
+    with fdesign.DesignQueue(max_workers=1) as queue:
+        futures = [queue.submit(fI=f, priority=p, **inp)
+                   for f, p in zip(fI, [0, 5, 1])]
+        for i, fut in enumerate(futures):
+            fut.add_done_callback(lambda fut, i=i: order.append(i))
+    assert order == [0, 2, 1]
+    for fut, filt, f in zip(futures, ref, fI):
+        assert_allclose(fut.result().base, filt.base)
+        assert_allclose(getattr(fut.result(), f.name), getattr(filt, f.name))
+
+    # Errors are passed on to the future
+    queue = fdesign.DesignQueue(max_workers=2)
+    fut = queue.submit(fI=fI[0], **dict(inp, spacing=(1, 2, 3, 4)))
+    with pytest.raises(ValueError):
+        fut.result()
+    queue.shutdown()
+    with pytest.raises(RuntimeError):
+        queue.submit(fI=fI[0], **inp)
+
+    # Jobs go to the free worker which already ran their pairs
+    with fdesign.DesignQueue(max_workers=2) as queue:
+        queue.submit(fI=fI[0], **inp).result()
+        queue.submit(fI=fI[2], fC=fI[2], **inp).result()
+        keys = [set(k) for k in queue._keys]
+        assert sorted(keys) == sorted([{fI[0].key}, {fI[2].key}])
+        for _ in range(2):
+            futures = [queue.submit(fI=fI[2], **inp),
+                       queue.submit(fI=fI[0], fC=fI[0], **inp)]
+            [fut.result() for fut in futures]
+    assert queue._keys == keys
+
+    # Without waiting, jobs which were not yet started are cancelled
+    queue = fdesign.DesignQueue(max_workers=1)
+    futures = [queue.submit(fI=f, **inp) for f in fI]
+    queue.shutdown(wait=False)
+    assert_allclose(futures[0].result().j0, ref[0].j0)
+    assert futures[1].cancelled() and futures[2].cancelled()
+    with pytest.raises(CancelledError):
+        futures[1].result()
+
+    # The first job of a worker enables its evaluation cache
+    monkeypatch.setattr(fdesign, '_eval_cache', None)
+    filt = fdesign._run_design(dict(inp, fI=fI[0]), 1)
+    assert isinstance(fdesign._eval_cache, fdesign._EvalCache)
+    assert fdesign._eval_cache.maxbytes == 2**20
+    assert_allclose(filt.j0, ref[0].j0)
+
+
+def test_eval_cache(monkeypatch):
+    inp = {'n': 101, 'spacing': (0.05, 0.07, 3), 'shift': (-1.5, -1, 3),
+           'fI': fdesign.j0_1(3), 'r': np.logspace(0, 2, 20), 'verb': 0,
+           'plot': 0, 'save': False}
+    ref = fdesign.design(fC=fdesign.j0_2(3), **inp)
+
+    # Second design with the same pairs is only served from the cache
+    cache = fdesign._EvalCache(2**26)
+    monkeypatch.setattr(fdesign, '_eval_cache', cache)
+    filt1 = fdesign.design(fC=fdesign.j0_2(3), **inp)
+    misses = cache.misses
+    filt2 = fdesign.design(fC=fdesign.j0_2(3),
+                           **dict(inp, fI=fdesign.j0_1(3)))
+    assert cache.misses == misses
+    assert cache.hits > 0
+    assert_allclose(filt1.j0, ref.j0, 0, 0)
+    assert_allclose(filt2.j0, ref.j0, 0, 0)
+
+    # Cached arrays are read-only
+    for value, _ in cache.data.values():
+        assert not value.flags.writeable
+
+    # Least-recently-used entries are removed
+    cache = fdesign._EvalCache(200)
+    cache.put('a', np.ones(10))
+    cache.put('b', np.ones(10))
+    assert cache.get('a') is not None
+    cache.put('c', np.ones(10))
+    assert cache.get('b') is None
+    assert cache.nbytes == 160
+    cache.put('d', np.ones(100))  # Bigger than cache, not stored
+    assert cache.get('d') is None
+
+
+def test_shard_merge(tmpdir):
+    inp = {'n': 101, 'spacing': (0.05, 0.07, 5), 'shift': (-1.5, -1, 4),
+           'fI': fdesign.j0_1(5), 'fC': fdesign.j0_2(1),
+           'r': np.logspace(0, 2, 50), 'finish': True}
+    ref = fdesign.design(verb=0, plot=0, save=False, full_output=True, **inp)
+
+    # Run the shards in separate processes
+    files = fdesign.shard(nshards=3, path=str(tmpdir), verb=0, **inp)
+    assert len(files) == 3
+    with ProcessPoolExecutor(3) as executor:
+        outs = list(executor.map(fdesign.run_shard, files, [None, ]*3,
+                                 [2, ]*3, [0, ]*3))
+
+    # Best candidates of the shards
+    with open(outs[0], 'rb') as fres:
+        res = pickle.load(fres)
+    assert res['best'].shape == (2, 3)
+    assert res['best'][0, 2] == res['values'].min()
+
+    # Merged result is the same as from design
+    filt, full = fdesign.merge(outs, full_output=True, save=False, verb=0)
+    assert_allclose(filt.j0, ref[0].j0, 0, 0)
+    for out, out_ref in zip(full, ref[1]):
+        assert_allclose(out, out_ref, 0, 0)
+
+    # All shards are required
+    with pytest.raises(ValueError):
+        fdesign.merge(outs[:2], verb=0)
+
+
+def test_main(tmpdir, capsys):
+    job = {'n': 101, 'spacing': [0.05, 0.07, 5], 'shift': [-1.5, -1, 4],
+           'fI': [{'pair': 'j0_1', 'a': 5}, {'pair': 'j1_1', 'a': 5}],
+           'r': {'logspace': [0, 2, 50]}, 'name': 'cli', 'workers': 2}
+    fjob = join(str(tmpdir), 'job.json')
+    with open(fjob, 'w') as fj:
+        json.dump(job, fj)
+    ref = fdesign.design(n=101, spacing=(0.05, 0.07, 5), shift=(-1.5, -1, 4),
+                         fI=(fdesign.j0_1(5), fdesign.j1_1(5)),
+                         r=np.logspace(0, 2, 50), verb=0, plot=0, save=False,
+                         full_output=True)
+
+    # 1. run
+    output = join(str(tmpdir), 'run')
+    fdesign.main(['run', fjob, '-o', output])
+    out, _ = capsys.readouterr()
+    events = [json.loads(line) for line in out.splitlines()]
+    assert events[0]['event'] == 'start'
+    assert events[-2] == {'event': 'shard', 'done': 8, 'total': 8}
+    assert events[-1]['event'] == 'finished'
+    filt = filters.DigitalFilter('cli')
+    filt.fromfile(output)
+    assert_allclose(filt.j0, ref[0].j0)
+    assert_allclose(filt.j1, ref[0].j1)
+    full = np.load(join(output, 'cli_full.npz'))
+    assert_allclose(full['Jout'], ref[1][3], 0, 0)
+
+    # 2. shard, run-shard, merge
+    fdesign.main(['shard', fjob, '-o', str(tmpdir), '-n', '2'])
+    out, _ = capsys.readouterr()
+    files = json.loads(out)['files']
+    results = []
+    for fname in files:
+        fdesign.main(['run-shard', fname])
+        out, _ = capsys.readouterr()
+        results.append(json.loads(out)['result'])
+    output = join(str(tmpdir), 'merge')
+    fdesign.main(['merge', *results, '-o', output])
+    filt = filters.DigitalFilter('cli')
+    filt.fromfile(output)
+    assert_allclose(filt.j0, ref[0].j0)
+
+    # 3. Wrong job file
+    with open(fjob, 'w') as fj:
+        json.dump(dict(job, wrong=1), fj)
+    with pytest.raises(ValueError):
+        fdesign.main(['run', fjob])
+
+
+def test_design_screen(capsys, monkeypatch):
+    inp = {'n': 101, 'spacing': (0.05, 0.1, 6), 'shift': (-2, -0.5, 6),
+           'fI': (fdesign.j0_1(5), fdesign.j1_1(5)),
+           'r': np.logspace(0, 3, 500), 'plot': 0, 'save': False,
+           'full_output': True}
+    ref, full = fdesign.design(verb=0, **inp)
+    filt, full2 = fdesign.design(verb=2, screen=100, **inp)
+    out, _ = capsys.readouterr()
+    assert "screening       : " in out
+
+    # Surviving cells are identical to the full run, the others are inf
+    survive = np.isfinite(full2[3])
+    assert 0 < survive.sum() < survive.size
+    assert_allclose(full2[3][survive], full[3][survive], 0, 0)
+    assert np.all(full2[2] == full[2])
+
+    # Same best filter
+    assert_allclose(full2[0], full[0], 0, 0)
+    assert full2[1] == full[1]
+    assert_allclose(filt.j0, ref.j0, 0, 0)
+
+    # The filters of the screening are removed from log, also on failure
+    fC = [fdesign.j0_1(5)]
+    fC[0].rhs = fC[0].rhs(inp['r'])
+    log = {'warn-r': 1}
+    args = (101, inp['fI'], fC, inp['r'], (1, 1, 2), 0.01, np.real, 'amp',
+            0, 0, log)
+    ispacing, ishift = (0.05, 0.1, 2), (-2, -0.5, 2)
+    get_min_val = fdesign._get_min_val
+
+    def fail(cell, *args):
+        if args[-1] is log:  # Exact stage
+            raise RuntimeError('failed')
+        return get_min_val(cell, *args)
+
+    monkeypatch.setattr(fdesign, '_get_min_val', fail)
+    with pytest.raises(RuntimeError):
+        fdesign._screen_brute(100, ispacing, ishift, args, False)
+    assert 'filters' not in log
+
+
+def test_design_maxmem(capsys, monkeypatch):
+    inp = {'n': 101, 'spacing': (0.05, 0.1, 3), 'shift': (-2, -1, 3),
+           'fI': (fdesign.j0_1(5), fdesign.j1_1(5)),
+           'fC': (fdesign.j0_5(), fdesign.j0_5([1, 2])),
+           'r': np.logspace(0, 3, 1000), 'plot': 0, 'save': False,
+           'full_output': True}
+    ref, full = fdesign.design(verb=0, **inp)
+    filt, full2 = fdesign.design(verb=2, maxmem=1, **inp)
+    out, _ = capsys.readouterr()
+    assert "peak memory     : " in out
+    assert not tracemalloc.is_tracing()
+
+    # Tracing is stopped if the design fails
+    def fail(*args, **kwargs):
+        raise RuntimeError('brute failed')
+
+    with monkeypatch.context() as mp:
+        mp.setattr(fdesign, 'brute', fail)
+        with pytest.raises(RuntimeError):
+            fdesign.design(verb=0, maxmem=1, **inp)
+    assert not tracemalloc.is_tracing()
+
+    # Without tracemalloc.reset_peak (Python < 3.9)
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    filt3, full3 = fdesign.design(verb=0, maxmem=1, **inp)
+    assert_allclose(full3[3], full[3], 0, 0)
+    assert not tracemalloc.is_tracing()
+
+    # Evaluated in chunks, but identical
+    assert len(fdesign._rchunks(1000, 101, 1)) == 4
+    assert_allclose(full2[3], full[3], 0, 0)
+    assert_allclose(filt.j0, ref.j0, 0, 0)
+    assert_allclose(filt.j1, ref.j1, 0, 0)
+
+    # Chunks cover r in whole blocks
+    chunks = fdesign._rchunks(1000, 101, 30)
+    assert [c.start for c in chunks] == [0, 512]
+    assert chunks[-1].stop == 1000
+    assert len(fdesign._rchunks(1000, 101, None)) == 1
+
+    # Filter system in several chunks (updated QR): as good a solution
+    n, spacing, shift = 201, 0.074, -1.0
+    fI = (fdesign.j0_1(5), fdesign.j1_5([1, 2]))
+    assert len(fdesign._rchunks(2*n, n, 1e-3)) == 2
+    ref = fdesign._calculate_filter(n, spacing, shift, fI, (1, 1, 2), np.real,
+                                    'ref')
+    filt = fdesign._calculate_filter(n, spacing, shift, fI, (1, 1, 2),
+                                     np.real, 'filt', 1e-3)
+    base = ref.base
+    r = np.logspace(np.log10(1/base.max())-1, np.log10(1/base.min())+1, 2*n)
+    for f in fI:
+        lhs = f.lhs(base/r[:, None]).reshape(-1, n)
+        rhs = (f.rhs(r)*r).reshape(-1)
+        res = [np.linalg.norm(lhs.dot(getattr(dlf, f.name)) - rhs)
+               for dlf in [ref, filt]]
+        assert res[1] < 1.5*res[0]
+
+
+def test_design_opt(capsys, monkeypatch):
+    pytest.importorskip('numexpr')
+    k = np.logspace(-3, 2, 1000).reshape(10, 100)
+
+    # Transform pairs agree with numpy to round-off; also parameter sweeps
+    for pair in [fdesign.j0_1(5), fdesign.j0_4(), fdesign.j1_5([1, 2]),
+                 fdesign.sin_1(), fdesign.cos_3([1, 2])]:
+        ref = pair.lhs(k)
+        prev = fdesign._set_opt('parallel')
+        assert_allclose(pair.lhs(k), ref, rtol=1e-14, atol=0)
+        fdesign._set_opt(prev)
+        assert fdesign._use_ne_eval is False
+
+    # Design: same best filter, opt is reset afterwards
+    inp = {'n': 101, 'spacing': (0.05, 0.1, 3), 'shift': (-2, -1, 3),
+           'fI': (fdesign.j0_1(5), fdesign.j1_1(5)), 'fC': fdesign.j0_4(),
+           'r': np.logspace(0, 3, 100), 'plot': 0, 'save': False, 'verb': 0,
+           'full_output': True}
+    ref, full = fdesign.design(**inp)
+    filt, full2 = fdesign.design(opt='parallel', **inp)
+    assert fdesign._use_ne_eval is False
+    assert_allclose(full2[0], full[0], 0, 0)
+    assert_allclose(full2[3], full[3], rtol=1e-6)
+
+    # (The filter values themselves are ill-conditioned; compare the result)
+    r = np.logspace(0, 2, 10)
+    assert_allclose(fdesign.apply_filter(filt, inp['fC'], r),
+                    fdesign.apply_filter(ref, inp['fC'], r), rtol=1e-6)
+
+    # opt is also reset if the design fails
+    def fail(*args, **kwargs):
+        raise RuntimeError('brute failed')
+
+    monkeypatch.setattr(fdesign, 'brute', fail)
+    with pytest.raises(RuntimeError):
+        fdesign.design(opt='parallel', **inp)
+    assert fdesign._use_ne_eval is False
+
+
+def test_design_iter():
+    inp = {'n': 101, 'spacing': (0.05, 0.07, 5), 'shift': (-1.5, -1, 4),
+           'fI': fdesign.j0_1(5), 'fC': fdesign.j0_2(1),
+           'r': np.logspace(0, 2, 50)}
+    ref, full = fdesign.design(verb=0, plot=0, save=False, full_output=True,
+                               **inp)
+
+    # Serial: cells in the order of brute, same values and best filter
+    res = list(fdesign.design_iter(verb=0, **inp))
+    assert_allclose([x[0] for x in res], full[2][0].ravel())
+    assert_allclose([x[1] for x in res], full[2][1].ravel())
+    assert_allclose([x[2] for x in res], full[3].ravel(), 0, 0)
+    assert_allclose(res[-1][4].j0, ref.j0, 0, 0)
+    assert res[-1][4].name == 'dlf_101'
+
+    # imin: index of the value
+    sp, sh, value, imin, _ = res[np.argmin([x[2] for x in res])]
+    rhs = fdesign.apply_filter(ref, inp['fC'], inp['r'])
+    assert_allclose(value, np.abs(rhs[imin]))
+
+    # Parallel: same cells, in any order
+    res2 = list(fdesign.design_iter(workers=2, verb=0, **inp))
+    assert sorted(x[:4] for x in res2) == sorted(x[:4] for x in res)
+    assert_allclose(res2[-1][4].j0, ref.j0, 0, 0)
+
+    # Stopping early yields the best filter so far
+    it = fdesign.design_iter(workers=2, verb=0, **inp)
+    part = [next(it) for _ in range(3)]
+    it.close()
+    best = min(part, key=lambda x: (x[2], x[0], x[1]))  # As in brute
+    filt = fdesign._calculate_filter(101, best[0], best[1], [inp['fI'], ],
+                                     (1, 1, 2), np.real, '')
+    assert_allclose(part[-1][4].j0, filt.j0, 0, 0)
+
+
 def test_save_filter():
     # Here we only save two pseudo-filters. In
     # test_load_filter we check, if they were saved correctly
@@ -217,6 +615,47 @@ class TestFiguresMatplotlib:
         return plt.gcf()
 
 
+@pytest.mark.skipif(not plt, reason="Matplotlib not installed.")
+def test_plot_qc(tmpdir, monkeypatch, capsys):
+    # design with plot=3 records the inversion results; rendered to files in
+    # the background
+    qcdir = join(str(tmpdir), 'qc')
+    fdesign.design(n=101, spacing=(0.05, 0.07, 2), shift=(-1.5, -1, 2),
+                   fI=fdesign.j0_1(5), r=np.logspace(0, 2, 20), verb=0,
+                   plot=3, save=False, qcdir=qcdir)
+    plt.close('all')
+    assert len(fdesign._qc_procs) == 1
+    fdesign._reap_qc(wait=True)
+    assert fdesign._qc_procs == []
+    files = sorted(os.listdir(qcdir))
+    assert files == ['inversion_0000%d_j0.png' % i for i in range(4)] + [
+            'qc.pkl']
+
+    # Rendered in the foreground if the process cannot be started
+    def no_start(self):
+        raise pickle.PicklingError('cannot pickle')
+
+    monkeypatch.setattr(multiprocessing.Process, 'start', no_start)
+    files = fdesign.plot_qc(join(qcdir, 'qc.pkl'), cells=[1, ],
+                            path=join(str(tmpdir), 'inline'), background=True)
+    assert files == [join(str(tmpdir), 'inline', 'inversion_00001_j0.png')]
+    assert fdesign._qc_procs == []
+    monkeypatch.undo()
+
+    # Failed background processes are reported
+    proc = fdesign.plot_qc({'cells': [{}]}, path=qcdir, background=True)
+    proc.join()
+    fdesign._reap_qc()
+    out, _ = capsys.readouterr()
+    assert "Rendering QC figures failed" in out
+
+    # Render selected cells afterwards, in the foreground
+    files = fdesign.plot_qc(join(qcdir, 'qc.pkl'), cells=[2, ], fmt='pdf',
+                            path=join(str(tmpdir), 'sel'))
+    assert files == [join(str(tmpdir), 'sel', 'inversion_00002_j0.pdf')]
+    assert os.path.isfile(files[0])
+
+
 @pytest.mark.skipif(plt, reason="Matplotlib is installed.")
 class TestFiguresNoMatplotlib:
 
@@ -241,6 +680,11 @@ class TestFiguresNoMatplotlib:
         out, _ = capsys.readouterr()
         assert "* WARNING :: `matplotlib` is not installed, no " in out
 
+    def test_plot_qc(self, capsys):
+        fdesign.plot_qc(1)
+        out, _ = capsys.readouterr()
+        assert "* WARNING :: `matplotlib` is not installed, no " in out
+
     def test_plot_transform_pairs(self, capsys):
         fdesign._plot_transform_pairs(1, 2, 3, 4)
         out, _ = capsys.readouterr()
@@ -280,12 +724,194 @@ def test_print_data(capsys):
     assert "> Base min/max  : 6.112528e-04 / 1.635984e+03" in out
 
 
+def test_apply_filter():
+    filt = filters.key_201_2009()
+    r = np.logspace(0, 1, 100)
+
+    # 1. Standard, chunked, and lagged convolution DLF
+    for f in [fdesign.j0_1(5), fdesign.j1_1(5)]:
+        rhs = fdesign.apply_filter(filt, f, r)
+        assert_allclose(rhs, f.rhs(r), rtol=1e-10)
+        assert_allclose(fdesign.apply_filter(filt, f.lhs, r, f.name, 7), rhs,
+                        rtol=1e-14)
+        assert_allclose(fdesign.apply_filter(filt, f, r, lagged=True), rhs,
+                        rtol=1e-4)
+
+    # Lagged convolution is exact on the lagged r
+    rlag = 10*np.exp(-np.arange(30)*np.log(filt.base[1]/filt.base[0]))
+    f = fdesign.j0_1(5)
+    assert_allclose(fdesign.apply_filter(filt, f, rlag, lagged=True),
+                    fdesign.apply_filter(filt, f, rlag), rtol=1e-12)
+    assert_allclose(fdesign.apply_filter(filt, f, 3, lagged=True),
+                    fdesign.apply_filter(filt, f, 3), rtol=1e-12)
+
+    # 2. Parameter sweep
+    f = fdesign.j0_1(np.array([3, 5]))
+    rhs = fdesign.apply_filter(filt, f, r, chunk=30)
+    assert rhs.shape == (2, 100)
+    assert_allclose(rhs, f.rhs(r), rtol=1e-10)
+    assert_allclose(fdesign.apply_filter(filt, f, r, lagged=True), rhs,
+                    rtol=1e-3)
+
+    # 3. j2
+    f0, f1 = fdesign.j0_1(5), fdesign.j1_1(5)
+    f2 = fdesign.Ghosh('j2', lambda k: (f0.lhs(k), f1.lhs(k)), None)
+    for lagged in [False, True]:
+        assert_allclose(fdesign.apply_filter(filt, f2, r, lagged=lagged),
+                        f0.rhs(r) + f1.rhs(r)/r, rtol=1e-4)
+
+    # 4. Sine/cosine
+    filt2 = filters.key_201_CosSin_2012()
+    for f in [fdesign.sin_2(), fdesign.cos_2()]:
+        assert_allclose(fdesign.apply_filter(filt2, f, r), f.rhs(r),
+                        rtol=1e-10)
+
+    # k-grids are reused, if they fit into the cache
+    assert fdesign._kgrid(filt.base, r) is fdesign._kgrid(filt.base, r)
+    assert not fdesign._kgrid(filt.base, r).flags.writeable
+    assert fdesign._kgrids.nbytes <= fdesign._kgrids.maxbytes
+    maxbytes = fdesign._kgrids.maxbytes
+    fdesign._kgrids.maxbytes = filt.base.nbytes*r.size - 1
+    try:
+        rr = r[::-1].copy()
+        assert fdesign._kgrid(filt.base, rr) is not fdesign._kgrid(
+                filt.base, rr)
+    finally:
+        fdesign._kgrids.maxbytes = maxbytes
+
+    # 5. Errors
+    with pytest.raises(ValueError):
+        fdesign.apply_filter(filt, fdesign.j0_1().lhs, r)
+    with pytest.raises(ValueError):
+        fdesign.apply_filter(filt, fdesign.sin_1(), r)
+
+
+def test_benchmark(tmpdir, capsys):
+    output = join(str(tmpdir), 'bench.csv')
+    filt = filters.kong_61_2007()
+    pairs = [fdesign.j0_1(5), fdesign.sin_2()]
+    r = np.logspace(0, 2, 50)
+    table = fdesign.benchmark(['key_201_2009', 'key_201_CosSin_2012', filt],
+                              pairs, r, output=output, sort='digits')
+    out, _ = capsys.readouterr()
+    assert 'Kong 61' in out
+
+    # Only fitting filter/pair-combinations
+    assert len(table) == 3
+    assert {(row['filter'], row['pair']) for row in table} == {
+            ('Key 201 (2009)', 'j0_1'), ('Kong 61', 'j0_1'),
+            ('Key 201 CosSin (2012)', 'sin_2')}
+
+    # Sorted by digits, descending
+    digits = [row['digits'] for row in table]
+    assert digits == sorted(digits, reverse=True)
+    row = [row for row in table if row['filter'] == 'Kong 61'][0]
+    assert_allclose(row['cost'], row['time']/row['digits'])
+    rhs = fdesign.apply_filter(filt, pairs[0], r)
+    imin, _ = fdesign._get_imin(rhs, pairs[0].rhs(r), 0.01)
+    assert row['max_r'] == r[imin]
+
+    # CSV file
+    with open(output) as fcsv:
+        lines = fcsv.read().splitlines()
+    assert lines[0] == 'filter,n,pair,ftype,max_r,min_amp,digits,time,cost'
+    assert len(lines) == 4
+
+    # Parallel; same accuracy
+    table2 = fdesign.benchmark(['key_201_2009', 'key_201_CosSin_2012', filt],
+                               pairs, r, output=None, sort='digits',
+                               workers=2, verb=0)
+    for row, row2 in zip(table, table2):
+        assert row['digits'] == row2['digits']
+
+    # From the command line
+    fjob = join(str(tmpdir), 'job.json')
+    with open(fjob, 'w') as fj:
+        json.dump({'filters': ['kong_61_2007'],
+                   'pairs': [{'pair': 'j0_1', 'a': 5}]}, fj)
+    fdesign.main(['benchmark', fjob, '-o', output])
+    out, _ = capsys.readouterr()
+    assert json.loads(out)['best']['filter'] == 'Kong 61'
+
+    with pytest.raises(ValueError):
+        fdesign.benchmark([filt], pairs, sort='wrong')
+
+
 def test_ghosh():
     # Assure a DigitalFilter has attributes 'name', 'lhs', and 'rhs'.
     out = fdesign.Ghosh('test', 'lhs', 'rhs')
     assert out.name == 'test'
     assert out.lhs == 'lhs'
     assert out.rhs == 'rhs'
+    assert out.key is None
+
+
+@fdesign.register_pair
+def my_pair(a=1):
+    """Transform pair used in test_register_pair."""
+
+    def lhs(x):
+        return np.exp(-a*x)
+
+    def rhs(b):
+        return 1/np.sqrt(b**2 + a**2)
+
+    return fdesign.Ghosh('j0', lhs, rhs)
+
+
+def test_register_pair():
+    r = np.logspace(0, 1, 10)
+
+    # 1. Built-in pairs are registered, also with positional arguments
+    tp1 = fdesign.j0_4(1, z=40)
+    assert tp1.pair == 'j0_4'
+    assert tp1.params == {'f': 1, 'rho': 0.3, 'z': 40}
+    assert tp1.key == fdesign.j0_4(f=1, rho=0.3, z=40).key
+    assert tp1.key != fdesign.j0_4(1, z=50).key
+    assert isinstance(hash(tp1.key), int)
+
+    # 2. Pickle, also with evaluated rhs
+    tp2 = pickle.loads(pickle.dumps(tp1))
+    assert tp2.key == tp1.key
+    assert_allclose(tp2.lhs(1/r), tp1.lhs(1/r))
+    assert_allclose(tp2.rhs(r), tp1.rhs(r))
+    tp1.rhs = tp1.rhs(r)
+    tp3 = pickle.loads(pickle.dumps(tp1))
+    assert_allclose(tp3.rhs, tp1.rhs)
+    assert_allclose(tp3.lhs(1/r), tp1.lhs(1/r))
+
+    # 3. empy_hankel with list; array parameters
+    tp4 = fdesign.empy_hankel(['j0', 'j1'], 50, 100, np.array([2e14, 1]), 1,
+                              0)
+    assert tp4[0].params['ftype'] == 'j0'
+    assert tp4[1].params['ftype'] == 'j1'
+    tp5 = pickle.loads(pickle.dumps(tp4))
+    assert tp5[1].key == tp4[1].key
+    assert_allclose(tp5[1].lhs(1/r), tp4[1].lhs(1/r))
+
+    # 4. User-defined pair
+    tp6 = my_pair(3)
+    tp7 = pickle.loads(pickle.dumps(tp6))
+    assert tp7.key == ('my_pair', (('a', 3), ))
+    assert_allclose(tp7.rhs(r), tp6.rhs(r))
+
+    # 5. Key is stored; callables are identified by their import path
+    assert 'key' in vars(tp6)
+    assert my_pair(np.sin).key == my_pair(np.sin).key
+    assert my_pair(np.sin).key != my_pair(np.cos).key
+    assert my_pair(my_pair).key[1] == (
+            ('a', ('callable', __name__, 'my_pair')), )
+    assert my_pair(lambda x: x).key is None
+
+
+def test_get_pair():
+    tp = fdesign.get_pair('sin_2', a=3)
+    assert tp.name == 'sin'
+    assert tp.key == fdesign.sin_2(3).key
+
+    # Error
+    with pytest.raises(ValueError):
+        fdesign.get_pair('does_not_exist')
 
 
 def test_j01():
@@ -338,6 +964,51 @@ def test_sincos():
         assert_allclose(rhs2a, rhs2c, rtol=1e-3)
 
 
+def test_parameter_sweep():
+    filt = filters.key_201_2009()
+    r = np.logspace(0, 1, 30)
+    k = filt.base/r[:, None]
+
+    # 1. Sweeps of analytical transform pairs correspond to individual pairs
+    for name in ['j0_1', 'j1_2', 'sin_3', 'cos_1']:
+        a = np.array([2, 3, 5])
+        tps = getattr(fdesign, name)(a)
+        assert tps.lhs(k).shape == (3, r.size, filt.base.size)
+        assert tps.rhs(r).shape == (3, r.size)
+        for i, ia in enumerate(a):
+            tp = getattr(fdesign, name)(ia)
+            assert_allclose(tps.lhs(k)[i], tp.lhs(k), rtol=1e-14)
+            assert_allclose(tps.rhs(r)[i], tp.rhs(r), rtol=1e-14)
+
+    # Several parameters; scalars are broadcasted
+    f = np.array([0.1, 1, 10])
+    tps = fdesign.j1_4(f, z=30)
+    for i, fi in enumerate(f):
+        tp = fdesign.j1_4(fi, z=30)
+        assert_allclose(tps.lhs(k)[i], tp.lhs(k), rtol=1e-14)
+        assert_allclose(tps.rhs(r)[i], tp.rhs(r), rtol=1e-14)
+
+    # 2. fC: sweep is checked like individual transform pairs
+    fI = [fdesign.j0_1(5), ]
+    fCs = fdesign.j0_1(np.array([3, 5, 8]))
+    fCs.rhs = fCs.rhs(r)
+    fC = [fdesign.j0_1(3), fdesign.j0_1(5), fdesign.j0_1(8)]
+    for tp in fC:
+        tp.rhs = tp.rhs(r)
+    inp = (201, fI, [fCs, ], r, (1, 1, 2), 0.01, np.real, 'amp', 0, 0, [])
+    out1 = fdesign._get_min_val((0.05, -1.0), *inp)
+    inp = (201, fI, fC, r, (1, 1, 2), 0.01, np.real, 'amp', 0, 0, [])
+    out2 = fdesign._get_min_val((0.05, -1.0), *inp)
+    assert_allclose(out1, out2, rtol=1e-6)
+
+    # 3. fI: sweep enters one inversion; resulting filter works for both
+    fIs = fdesign.j0_1(np.array([3, 5]))
+    filt = fdesign._calculate_filter(201, 0.0641, -1.2847, [fIs, ],
+                                     (1, 1, 2), np.real, 'sweep')
+    k = filt.base/r[:, None]
+    assert_allclose(np.dot(fIs.lhs(k), filt.j0)/r, fIs.rhs(r), rtol=1e-3)
+
+
 def test_empy_hankel():
 
     # 1. Simple test to compare ['j0', 'j1'] with 'j0' and 'j1'
@@ -397,6 +1068,47 @@ def test_empy_hankel():
     assert_allclose(out5a.lhs(1/r)[1], out5d)
 
 
+def test_tabulated(tmpdir, capsys):
+    k = np.logspace(-4, 2, 1000)
+    r = np.logspace(-1, 3, 500)
+    x = np.logspace(-3, 1, 111)
+    b = np.logspace(0, 1, 55)
+
+    # 1. Tabulated versions of analytical pairs (real and complex)
+    for tp in [fdesign.j0_1(5), fdesign.j1_4(1, 0.3, 50)]:
+        tt = fdesign.tabulated(tp.name, k, tp.lhs(k), r, tp.rhs(r))
+        assert tt.name == tp.name
+        assert_allclose(tt.lhs(x), tp.lhs(x), rtol=1e-6)
+        assert_allclose(tt.rhs(b), tp.rhs(b), rtol=1e-6)
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+    # 2. Memory-mapped data, parameter sweep, and pickling
+    tp = fdesign.sin_2(np.array([1, 2]))
+    np.save(str(tmpdir.join('lhs.npy')), tp.lhs(k))
+    lhs = np.load(str(tmpdir.join('lhs.npy')), mmap_mode='r')
+    tt = fdesign.tabulated('sin', k, lhs, r, tp.rhs(r))
+    tt = pickle.loads(pickle.dumps(tt))
+    assert_allclose(tt.lhs(x), tp.lhs(x), rtol=1e-6)
+    assert_allclose(tt.rhs(b), tp.rhs(b), rtol=1e-6)
+
+    # 3. Real data with sign changes
+    tt = fdesign.tabulated('cos', k, np.cos(k), r, np.sin(r))
+    assert_allclose(tt.lhs(x), np.cos(x), rtol=1e-5, atol=1e-8)
+
+    # 4. Extrapolation warning, only once
+    tt.lhs(np.array([1e-5, 1]))
+    tt.lhs(np.array([1e-5, 1]))
+    out, _ = capsys.readouterr()
+    assert out.count("* WARNING :: Tabulated lhs is extrapolated") == 1
+
+    # No warning if verb=0
+    tt = fdesign.tabulated('cos', k, np.cos(k), r, np.sin(r), verb=0)
+    tt.rhs(np.array([1e-5, 1]))
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+
 def test_get_min_val(capsys):
 
     # Some parameters
@@ -542,3 +1254,19 @@ def test_print_count(capsys):
                                 'time': default_timer(), 'warn-r': 0})
     out, _ = capsys.readouterr()
     assert out == ""
+
+
+def test_lazy_import():
+    # Attribute of a module, imported on first call
+    sqrt = fdesign._LazyImport('math', 'sqrt')
+    assert '_obj' not in sqrt.__dict__
+    assert sqrt(4) == 2
+    assert sqrt.__name__ == 'sqrt'
+
+    # Module; picklable
+    lmath = fdesign._LazyImport('math')
+    assert lmath.pi == np.pi
+    assert pickle.loads(pickle.dumps(fdesign._LazyImport('math'))).e == np.e
+
+    # Not installed
+    assert not fdesign._LazyImport('a_module_which_does_not_exist')
@@ -1,4 +1,6 @@
+import sys
 import pytest
+import subprocess
 
 # Optional imports
 try:
@@ -67,3 +69,26 @@ def test_versions(capsys):
     teststr += "</td>\n    <td style='"
     teststr += "border: 2px solid #fff; text-align: left;'>pytest</td>"
     assert teststr in out4
+
+
+def test_lazy_import():
+    # Importing empyscripts does not import the add-ons
+    code = ("import sys, empyscripts; print('empyscripts.fdesign' in " +
+            "sys.modules, 'fdesign' in dir(empyscripts))")
+    out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code])
+    assert out.decode().split() == ['False', 'True']
+
+    # Submodule imports (without PEP 562 module __getattr__, Python < 3.7)
+    code = ("import empyscripts.tmtemod; from empyscripts import fdesign, " +
+            "versions; print(empyscripts.tmtemod.__name__, " +
+            "fdesign.__name__, versions.__name__)")
+    out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code])
+    assert out.decode().split() == ['empyscripts.tmtemod',
+                                    'empyscripts.fdesign', 'versions']
+
+    # They are imported on first access
+    import empyscripts
+    assert empyscripts.fdesign.__name__ == 'empyscripts.fdesign'
+    assert empyscripts.versions is versions
+    with pytest.raises(AttributeError):
+        empyscripts.nonexistent
@@ -4,7 +4,14 @@ from numpy.testing import assert_allclose
 from scipy.constants import mu_0, epsilon_0
 
 from empyscripts import tmtemod
-from empymod import kernel, filters, dipole
+from empymod import kernel, filters, utils, dipole
+from empymod.model import tem
+
+# Optional import
+try:
+    import numexpr
+except ImportError:
+    numexpr = False
 
 # We only check that the summed return values in the functions in tmtemod agree
 # with the corresponding functions from empymod. Nothing more. The examples are
@@ -51,17 +58,200 @@ def test_dipole():
             # Check
             assert_allclose(out, TM + TE, rtol=1e-5, atol=1e-50)
 
-    # Check the 3 errors
+            # numexpr-version (or numpy, with a warning, if not installed)
+            TMne, TEne = tmtemod.dipole(eperm=eperm, mperm=mperm,
+                                        opt='parallel', **inp)
+            TMne = TMne[0] + TMne[1] + TMne[2] + TMne[3] + TMne[4]
+            TEne = TEne[0] + TEne[1] + TEne[2] + TEne[3] + TEne[4]
+            assert_allclose(TMne, TM, atol=1e-50)
+            assert_allclose(TEne, TE, atol=1e-50)
+
+    # Check the 2 errors
     with pytest.raises(ValueError):  # scr/rec not in same layer
         tmtemod.dipole([0, 0, 90], [4000, 0, 180], depth[1:-1], res, 1)
 
-    with pytest.raises(ValueError):  # more than one frequency
-        tmtemod.dipole([0, 0, 90], [4000, 0, 110], depth[1:-1], res, [1, 10])
-
     with pytest.raises(ValueError):  # only one layer
         tmtemod.dipole([0, 0, 90], [4000, 0, 110], [], 10, 1)
 
 
+def test_dipole_freqs():
+    # Several frequencies at once, same as one at a time
+    for lay in [0, 1, 5]:
+        inp = {'src': [0, 0, depth[lay+1]-50],
+               'rec': [1000, 0, depth[lay+1]-10], 'depth': depth[1:-1],
+               'res': res, 'aniso': aniso, 'eperm': eperm, 'mperm': mperm,
+               'verb': 0}
+        TM, TE = tmtemod.dipole(freqtime=freq, **inp)
+        assert TM[0].shape == TE[4].shape == (freq.size, )
+        for i, f in enumerate(freq):
+            TMf, TEf = tmtemod.dipole(freqtime=f, **inp)
+            for val, valf in zip(TM + TE, TMf + TEf):
+                assert_allclose(val[i], valf, rtol=1e-12, atol=1e-50)
+
+
+def test_dipole_htarg():
+    # Lagged convolution and splined DLF
+    inp = {'src': [0, 0, 100], 'rec': [2000, 500, 200], 'depth': [0, 1000],
+           'res': [2e14, 1, 100], 'freqtime': freq[:2], 'verb': 0}
+    for pts_per_dec in [-1, 10]:
+        htarg = {'fhtfilt': 'key_201_2012', 'pts_per_dec': pts_per_dec}
+        out = dipole(htarg=htarg, xdirect=False, **inp)
+        TM, TE = tmtemod.dipole(htarg=[None, pts_per_dec], **inp)
+        assert_allclose(np.sum(TM, 0) + np.sum(TE, 0), out, rtol=1e-10)
+
+    # Other filters, verified against the default filter key_201_2012
+    TM0, TE0 = tmtemod.dipole(**inp)
+    filt = filters.DigitalFilter('fdesign-like')  # As returned by fdesign
+    filt.base = filters.key_101_2012().base
+    filt.j0 = filters.key_101_2012().j0
+    filt.j1 = filters.key_101_2012().j1
+    filt.factor = filters.key_101_2012().factor
+    for fhtfilt, rtol in [('wer_201_2018', 1e-6), ('key_101_2009', 1e-5),
+                          (filt, 1e-6), (filters.key_51_2012(), 1e-3)]:
+        for pts_per_dec in [0, -1]:
+            TM, TE = tmtemod.dipole(htarg=[fhtfilt, pts_per_dec], **inp)
+            for val, val0 in zip(TM + TE, TM0 + TE0):
+                assert_allclose(val, val0, rtol=rtol,
+                                atol=rtol*abs(val0).max())
+
+    # Filter without J1-coefficients
+    del filt.j1
+    with pytest.raises(ValueError):
+        tmtemod.dipole(htarg={'fhtfilt': filt}, **inp)
+
+
+# Time-domain model of the following tests
+time = np.logspace(-2, 1, 11)
+tinp = {'src': [0, 0, 100], 'rec': [2000, 500, 200], 'depth': [0, 1000],
+        'res': [2e14, 1, 100], 'freqtime': time, 'verb': 0}
+
+
+def test_dipole_time():
+    # Time domain: impulse, switch-on, and switch-off responses
+    for signal, ft in [(0, 'sin'), (0, 'cos'), (1, 'sin'), (-1, 'sin')]:
+        for ftarg in [None, {'pts_per_dec': 0}, {'pts_per_dec': 10}]:
+            out = dipole(signal=signal, ft=ft, ftarg=ftarg, xdirect=False,
+                         **tinp)
+            TM, TE = tmtemod.dipole(signal=signal, ft=ft, ftarg=ftarg, **tinp)
+            assert TM[0].shape == TE[4].shape == (time.size, )
+            assert_allclose(np.sum(TM, 0) + np.sum(TE, 0), out,
+                            rtol=1e-4, atol=1e-4*abs(out).max())
+
+
+def test_dipole_modes():
+    # Selected modes, in the requested order, same as from all modes
+    TM, TE = tmtemod.dipole(signal=0, **tinp)
+    for modes in [['TE++', 'TM--'], 'TMdirect', ['TM-+', 'TEdirect', 'TE+-']]:
+        out = tmtemod.dipole(signal=0, modes=modes, **tinp)
+        modes = [modes, ] if isinstance(modes, str) else modes
+        assert len(out) == len(modes)
+        for mode, val in zip(modes, out):
+            assert_allclose(val, (TM + TE)[tmtemod._MODES.index(mode)],
+                            rtol=1e-12, atol=1e-50)
+
+    with pytest.raises(ValueError):  # unknown mode
+        tmtemod.dipole(modes=['TM++', 'TM00'], **tinp)
+
+
+def test_dipole_models():
+    # Several models at once, same as one at a time
+    inp = dict(tinp, aniso=[1, 2, 1],
+               res=np.array([[2e14, 1, 100], [2e14, 3, 10], [2e14, 0.3, 30]]),
+               mperm=[[1, 1, 1], [1, 2, 1], [1, 1, 3]])
+    for signal in [None, 0, -1]:
+        TM, TE = tmtemod.dipole(signal=signal, **inp)
+        assert TM[0].shape == TE[4].shape == (3, time.size)
+        for i in range(3):
+            inpi = dict(inp, res=inp['res'][i], mperm=inp['mperm'][i])
+            TMi, TEi = tmtemod.dipole(signal=signal, **inpi)
+            for val, vali in zip(TM + TE, TMi + TEi):
+                assert_allclose(val[i], vali, rtol=1e-10,
+                                atol=1e-10*abs(vali).max())
+    out = tmtemod.dipole(signal=-1, modes='TE++', **inp)
+    assert_allclose(out[0], TE[3])
+
+    with pytest.raises(ValueError):  # different number of models
+        tmtemod.dipole(**dict(inp, mperm=[[1, 1, 1], [1, 2, 1]],
+                              res=[[2e14, 1, 100]]*3))
+    with pytest.raises(ValueError):  # wrong number of layers of a model axis
+        tmtemod.dipole(**dict(inp, mperm=[[1, 1], [1, 2], [1, 1]]))
+
+
+def test_dipole_models_min(capsys):
+    # Minimum values of stacked parameters are set as in check_model
+    inp = dict(tinp, aniso=[[1, 1, 1], [1, 0, 1]],
+               res=np.array([[2e14, 1, 100], [2e14, 3, 0]]),
+               eperm=[[1, -1, 1], [1, 1, 1]], verb=1)
+    _ = capsys.readouterr()
+    TM, TE = tmtemod.dipole(**inp)
+    out, _ = capsys.readouterr()
+    assert 'Resistivities < 1e-20 Ohm.m' in out
+    assert 'Parameter aniso < 1e-20' in out
+    assert 'Parameter epermH < 0.0' in out
+    for i, model in enumerate([
+            dict(res=[2e14, 1, 100], aniso=[1, 1, 1], eperm=[1, 0, 1]),
+            dict(res=[2e14, 3, 1e-20], aniso=[1, np.sqrt(1e-20/3), 1],
+                 eperm=[1, 1, 1])]):
+        TMi, TEi = tmtemod.dipole(**dict(inp, **model))
+        for val, vali in zip(TM + TE, TMi + TEi):
+            assert_allclose(val[i], vali, rtol=1e-10,
+                            atol=1e-10*abs(vali).max())
+
+
+def test_dipole_jacobian():
+    # Jacobian, compared to central differences
+    inp = dict(tinp, res=[2e14, 3, 10], aniso=[1, 2, 1])
+    for signal, rtol in [(None, 1e-6), (0, 1e-4)]:
+        TM, TE, dTM, dTE = tmtemod.dipole(signal=signal,
+                                          jacobian=['res', 'aniso'], **inp)
+        assert dTM[0].shape == dTE[4].shape == (2, 3, time.size)
+        for i, name in enumerate(['res', 'aniso']):
+            for j in range(3):
+                inpj = dict(inp)
+                inpj[name] = np.array(inp[name], dtype=float)
+                h = 1e-6*inpj[name][j]
+                inpj[name][j] += h
+                TMp, TEp = tmtemod.dipole(signal=signal, **inpj)
+                inpj[name][j] -= 2*h
+                TMm, TEm = tmtemod.dipole(signal=signal, **inpj)
+                for vp, vm, dval, val in zip(TMp + TEp, TMm + TEm, dTM + dTE,
+                                             TM + TE):
+                    assert_allclose(dval[i, j], (vp - vm)/(2*h), rtol=rtol,
+                                    atol=rtol*abs(val).max()/h*1e-6)
+    EM, dEM = tmtemod.dipole(modes=['TEdirect', 'TM+-'], jacobian='res',
+                             signal=0, **inp)
+    assert_allclose(dEM[0], dTE[4][0], atol=1e-10*abs(dTE[4][0]).max())
+    assert_allclose(dEM[1], dTM[2][0], atol=1e-10*abs(dTM[2][0]).max())
+
+    with pytest.raises(ValueError):  # unknown Jacobian parameter
+        tmtemod.dipole(jacobian=['res', 'eperm'], **inp)
+
+
+def test_dipole_cache():
+    # Cache: changed layers only, same result as without cache
+    cache = {}
+    inp = {'src': [0, 0, 1100], 'rec': [2000, 500, 1200],
+           'depth': [0, 1000, 1500, 2000], 'freqtime': freq[:2], 'verb': 0}
+    for resc, kwargs in [([2e14, 1, 100, 3, 1], {}),
+                         ([2e14, 1, 100, 5, 1], {}),
+                         ([2e14, 2, 100, 5, 1], {'modes': ['TMdirect']}),
+                         ([2e14, 2, 100, 5, 1], {'opt': 'parallel'}),
+                         ([2e14, 3, 100, 5, 1], {'aniso': [1, 1, 1, 2, 1]}),
+                         ([2e14, 3, 100, 5, 3], {'freqtime': freq[1:]})]:
+        kwargs = dict(inp, **kwargs)
+        out = tmtemod.dipole(cache=cache, res=resc, **kwargs)
+        for val, val0 in zip(out, tmtemod.dipole(res=resc, **kwargs)):
+            assert_allclose(val, val0, rtol=1e-14, atol=1e-50)
+
+    # Unchanged steps of the recursion are reused (layer 1 is above the
+    # src-layer 2: Rp is reused, Rm recalculated)
+    Rp, Rm = dict(cache['TE']['Rp']), dict(cache['TE']['Rm'])
+    tmtemod.dipole(cache=cache, res=[2e14, 4, 100, 5, 3],
+                   **dict(inp, freqtime=freq[1:]))
+    assert cache['TE']['Rp'][3] is Rp[3] and cache['TE']['Rp'][2] is Rp[2]
+    assert cache['TE']['Rm'][1] is not Rm[1]
+
+
 def test_greenfct():
     for lay in [0, 1, 5]:  # src/rec in first, second, and last layer
         inp = {'depth': depth[:-1], 'lambd': lambd,
@@ -83,6 +273,29 @@ def test_greenfct():
         assert_allclose(out1, TM, atol=1e-100)
         assert_allclose(out2, TE)
 
+        # numexpr-version
+        if numexpr:
+            TMne, TEne = tmtemod.greenfct(use_ne_eval=numexpr.evaluate, **inp)
+            TMne = TMne[0] + TMne[1] + TMne[2] + TMne[3] + TMne[4]
+            TEne = TEne[0] + TEne[1] + TEne[2] + TEne[3] + TEne[4]
+            assert_allclose(TMne, TM, atol=1e-100)
+            assert_allclose(TEne, TE)
+
+        # All modes in one provided array
+        out = np.zeros((2, 5, freq.size) + lambd.shape, dtype=complex)
+        TMo, TEo = tmtemod.greenfct(out=out, **inp)
+        assert np.shares_memory(TMo, out) and np.shares_memory(TEo, out)
+        assert_allclose(out[0].sum(0), TM, atol=1e-100)
+        assert_allclose(out[1].sum(0), TE)
+
+        # Only selected modes
+        modes = ['TE-+', 'TMdirect', 'TM++']
+        out = tmtemod.greenfct(modes=modes, **inp)
+        assert out.shape == (3, freq.size) + lambd.shape
+        assert_allclose(out[0], TEo[1])
+        assert_allclose(out[1], TMo[4], atol=1e-100)
+        assert_allclose(out[2], TMo[3], atol=1e-100)
+
 
 def test_fields():
     Gam = np.sqrt((etaH/etaV)[:, None, :, None] *
@@ -111,3 +324,152 @@ def test_fields():
             # Check
             assert_allclose(out[0], TMTE[0] + TMTE[1])
             assert_allclose(out[1], TMTE[2] + TMTE[3])
+
+            # numexpr-version
+            if numexpr:
+                TMTEne = tmtemod.fields(use_ne_eval=numexpr.evaluate, **inp2)
+                for val, valne in zip(TMTE, TMTEne):
+                    assert_allclose(valne, val)
+
+            # Only selected fields
+            TMTEsel = tmtemod.fields(which=['ud', 'dd'], **inp2)
+            assert TMTEsel[0] is None and TMTEsel[2] is None
+            assert_allclose(TMTEsel[1], TMTE[1])
+            assert_allclose(TMTEsel[3], TMTE[3])
+
+
+def test_tem():
+    # The batched transform must agree column by column with empymod
+    time = np.logspace(-2, 1, 11)
+    for signal in [0, 1, -1]:
+        for pts_per_dec in [-1, 0, 5]:
+            time, freq, ft, ftarg = utils.check_time(
+                    time, signal, 'sin', {'pts_per_dec': pts_per_dec}, 0)
+            fEM = np.outer(1/freq + 1j*np.sin(freq), [1, 2, 3])
+            tEM, conv = tmtemod.tem(fEM, freq, time, signal, ft, ftarg)
+            assert conv
+            for i in range(fEM.shape[1]):
+                out, _ = tem(fEM[:, i:i+1], np.ones(1), freq, time, signal,
+                             ft, ftarg)
+                assert_allclose(tEM[:, i], out[:, 0], rtol=1e-10)
+
+
+def test_unique_offsets():
+    # Receivers on a circle and reciprocal pairs
+    phi = np.linspace(0, 2*np.pi, 7)
+    off = np.r_[np.sqrt((3000*np.cos(phi))**2 + (3000*np.sin(phi))**2),
+                [1000, 5000, 1000, 5000+1e-6]]
+    uoff, uind = tmtemod._unique_offsets(off)
+    assert_allclose(uoff, [1000, 3000, 5000, 5000+1e-6])
+    assert_allclose(uoff[uind], off, rtol=1e-12)
+
+
+def test_dipole_offsets():
+    # Receivers on a circle (one unique offset) and reciprocal receivers (each
+    # offset twice), same as one receiver at a time
+    phi = np.linspace(0, 2*np.pi, 8, endpoint=False)
+    off = np.array([1000, 2500, 4000])
+    inp = {'src': [0, 0, 100], 'depth': [0, 1000], 'res': [2e14, 1, 100],
+           'verb': 0}
+    for x, y, nunique in [(3000*np.cos(phi), 3000*np.sin(phi), 1),
+                          (np.r_[off, -off], np.zeros(2*off.size), 3)]:
+        assert tmtemod._unique_offsets(np.hypot(x, y))[0].size == nunique
+
+        # Receivers as object array: a list of arrays and a float is ragged,
+        # which empymod's check_dipole cannot squeeze with numpy >= 1.24
+        rec = np.empty(3, dtype=object)
+        rec[:] = [x, y, 200]
+
+        # Frequency and time domain
+        for freqtime, signal in [(freq[:2], None),
+                                 (np.logspace(-2, 1, 5), 0)]:
+            TM, TE = tmtemod.dipole(rec=rec, freqtime=freqtime,
+                                    signal=signal, **inp)
+            assert TM[0].shape == TE[4].shape == (freqtime.size, x.size)
+            for i in range(x.size):
+                TMi, TEi = tmtemod.dipole(rec=[x[i], y[i], 200],
+                                          freqtime=freqtime, signal=signal,
+                                          **inp)
+                for val, vali in zip(TM + TE, TMi + TEi):
+                    assert_allclose(val[:, i], vali, rtol=1e-10,
+                                    atol=1e-10*abs(vali).max())
+
+
+def test_reflections_deriv():
+    Gam = np.sqrt((etaH/etaV)[:, None, :, None] *
+                  (lambd**2)[None, :, None, :] + (zeta**2)[:, None, :, None])
+
+    for lay in [0, 1, 5]:  # Src/rec in first, second, and last layer
+        inp = {'depth': depth[:-1], 'e_zH': etaH, 'lrec': np.array(lay),
+               'lsrc': np.array(lay)}
+
+        # Same reflections as empymod
+        Rp, Rm, dRp, dRm = tmtemod.reflections_deriv(Gam=Gam, **inp)
+        Rp1, Rm1 = kernel.reflections(Gam=Gam, use_ne_eval=False, **inp)
+        assert_allclose(Rp, np.squeeze(Rp1, 2) if Rp1.ndim == 4 else Rp1)
+        assert_allclose(Rm, np.squeeze(Rm1, 2) if Rm1.ndim == 4 else Rm1)
+
+        # Derivatives with respect to Gam and e_zH of layer 3, central
+        # differences (low frequencies and small wavenumbers, where the
+        # reflections are smooth)
+        Gam1, e_zH = Gam[:2, 2:], etaH[:2]
+        inp['e_zH'] = e_zH
+        _, _, dRp, dRm = tmtemod.reflections_deriv(Gam=Gam1, **inp)
+        h = 1e-6*Gam1[:, :, 3, :]
+        Gamp, Gamm = Gam1.copy(), Gam1.copy()
+        Gamp[:, :, 3, :] += h
+        Gamm[:, :, 3, :] -= h
+        outp = tmtemod.reflections_deriv(Gam=Gamp, **inp)
+        outm = tmtemod.reflections_deriv(Gam=Gamm, **inp)
+        for i, dR in enumerate([dRp, dRm]):
+            fd = outp[i] - outm[i]
+            assert_allclose(dR[0][:, :, 3, :]*2*h, fd, rtol=1e-5,
+                            atol=1e-7*abs(fd).max())
+
+        he = 1e-6*e_zH[:, 3]
+        e_zHp, e_zHm = e_zH.copy(), e_zH.copy()
+        e_zHp[:, 3] += he
+        e_zHm[:, 3] -= he
+        inp['Gam'] = Gam1
+        outp = tmtemod.reflections_deriv(**dict(inp, e_zH=e_zHp))
+        outm = tmtemod.reflections_deriv(**dict(inp, e_zH=e_zHm))
+        for i, dR in enumerate([dRp, dRm]):
+            fd = outp[i] - outm[i]
+            assert_allclose(dR[1][:, :, 3, :]*2*he[:, None, None], fd,
+                            rtol=1e-5, atol=1e-7*abs(fd).max())
+
+
+def test_reflections_cache():
+    Gam = np.sqrt((etaH/etaV)[:, None, :, None] *
+                  (lambd**2)[None, :, None, :] + (zeta**2)[:, None, :, None])
+
+    for lay in [0, 1, 5]:  # Src/rec in first, second, and last layer
+        inp = {'depth': depth[:-1], 'e_zH': etaH, 'lrec': np.array(lay),
+               'lsrc': np.array(lay), 'use_ne_eval': False}
+
+        # Same reflections as empymod
+        entry = {}
+        Rp, Rm = tmtemod.reflections_cache(Gam=Gam, entry=entry, **inp)
+        Rp1, Rm1 = kernel.reflections(Gam=Gam, **inp)
+        assert_allclose(Rp, np.squeeze(Rp1, 2) if Rp1.ndim == 4 else Rp1)
+        assert_allclose(Rm, np.squeeze(Rm1, 2) if Rm1.ndim == 4 else Rm1)
+
+        # Changed layer 3: same as from scratch
+        Gam2 = Gam.copy()
+        Gam2[:, :, 3, :] *= 1.1
+        changed = np.arange(depth.size-1) == 3
+        Rp, Rm = tmtemod.reflections_cache(Gam=Gam2, entry=entry,
+                                           changed=changed, **inp)
+        Rp2, Rm2 = tmtemod.reflections_cache(Gam=Gam2, entry={}, **inp)
+        assert_allclose(Rp, Rp2, rtol=1e-15)
+        assert_allclose(Rm, Rm2, rtol=1e-15)
+
+
+def test_dlf():
+    # Combined J0/J1-weights, compared to the separate filter application
+    off = np.array([500., 1000, 3000])
+    lambd = filt.base/off[:, None]
+    PT = np.exp(-np.array([1, 2])[:, None, None]*lambd) + 1j  # (2, 3, nl)
+    J0, J1 = tmtemod.dlf(PT, lambd, off, filt, 0)
+    assert_allclose(J0, np.dot(PT*lambd, filt.j0)/off)
+    assert_allclose(J1, np.dot(-PT, filt.j1)/off**2)